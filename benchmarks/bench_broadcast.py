@@ -0,0 +1,97 @@
+"""Compare per-task shipping of func/args/kwargs with the one-time broadcast.
+
+Maps a cheap function over items with a large constant kwarg. The baseline
+sends ``(func, obj, args, kwargs)`` with every task, as ``pmap_iter`` used
+to. ``pmap`` now pickles the call once and each task carries only its objs.
+
+Run from the repo root::
+
+    python benchmarks/bench_broadcast.py --mb 100 --items 64 --num-proc 2
+"""
+
+import argparse
+import multiprocessing as mp
+import pickle
+import time
+
+from logmap import pmap, shutdown_pools
+from logmap.logmap import CONTEXT, _iter_chunks
+
+
+def fixed_chunksize(n_items, num_proc):
+    # The fixed size pmap used before chunks were sized adaptively, so both
+    # sides ship the same chunks.
+    if num_proc <= 1:
+        return 1
+    return max(1, n_items // (num_proc * 4))
+
+
+def lookup(x, table=None):
+    return x + len(table)
+
+
+def _per_task(inp):
+    func, obj, args, kwargs = inp
+    return func(obj, *args, **kwargs)
+
+
+def baseline(items, kwargs, num_proc, chunksize):
+    payload = ((lookup, obj, (), kwargs) for obj in items)
+    with mp.get_context(CONTEXT).Pool(num_proc) as pool:
+        return list(pool.imap(_per_task, payload, chunksize=chunksize))
+
+
+def baseline_ipc_bytes(items, kwargs, chunksize):
+    # Pool pickles each chunk as one task; pickle's memo dedupes the kwarg
+    # within a chunk but not across chunks.
+    return sum(
+        len(pickle.dumps([(lookup, obj, (), kwargs) for obj in chunk]))
+        for _, chunk in _iter_chunks(items, chunksize)
+    )
+
+
+def broadcast_ipc_bytes(items, kwargs, chunksize):
+    call = len(pickle.dumps((lookup, (), kwargs), protocol=pickle.HIGHEST_PROTOCOL))
+    tasks = sum(
+        len(pickle.dumps(("0:1", "/tmp/logmap-xxxxxxxx.pkl", chunk)))
+        for _, chunk in _iter_chunks(items, chunksize)
+    )
+    return call + tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mb", type=int, default=100, help="kwarg size in MB")
+    parser.add_argument("--items", type=int, default=64)
+    parser.add_argument("--num-proc", type=int, default=2)
+    opts = parser.parse_args()
+
+    items = list(range(opts.items))
+    kwargs = {"table": b"\0" * (opts.mb * 1024 * 1024)}
+    cs = fixed_chunksize(len(items), opts.num_proc)
+    expected = [x + len(kwargs["table"]) for x in items]
+
+    t0 = time.perf_counter()
+    assert baseline(items, kwargs, opts.num_proc, cs) == expected
+    t_base = time.perf_counter() - t0
+
+    # Warm the pool so both sides pay for process startup the same way.
+    pmap(lookup, [0, 1], kwargs={"table": b""}, num_proc=opts.num_proc, progress=False)
+    t0 = time.perf_counter()
+    out = pmap(lookup, items, kwargs=kwargs, num_proc=opts.num_proc,
+               chunksize=cs, progress=False)
+    t_new = time.perf_counter() - t0
+    assert out == expected
+    shutdown_pools()
+
+    b_base = baseline_ipc_bytes(items, kwargs, cs)
+    b_new = broadcast_ipc_bytes(items, kwargs, cs)
+    mb = 1024 * 1024
+    print(f"{opts.items} items, {opts.mb} MB kwarg, num_proc={opts.num_proc}, chunksize={cs}")
+    print(f"  per-task : {b_base / mb:10.1f} MB pickled  {t_base:8.2f} s")
+    print(f"  broadcast: {b_new / mb:10.1f} MB pickled  {t_new:8.2f} s")
+    print(f"  saved    : {(b_base - b_new) / mb:10.1f} MB         {t_base - t_new:8.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Compare the old per-record line rendering with the compiled formatters.
+
+The text baseline is the formatter ``configure(format=...)`` used to apply to
+every record: a ``datetime.fromtimestamp`` call, a full timestamp and a
+``str.format`` of the template. The compiled formatter folds constants into
+the code at configure time and reuses the timestamp for the rest of the second.
+
+The structured baseline builds a dict and calls ``json.dumps`` per record,
+against the pre-serialized JSON-lines encoder with ISO and nanosecond ``ts``.
+
+Run from the repo root::
+
+    python benchmarks/bench_format.py --lines 200000
+"""
+
+import argparse
+import io
+import json
+import sys
+import time
+from datetime import datetime
+
+from logmap import configure, flush, logmap
+from logmap.logmap import (
+    _CYAN, _RESET, DEFAULT_FORMAT, LEVEL_COLORS, _compile_format, _iso_ts, _json_line, _ns_ts,
+)
+
+EXTRA = {"depth": 2, "task": "outer", "msg": "processed item"}
+
+
+def baseline(t, level, msg, fmt, colorize):
+    n = datetime.fromtimestamp(t)
+    ts = (f"{n.year:04d}-{n.month:02d}-{n.day:02d} "
+          f"{n.hour:02d}:{n.minute:02d}:{n.second:02d},{n.microsecond // 1000:03d}")
+    if colorize:
+        return fmt.format(color=LEVEL_COLORS.get(level, ""), msg=msg,
+                          reset=_RESET, cyan=_CYAN, time=ts)
+    return fmt.format(color="", msg=msg, reset="", cyan="", time=ts)
+
+
+def baseline_json(t, level, msg, extra):
+    out = {"ts": datetime.fromtimestamp(t).isoformat(), "level": level, "msg": msg}
+    out.update(extra)
+    return json.dumps(out, default=str)
+
+
+def rate(render, n):
+    # Timestamps advance 10 us per line, as in a busy hot loop.
+    t = time.time()
+    t0 = time.perf_counter()
+    for i in range(n):
+        render(t + i * 1e-5, "INFO", "processed item")
+    return n / (time.perf_counter() - t0)
+
+
+def end_to_end(n, colorize=False, **config):
+    buf = io.StringIO()
+    configure(sinks=[{"sink": buf, "colorize": colorize}], **config)
+    t0 = time.perf_counter()
+    with logmap("bench") as lm:
+        for _ in range(n):
+            lm.info("processed item")
+    flush()
+    return n / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200_000)
+    parser.add_argument("--format", default=DEFAULT_FORMAT)
+    opts = parser.parse_args()
+
+    print(f"{opts.lines} lines, format={opts.format!r}")
+    print(f"  {'mode':10s} {'str.format':>14s} {'compiled':>14s} {'speedup':>8s} {'lm.info':>14s}")
+    for colorize in (False, True):
+        fmt = opts.format
+        compiled = _compile_format(fmt, colorize)
+        assert compiled(1e9, "INFO", "x") == baseline(1e9, "INFO", "x", fmt, colorize)
+        old = rate(lambda t, lv, m: baseline(t, lv, m, fmt, colorize), opts.lines)
+        new = rate(compiled, opts.lines)
+        e2e = end_to_end(opts.lines, colorize)
+        mode = "colorized" if colorize else "plain"
+        print(f"  {mode:10s} {old:10,.0f}/s {new:10,.0f}/s {new / old:7.1f}x {e2e:10,.0f}/s")
+
+    print(f"  {'mode':10s} {'json.dumps':>14s} {'encoder':>14s} {'speedup':>8s} {'lm.info':>14s}")
+    old = rate(lambda t, lv, m: baseline_json(t, lv, m, EXTRA), opts.lines)
+    for ts_format in ("iso", "ns"):
+        ts = _ns_ts if ts_format == "ns" else _iso_ts
+        new = rate(lambda t, lv, m: _json_line(t, lv, m, EXTRA, ts), opts.lines)
+        e2e = end_to_end(opts.lines, structured=True, ts_format=ts_format)
+        print(f"  {'json ' + ts_format:10s} {old:10,.0f}/s {new:10,.0f}/s {new / old:7.1f}x {e2e:10,.0f}/s")
+    configure(sink=sys.stderr, structured=False, ts_format="iso")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,18 @@ from importlib.metadata import PackageNotFoundError, version as _pkg_version
 
 from .logmap import (
     BOTTOM_CHAR,
+    MapStats,
+    ResultCache,
+    RotatingSink,
     TOP_CHAR,
     VERTICAL_CHAR,
     configure,
+    flush,
     logmap,
     pmap,
     pmap_iter,
     pmap_run,
+    shutdown_pools,
 )
 
 try:
@@ -18,12 +23,17 @@ except PackageNotFoundError:  # running from source tree, not installed
 
 __all__ = [
     "BOTTOM_CHAR",
+    "MapStats",
+    "ResultCache",
+    "RotatingSink",
     "TOP_CHAR",
     "VERTICAL_CHAR",
     "configure",
+    "flush",
     "logmap",
     "pmap",
     "pmap_iter",
     "pmap_run",
+    "shutdown_pools",
     "__version__",
 ]
@@ -1,207 +1,2917 @@
 """Hierarchical context-manager logger with multiprocess mapping."""
 
 import asyncio
+import atexit
+import contextvars
 import functools
+import gzip
+import hashlib
 import inspect
+import io
 import json
 import multiprocessing as mp
+import os
+import pickle
 import platform
+import queue
 import random
+import shutil
+import sqlite3
+import string
 import sys
+import tempfile
 import threading
 import time
+import weakref
 from collections import deque
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
+from itertools import chain, count, islice
+from json.encoder import encode_basestring_ascii
+from multiprocessing import resource_tracker, shared_memory
 
-from humanfriendly import format_timespan
+from humanfriendly import format_size, format_timespan
 from tqdm.auto import tqdm
 
+try:  # optional: faster JSON string escaping for structured output
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # ---------------------------------------------------------------------------
 # Module config
 # ---------------------------------------------------------------------------
 
-def _default_mp_context():
-    system = platform.system()
-    if system == "Darwin":
-        return "forkserver"
-    if system == "Windows":
-        return "spawn"
-    return "fork"
+def _default_mp_context():
+    system = platform.system()
+    if system == "Darwin":
+        return "forkserver"
+    if system == "Windows":
+        return "spawn"
+    return "fork"
+
+
+CONTEXT = _default_mp_context()
+
+# Parallel map backends: worker processes, worker threads, or inline
+BACKENDS = ("process", "thread", "serial")
+
+# Coroutines in flight at once for logmap.amap / logmap.aimap
+DEFAULT_CONCURRENCY = 100
+
+# Progress display: tqdm bars, periodic log lines, or bars only on a TTY sink
+PROGRESS_STYLES = ("auto", "bar", "log")
+# Fastest a bar redraws for a changed description (lm.log inside a loop)
+PROGRESS_REFRESH_SECONDS = 0.1
+# Seconds between "n/total, rate, ETA" lines when progress is logged
+PROGRESS_INTERVAL_SECONDS = 10.0
+
+_cpu = mp.cpu_count()
+DEFAULT_NUM_PROC = 1 if _cpu <= 1 else (2 if _cpu <= 3 else _cpu - 2)
+
+# Level dispatch — int values follow stdlib logging convention
+LEVELS = {
+    "TRACE": 5,
+    "DEBUG": 10,
+    "INFO": 20,
+    "WARNING": 30,
+    "ERROR": 40,
+    "CRITICAL": 50,
+}
+
+# ANSI color codes used in output
+_RESET = "\033[0m"
+_CYAN = "\033[0;36m"
+TOP_CHAR = "⎾"
+BOTTOM_CHAR = "⎿"
+VERTICAL_CHAR = " "
+
+LEVEL_COLORS = {
+    "TRACE":    "\033[0;36m",
+    "DEBUG":    "\033[1;34m",
+    "INFO":     "\033[1;32m",
+    "WARNING":  "\033[1;33m",
+    "ERROR":    "\033[1;31m",
+    "CRITICAL": "\033[1;35m",
+}
+
+# Format string — understood placeholders: {color} {msg} {reset} {cyan} {time}
+DEFAULT_FORMAT = "{color}{msg}{reset}{cyan} @ {time}{reset}"
+
+# Legacy palette used by iter_progress's tqdm bar_format
+COLORS = {
+    "default": "\033[0;39m",
+    "light-blue": "\033[0;34m",
+    "light-cyan": "\033[0;36m",
+    "light-yellow": "\033[0;33m",
+    "light-magenta": "\033[0;35m",
+}
+
+
+# ---------------------------------------------------------------------------
+# Per-context nesting state + shared output config
+# ---------------------------------------------------------------------------
+
+class _ContextField:
+    """Attribute backed by a ``ContextVar``.
+
+    Each thread, and each asyncio task (which starts from a copy of its
+    creator's context), sees and updates its own value.
+    """
+
+    def __init__(self, name, default):
+        self.var = contextvars.ContextVar(f"logmap.{name}", default=default)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return self.var.get()
+
+    def __set__(self, obj, value):
+        self.var.set(value)
+
+
+class _NestingState:
+    __slots__ = ()
+    num_logwatches = _ContextField("num_logwatches", 0)
+    logwatch_id = _ContextField("logwatch_id", 0)
+    is_quiet = _ContextField("is_quiet", False)
+    pool_scope = _ContextField("pool_scope", None)
+
+
+_nesting = _NestingState()
+_lock = threading.Lock()
+
+# Output config — module-level, shared across threads, guarded by _lock.
+# _level/_format/_structured/_ts_format are the defaults each sink inherits
+# unless it sets its own; _min_level is the lowest level any sink accepts.
+_level = LEVELS["DEBUG"]
+_min_level = _level
+_format = DEFAULT_FORMAT
+_structured = False
+_ts_format = "iso"
+_logger = None
+_progress_style = "auto"
+_progress_refresh = PROGRESS_REFRESH_SECONDS
+_progress_interval = PROGRESS_INTERVAL_SECONDS
+# First sink's stream and color setting (progress bars coordinate with it)
+_sink = sys.stderr
+_colorize = False
+
+
+def _isatty(stream):
+    try:
+        return bool(stream.isatty())
+    except (AttributeError, ValueError):
+        return False
+
+
+_UNSET = object()
+
+
+# Last second rendered by _timestamp: (epoch second, "YYYY-mm-dd HH:MM:SS")
+_ts_cache = (None, "")
+
+
+def _split_ts(t):
+    """``(whole seconds, microseconds)`` of epoch ``t``, rounded as datetime does."""
+    sec = int(t)
+    us = round((t - sec) * 1e6)
+    if us >= 1_000_000:
+        return sec + 1, us - 1_000_000
+    return sec, us
+
+
+def _timestamp(t):
+    """``YYYY-mm-dd HH:MM:SS,mmm`` for epoch ``t``; only ms change within a second."""
+    global _ts_cache
+    sec, us = _split_ts(t)
+    cached_sec, prefix = _ts_cache
+    if sec != cached_sec:
+        prefix = datetime.fromtimestamp(sec).strftime("%Y-%m-%d %H:%M:%S")
+        _ts_cache = (sec, prefix)
+    return f"{prefix},{us // 1000:03d}"
+
+
+FORMAT_FIELDS = ("color", "msg", "reset", "cyan", "time")
+_CONVERSIONS = {"r": repr, "s": str, "a": ascii}
+
+
+def _compile_format(fmt, colorize):
+    """Compile ``fmt`` into ``line(t, level, msg, extra=None) -> str``.
+
+    Literal text and the color codes (fixed once ``colorize`` is known) are
+    folded into constants, and the timestamp is only rendered when
+    ``{time}`` is used, so a line costs a few string concatenations.
+    """
+    parts = []
+    for literal, field, spec, conv in string.Formatter().parse(fmt):
+        if literal:
+            parts.append((True, literal))
+        if field is None:
+            continue
+        if field not in FORMAT_FIELDS:
+            raise ValueError(
+                f"unknown placeholder {{{field}}} in format {fmt!r}; "
+                f"expected some of {', '.join('{%s}' % f for f in FORMAT_FIELDS)}"
+            )
+        if spec and "{" in spec:
+            raise ValueError(f"nested placeholders are not supported in format {fmt!r}")
+        if field in ("reset", "cyan"):
+            value = (_RESET if field == "reset" else _CYAN) if colorize else ""
+            if conv:
+                value = _CONVERSIONS[conv](value)
+            parts.append((True, format(value, spec)))
+            continue
+        if field == "color" and not colorize:
+            parts.append((True, format("", spec)))
+            continue
+        expr = {"color": "_colors.get(level, '')", "msg": "msg", "time": "_timestamp(t)"}[field]
+        if conv:
+            expr = f"{_CONVERSIONS[conv].__name__}({expr})"
+        if spec:
+            expr = f"format({expr}, {spec!r})"
+        elif conv is None and field == "msg":
+            expr = "str(msg)"
+        parts.append((False, expr))
+    # Merge adjacent constants, then emit one concatenation.
+    code = []
+    for is_const, text in parts:
+        if is_const and code and code[-1][0]:
+            code[-1] = (True, code[-1][1] + text)
+        else:
+            code.append((is_const, text))
+    body = " + ".join(repr(text) if is_const else text for is_const, text in code) or "''"
+    ns = {"_colors": LEVEL_COLORS, "_timestamp": _timestamp}
+    exec(compile(f"def line(t, level, msg, extra=None):\n    return {body}\n",
+                 "<logmap format>", "exec"), ns)
+    return ns["line"]
+
+
+# Structured ``ts`` encodings: ISO-8601 local time, or integer epoch nanoseconds
+TS_FORMATS = ("iso", "ns")
+
+if orjson is not None:
+    def _json_str(s):
+        try:
+            return orjson.dumps(s).decode()
+        except TypeError:  # lone surrogates; the stdlib escapes them
+            return encode_basestring_ascii(s)
+else:
+    _json_str = encode_basestring_ascii
+
+
+def _json_value(v):
+    """JSON text for one value, matching ``json.dumps(v, default=str)``."""
+    kind = type(v)
+    if kind is str:
+        return _json_str(v)
+    if kind is int:
+        return str(v)
+    if v is None:
+        return "null"
+    return json.dumps(v, default=str)
+
+
+# Last second rendered by _iso_ts: (epoch second, '{"ts": "YYYY-mm-ddTHH:MM:SS')
+_iso_cache = (None, "")
+
+
+def _iso_ts(t):
+    """``{"ts": "<isoformat>"`` for epoch ``t``, as ``datetime.isoformat`` writes it."""
+    global _iso_cache
+    sec, us = _split_ts(t)
+    cached_sec, prefix = _iso_cache
+    if sec != cached_sec:
+        prefix = datetime.fromtimestamp(sec).strftime('{"ts": "%Y-%m-%dT%H:%M:%S')
+        _iso_cache = (sec, prefix)
+    return f'{prefix}.{us:06d}"' if us else prefix + '"'
+
+
+def _ns_ts(t):
+    """``{"ts": <epoch ns>`` for epoch ``t``."""
+    return '{"ts": ' + str(round(t * 1e9))
+
+
+# Pre-serialized '", "level": "INFO", "msg": ' and '", "depth": ' pieces
+_json_levels = {}
+_json_keys = {}
+
+
+def _json_line(t, level, msg, extra, ts=_iso_ts):
+    """One JSON-lines record: ``ts``, ``level``, ``msg``, then ``extra`` keys.
+
+    Same keys, order and values as ``json.dumps`` of the merged dict, but
+    only ``msg`` and the string values in ``extra`` are escaped per line.
+    """
+    head = _json_levels.get(level)
+    if head is None:
+        head = _json_levels[level] = f", \"level\": {_json_str(level)}, \"msg\": "
+    if extra:
+        msg = extra.get("msg", msg)
+    out = ts(t) + head + _json_value(msg)
+    if extra:
+        for key, value in extra.items():
+            if key == "msg":
+                continue
+            sep = _json_keys.get(key)
+            if sep is None:
+                sep = _json_keys[key] = f", {_json_str(str(key))}: "
+            out += sep + _json_value(value)
+    return out + "}"
+
+
+# ---------------------------------------------------------------------------
+# Sinks and dispatch
+# ---------------------------------------------------------------------------
+
+# Keys a ``configure(sinks=[{...}])`` entry may set
+SINK_OPTIONS = ("sink", "level", "format", "structured", "ts_format", "colorize",
+                "buffer_size", "flush_interval")
+
+
+class _Output:
+    """One configured sink: a stream plus the settings it overrides (``None`` inherits)."""
+
+    def __init__(self, stream, owned=False, level=None, format=None,
+                 structured=None, ts_format=None, colorize=None):
+        self.stream = stream
+        self.owned = owned  # opened from a path by configure, so closed by it
+        self.level = level
+        self.format = format
+        self.structured = structured
+        self.ts_format = ts_format
+        self.colorize = colorize
+
+    def resolve(self):
+        """``(formatter key, level int, colorize)`` under the current defaults."""
+        level = _level if self.level is None else self.level
+        colorize = _isatty(self.stream) if self.colorize is None else self.colorize
+        if _structured if self.structured is None else self.structured:
+            return ("json", self.ts_format or _ts_format), level, colorize
+        return ("text", self.format or _format, colorize), level, colorize
+
+
+# Formatter key -> fn(t, level, msg, extra) -> line; compiled on first use
+_formatters = {}
+
+
+def _formatter(key):
+    fn = _formatters.get(key)
+    if fn is None:
+        if key[0] == "json":
+            fn = _json_line if key[1] == "iso" else functools.partial(_json_line, ts=_ns_ts)
+        else:
+            fn = _compile_format(key[1], key[2])
+        _formatters[key] = fn
+    return fn
+
+
+def _build_routes(outputs):
+    """Dispatch table for ``outputs``: level int -> ``((formatter, streams), ...)``.
+
+    Sinks sharing a format share a formatter, so a record is rendered once
+    per distinct format no matter how many sinks receive it. Keys are every
+    level a record can carry plus each sink's threshold; see :func:`_route`.
+    """
+    groups = {}
+    for out in outputs:
+        key, level, _ = out.resolve()
+        groups.setdefault(key, []).append((level, out.stream))
+    levels = set(LEVELS.values()) | {0} | {lvl for members in groups.values() for lvl, _ in members}
+    return {
+        lvl: tuple(
+            (_formatter(key), streams)
+            for key, members in groups.items()
+            for streams in [tuple(s for threshold, s in members if threshold <= lvl)]
+            if streams
+        )
+        for lvl in levels
+    }
+
+
+_outputs = (_Output(sys.stderr),)
+_routes = _build_routes(_outputs)
+
+
+def _route(routes, lvl_int):
+    """Routes for ``lvl_int``, which may fall between the table's keys."""
+    route = routes.get(lvl_int)
+    if route is None:
+        below = [k for k in routes if k <= lvl_int]
+        route = routes[max(below)] if below else ()
+    return route
+
+
+def _render(routes, records):
+    """``[(stream, text, flush)]`` for a batch, each line formatted once per format."""
+    out = {}
+    for t, level, lvl_int, msg, extra in records:
+        for fmt, streams in _route(routes, lvl_int):
+            line = fmt(t, level, msg, extra) + "\n"
+            for stream in streams:
+                entry = out.get(id(stream))
+                if entry is None:
+                    out[id(stream)] = [stream, [line], lvl_int >= FLUSH_LEVEL]
+                else:
+                    entry[1].append(line)
+                    entry[2] = entry[2] or lvl_int >= FLUSH_LEVEL
+    return [(stream, "".join(lines), flush) for stream, lines, flush in out.values()]
+
+
+def _write_records(records):
+    """Format a batch of records and write each sink's share in one call."""
+    routes = _routes
+    chunks = _render(routes, records)
+    with _lock:
+        if routes is not _routes:  # reconfigured while formatting
+            chunks = _render(_routes, records)
+        for stream, text, flush in chunks:
+            stream.write(text)
+            if flush:
+                _flush_stream(stream)
+
+
+def _flush_stream(stream):
+    """Flush ``stream``, ignoring streams that can't be flushed. Call under _lock."""
+    try:
+        stream.flush()
+    except (AttributeError, ValueError):
+        pass
+
+
+def _level_int(level):
+    """Numeric value of a level name (any case) or int."""
+    if isinstance(level, int):
+        return level
+    lvl = LEVELS.get(level)
+    if lvl is None:
+        lvl = LEVELS.get(level.upper(), 0)
+    return lvl
+
+
+def is_enabled_for(level):
+    """Whether a message at ``level`` would currently be written.
+
+    Checks both the configured minimum level and the thread's quiet state,
+    so callers can skip building expensive messages::
+
+        if logmap.is_enabled_for("DEBUG"):
+            lm.debug(summarize(big_thing))
+    """
+    return not _nesting.is_quiet and _level_int(level) >= _min_level
+
+
+def _render_msg(msg, args):
+    """Resolve a deferred message: call it if callable, then %-format.
+
+    Like stdlib logging, a message that doesn't match its args never makes
+    the log call raise; it is written as is, followed by the args' repr.
+    """
+    if callable(msg):
+        msg = msg()
+    if args:
+        try:
+            msg = str(msg) % args
+        except (TypeError, ValueError):
+            msg = f"{msg} {args!r}"
+    return msg
+
+
+class _CallSite:
+    """Counters behind ``every=`` / ``max_per_second=`` for one ``lm.log`` call site."""
+
+    __slots__ = ("calls", "tokens", "stamp", "lock")
+
+    def __init__(self):
+        self.calls = count()
+        self.tokens = None
+        self.stamp = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self, every, max_per_second, sample):
+        if every and next(self.calls) % every:
+            return False
+        if sample is not None and random.random() >= sample:
+            return False
+        if max_per_second is not None:
+            # Token bucket: refills at max_per_second, holds at least one.
+            with self.lock:
+                now = time.monotonic()
+                cap = max(1.0, max_per_second)
+                tokens = cap if self.tokens is None else min(
+                    cap, self.tokens + (now - self.stamp) * max_per_second)
+                self.stamp = now
+                if tokens < 1.0:
+                    self.tokens = tokens
+                    return False
+                self.tokens = tokens - 1.0
+        return True
+
+
+# (code, line) of the calling source line -> _CallSite
+_call_sites = {}
+
+
+def _site_allows(every, max_per_second, sample):
+    """Apply per-call-site limits for the ``lm.log`` caller two frames up."""
+    frame = sys._getframe(2)
+    if frame.f_code in _LEVEL_HELPERS:
+        frame = frame.f_back
+    key = (frame.f_code, frame.f_lineno)
+    site = _call_sites.get(key)
+    if site is None:
+        site = _call_sites.setdefault(key, _CallSite())
+    return site.allow(every, max_per_second, sample)
+
+
+# configure(dedup=True): collapse consecutive identical lm.log calls
+_dedup = False
+_dedup_lock = threading.Lock()
+_dedup_key = None
+_repeats = None  # [count, prefix, level, depth, task] for _dedup_key
+
+
+def _is_repeat(key, prefix, level, depth, task):
+    """Whether ``key`` repeats the previous call; if not, report the previous run."""
+    global _dedup_key, _repeats
+    with _dedup_lock:
+        try:
+            same = key == _dedup_key
+        except Exception:  # e.g. arrays without a truth value
+            same = False
+        if same:
+            _repeats[0] += 1
+            return True
+        pending, _repeats = _repeats, [0, prefix, level, depth, task]
+        _dedup_key = key
+    _emit_repeats(pending)
+    return False
+
+
+def _flush_repeats():
+    global _dedup_key, _repeats
+    with _dedup_lock:
+        pending, _repeats, _dedup_key = _repeats, None, None
+    _emit_repeats(pending)
+
+
+def _emit_repeats(pending):
+    if pending and pending[0]:
+        n, prefix, level, depth, task = pending
+        msg = f"last message repeated {n} time{'s' if n != 1 else ''}"
+        _emit(f"{prefix}{msg}", level=level, extra={"depth": depth, "task": task, "msg": msg})
+
+
+def _emit(msg, level="DEBUG", extra=None):
+    """Write one formatted log line to the current sink."""
+    level = level.upper()
+    lvl_int = LEVELS.get(level, 0)
+    if lvl_int < _min_level:
+        return
+    record = (time.time(), level, lvl_int, msg, extra)
+    forwarder = _forwarder
+    if forwarder is not None:
+        # In a map worker: the parent writes it.
+        forwarder.put(record)
+        return
+    _dispatch(record)
+
+
+def _dispatch(record):
+    """Hand a record to the stdlib logger, the async writer, or the sinks."""
+    if _logger is not None:
+        _, _, lvl_int, msg, extra = record
+        clean = extra.get("msg", msg) if extra else msg
+        _logger.log(lvl_int, clean)
+        return
+    writer = _writer
+    if writer is not None:
+        writer.put(record)
+        return
+    t, level, lvl_int, msg, extra = record
+    routes = _routes
+    lines = [(fmt(t, level, msg, extra) + "\n", streams) for fmt, streams in _route(routes, lvl_int)]
+    with _lock:
+        if routes is not _routes:  # reconfigured while formatting
+            lines = [(fmt(t, level, msg, extra) + "\n", streams)
+                     for fmt, streams in _route(_routes, lvl_int)]
+        for line, streams in lines:
+            for stream in streams:
+                stream.write(line)
+                if lvl_int >= FLUSH_LEVEL:
+                    _flush_stream(stream)
+
+
+# ---------------------------------------------------------------------------
+# File sink
+# ---------------------------------------------------------------------------
+
+# Records at or above this level are flushed to the sink as soon as written
+FLUSH_LEVEL = LEVELS["ERROR"]
+
+# Longest a line may sit in a buffered file sink before being written out
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+_APPEND_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+
+
+def _open_append(path):
+    return os.open(path, _APPEND_FLAGS, 0o666)
+
+
+class _FileSink:
+    """Log file opened by path, appended to with as few writes as possible.
+
+    With ``buffer_size=0`` each write goes straight to the file, like the
+    line-buffered handle this replaces. Otherwise text accumulates until
+    ``buffer_size`` characters are pending, or until a daemon thread
+    flushes it after at most ``flush_interval`` seconds, so a quiet run
+    still reaches disk.
+
+    The file is opened ``O_APPEND`` and each record, or batch of records,
+    goes out in a single ``os.write`` with no buffering in between, so any
+    number of processes (forked map workers included) can share the file
+    without tearing or interleaving lines.
+    """
+
+    def __init__(self, path, buffer_size=0, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = os.fspath(path)
+        self.buffer_size = max(0, int(buffer_size))
+        self.flush_interval = flush_interval
+        self._fd = _open_append(self.path)
+        self._lock = threading.Lock()
+        self._parts = []
+        self._size = 0
+        self._thread = None
+        self._closed = threading.Event()
+        _file_sinks.add(self)
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        return self._fd
+
+    def write(self, text):
+        with self._lock:
+            if self._fd is None:
+                raise ValueError(f"log file {self.path} is closed")
+            if not self.buffer_size:
+                self._write(text.encode("utf-8"))
+                return
+            self._parts.append(text)
+            self._size += len(text)
+            if not _exit_flush_armed:
+                _arm_exit_flush()
+            if self._size >= self.buffer_size:
+                self._drain()
+            elif self._thread is None and self.flush_interval:
+                self._thread = threading.Thread(
+                    target=self._run, name="logmap-flush", daemon=True
+                )
+                self._thread.start()
+
+    def _drain(self):
+        # Under self._lock.
+        if self._parts:
+            data = "".join(self._parts).encode("utf-8")
+            self._parts.clear()
+            self._size = 0
+            self._write(data)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._fd is not None:
+                self._drain()
+
+    def close(self):
+        with self._lock:
+            self._closed.set()
+            if self._fd is not None:
+                try:
+                    self._drain()
+                finally:
+                    os.close(self._fd)
+                    self._fd = None
+        _file_sinks.discard(self)
+
+    def _after_fork(self):
+        # The flush thread and any lock holder stayed in the parent, which
+        # also owns whatever text is still pending. The descriptor is shared
+        # on purpose: O_APPEND keeps every process's writes whole.
+        self._lock = threading.Lock()
+        self._parts = []
+        self._size = 0
+        self._thread = None
+
+
+# RotatingSink(when=...) periods, in seconds
+ROTATE_WHEN = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+class RotatingSink(_FileSink):
+    """Log file that rolls over by size and/or time, keeping ``backups`` old segments.
+
+    Pass it as the sink: ``configure(sink=RotatingSink("app.log",
+    max_bytes=100_000_000, when="h", backups=24))``. A rollover renames the
+    file to ``app.log.YYYYmmdd-HHMMSS`` (the time of the rollover) and opens
+    a fresh ``app.log``, all under the lock writes take, so no line is lost
+    or split between segments. Gzipping the old segment and deleting
+    segments beyond ``backups`` happen on a background thread.
+
+    Rollover is tracked per process: a forked child that keeps writing
+    goes on appending to whichever file it inherited. Map workers send
+    their records to the parent, so only the parent writes the file.
+
+    Args:
+        path: the live log file; appended to if it exists.
+        max_bytes: roll over before a write would take the file past this
+            size; ``0`` (default) disables size-based rollover.
+        when: roll over at the start of every second, minute, hour or day
+            (``"s"``, ``"m"``, ``"h"``, ``"d"``) of local time; ``None``
+            disables time-based rollover.
+        backups: old segments to keep; ``0`` keeps them all.
+        compress: gzip old segments (to ``app.log.<stamp>.gz``).
+        buffer_size, flush_interval: as for :func:`configure`.
+    """
+
+    def __init__(self, path, max_bytes=0, when=None, backups=5, compress=True,
+                 buffer_size=0, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        if when is not None and when.lower() not in ROTATE_WHEN:
+            raise ValueError(f"when must be one of {tuple(ROTATE_WHEN)}, got {when!r}")
+        super().__init__(path, buffer_size=buffer_size, flush_interval=flush_interval)
+        self.max_bytes = max(0, int(max_bytes))
+        self.interval = ROTATE_WHEN[when.lower()] if when is not None else None
+        self.backups = max(0, int(backups))
+        self.compress = compress
+        st = os.fstat(self._fd)
+        self._bytes = st.st_size
+        self._rollover_at = (
+            self._next_rollover(st.st_mtime if st.st_size else time.time())
+            if self.interval else None
+        )
+        self._jobs = deque()
+        self._jobs_lock = threading.Lock()
+        self._worker = None
+        self._last_stamp = (None, 0)
+
+    def _next_rollover(self, t):
+        local = t + time.localtime(t).tm_gmtoff
+        return t + self.interval - local % self.interval
+
+    def _write(self, data):
+        # Under self._lock.
+        if self._rollover_at is not None and time.time() >= self._rollover_at:
+            self._rollover_at = self._next_rollover(time.time())
+            if self._bytes:
+                self._rotate()
+        elif self.max_bytes and self._bytes and self._bytes + len(data) > self.max_bytes:
+            self._rotate()
+        super()._write(data)
+        self._bytes += len(data)
+
+    def _rotate(self):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        # Count up within a second even once earlier segments were pruned,
+        # so names keep sorting in rollover order.
+        n = self._last_stamp[1] + 1 if stamp == self._last_stamp[0] else 0
+        target = f"{self.path}.{stamp}.{n}" if n else f"{self.path}.{stamp}"
+        while os.path.exists(target) or os.path.exists(target + ".gz"):
+            n += 1
+            target = f"{self.path}.{stamp}.{n}"
+        self._last_stamp = (stamp, n)
+        os.close(self._fd)
+        os.replace(self.path, target)
+        self._fd = _open_append(self.path)
+        self._bytes = 0
+        with self._jobs_lock:
+            self._jobs.append(target)
+            if self._worker is None:
+                # Not a daemon: exit waits for a compression in progress.
+                self._worker = threading.Thread(target=self._process, name="logmap-rotate")
+                self._worker.start()
+
+    def _process(self):
+        while True:
+            with self._jobs_lock:
+                if not self._jobs:
+                    self._worker = None
+                    return
+                segment = self._jobs.popleft()
+            try:
+                if self.compress:
+                    with open(segment, "rb") as src, gzip.open(segment + ".gz.tmp", "wb", compresslevel=6) as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+                    os.replace(segment + ".gz.tmp", segment + ".gz")
+                    os.remove(segment)
+                self._prune()
+            except OSError:
+                pass
+
+    def segments(self):
+        """Rotated segment paths, oldest first."""
+        base = os.path.basename(self.path) + "."
+        folder = os.path.dirname(os.path.abspath(self.path))
+        found = []
+        for name in os.listdir(folder):
+            if not name.startswith(base) or name.endswith(".tmp"):
+                continue
+            stamp, _, n = name[len(base):].removesuffix(".gz").partition(".")
+            if len(stamp) == 15 and stamp[8] == "-" and (not n or n.isdigit()):
+                found.append(((stamp, int(n or 0)), os.path.join(folder, name)))
+        return [path for _, path in sorted(found)]
+
+    def _prune(self):
+        if self.backups:
+            for old in self.segments()[:-self.backups]:
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+
+    def wait(self):
+        """Block until queued compression and pruning are done."""
+        worker = self._worker
+        while worker is not None:
+            worker.join()
+            worker = self._worker
+
+    def close(self):
+        super().close()
+        self.wait()
+
+    def _after_fork(self):
+        super()._after_fork()
+        self._jobs_lock = threading.Lock()
+        self._jobs = deque()
+        self._worker = None
+
+
+# Open file sinks, flushed before fork and at exit
+_file_sinks = set()
+
+
+def _flush_file_sinks():
+    for sink in list(_file_sinks):
+        try:
+            sink.flush()
+        except Exception:
+            pass
+
+
+def _arm_exit_flush():
+    # multiprocessing's fork launcher clears atexit in the child and later
+    # runs whatever the child registered, so each process registers the
+    # exit flush again from its first buffered write.
+    global _exit_flush_armed
+    _exit_flush_armed = True
+    atexit.register(_flush_file_sinks)
+
+
+# Registered before the writer's hook, so it runs after the queue is drained.
+_arm_exit_flush()
+
+
+# ---------------------------------------------------------------------------
+# Asynchronous writer
+# ---------------------------------------------------------------------------
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+DEFAULT_QUEUE_SIZE = 10000
+
+
+class _AsyncWriter:
+    """Single background thread draining a bounded record queue in batches.
+
+    Callers only pay for a deque append; formatting and the sink write
+    happen on the writer thread. When the queue is full, ``overflow``
+    decides whether the caller blocks or a record is dropped (and counted).
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, overflow="block"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"overflow must be one of {OVERFLOW_POLICIES}, got {overflow!r}"
+            )
+        self.maxsize = max(1, int(maxsize))
+        self.overflow = overflow
+        self.dropped = 0
+        self._buf = deque()
+        self._busy = False
+        self._closed = False
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._idle = threading.Condition(self._mutex)
+        self._thread = threading.Thread(
+            target=self._run, name="logmap-writer", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, record):
+        with self._mutex:
+            if self._closed:
+                closed = True
+            else:
+                closed = False
+                self._enqueue(record)
+        if closed:
+            # Raced with close(): nobody will drain the queue any more.
+            _write_records([record])
+
+    def _enqueue(self, record):
+        if len(self._buf) >= self.maxsize:
+            if self.overflow == "drop_newest":
+                self.dropped += 1
+                return
+            if self.overflow == "drop_oldest":
+                self._buf.popleft()
+                self.dropped += 1
+            else:
+                while len(self._buf) >= self.maxsize and not self._closed:
+                    self._not_full.wait()
+        self._buf.append(record)
+        self._not_empty.notify()
+
+    def flush(self):
+        """Block until every queued record has been written."""
+        with self._mutex:
+            while (self._buf or self._busy) and self._thread.is_alive():
+                self._idle.wait(0.1)
+
+    def close(self):
+        """Drain the queue and stop the writer thread."""
+        with self._mutex:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._mutex:
+                while not self._buf and not self._closed:
+                    self._not_empty.wait()
+                if not self._buf:
+                    self._idle.notify_all()
+                    return
+                batch = list(self._buf)
+                self._buf.clear()
+                self._busy = True
+                self._not_full.notify_all()
+            try:
+                _write_records(batch)
+            except Exception:
+                pass
+            finally:
+                with self._mutex:
+                    self._busy = False
+                    self._idle.notify_all()
+
+
+_writer = None
+
+
+def _stop_writer():
+    """Drain and stop the async writer, if one is running."""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+atexit.register(_stop_writer)
+# Registered after the writer's hook, so it runs before the queue is drained.
+atexit.register(_flush_repeats)
+
+
+# ---------------------------------------------------------------------------
+# Chrome trace output
+# ---------------------------------------------------------------------------
+
+# Longest a trace event may sit in the file buffer before being written out
+TRACE_FLUSH_SECONDS = 1.0
+
+
+class _TraceWriter:
+    """Stream Chrome trace events (Perfetto, chrome://tracing) to ``path``.
+
+    Events are appended one at a time to a JSON array that stays open
+    until :meth:`close`; trace viewers accept the unterminated form, so a
+    run that dies still leaves a loadable file and nothing accumulates in
+    memory. Timestamps are wall-clock microseconds, comparable across the
+    parent and its worker processes.
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self.pid = os.getpid()
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._first = True
+        self._named = set()
+        self._last_flush = time.monotonic()
+        self._write([{"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0,
+                      "args": {"name": "logmap"}}])
+
+    def _write(self, events):
+        with self._lock:
+            if self._file is None:
+                return
+            parts = []
+            for event in events:
+                parts.append("[\n" if self._first else ",\n")
+                parts.append(json.dumps(event, separators=(",", ":"), default=str))
+                self._first = False
+            self._file.write("".join(parts))
+            now = time.monotonic()
+            if now - self._last_flush >= TRACE_FLUSH_SECONDS:
+                self._file.flush()
+                self._last_flush = now
+
+    def _lane(self):
+        """``(tid, metadata)`` for the current thread, or asyncio task.
+
+        Tasks sharing a thread interleave their spans, so each task gets a
+        lane of its own to keep begin/end pairs nested.
+        """
+        tid = threading.get_native_id()
+        loop = asyncio._get_running_loop()
+        task = asyncio.current_task(loop) if loop is not None else None
+        if task is None:
+            return tid, None
+        lane = id(task)
+        if lane in self._named:
+            return lane, None
+        if len(self._named) > 10000:
+            self._named.clear()
+        self._named.add(lane)
+        return lane, {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": lane,
+                      "args": {"name": f"task {task.get_name()}"}}
+
+    def begin(self, name, level):
+        tid, meta = self._lane()
+        event = {"name": name, "cat": "span", "ph": "B", "ts": time.time() * 1e6,
+                 "pid": self.pid, "tid": tid, "args": {"level": level}}
+        self._write([meta, event] if meta else [event])
+        return tid
+
+    def end(self, tid, error=None):
+        event = {"ph": "E", "ts": time.time() * 1e6, "pid": self.pid, "tid": tid}
+        if error is not None:
+            event["args"] = {"error": error}
+        self._write([event])
+
+    def items(self, name, start, meta, positions=None):
+        """Complete events for the items of one map chunk, on the worker's lane."""
+        pid, tid, stamps, step = meta["pid"], meta["tid"], meta["stamps"], meta["step"]
+        events = []
+        if (pid, tid) not in self._named:
+            self._named.add((pid, tid))
+            label = f"logmap worker {pid}" if pid != self.pid else "logmap worker"
+            if pid != self.pid:
+                events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                               "args": {"name": label}})
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                           "args": {"name": label}})
+        for k in range(len(stamps) - 1):
+            lo = k * step
+            hi = min(lo + step, meta["n"])
+            idx = [start + (positions[j] if positions is not None else j)
+                   for j in range(lo, hi)]
+            events.append({
+                "name": name, "cat": "item", "ph": "X",
+                "ts": stamps[k] * 1e6, "dur": (stamps[k + 1] - stamps[k]) * 1e6,
+                "pid": pid, "tid": tid,
+                "args": {"index": idx[0]} if step == 1 else {"items": idx},
+            })
+        self._write(events)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.write("\n]\n" if not self._first else "[]\n")
+                self._file.close()
+                self._file = None
+
+
+_trace = None
+
+
+def _stop_trace():
+    global _trace
+    trace, _trace = _trace, None
+    if trace is not None:
+        trace.close()
+
+
+atexit.register(_stop_trace)
+
+
+def flush():
+    """Write out anything queued by the async writer and flush the sinks."""
+    _flush_repeats()
+    writer = _writer
+    if writer is not None:
+        writer.flush()
+    with _lock:
+        for out in _outputs:
+            _flush_stream(out.stream)
+    trace = _trace
+    if trace is not None:
+        trace.flush()
+
+
+def _parse_level(level):
+    return LEVELS[level.upper()] if isinstance(level, str) else int(level)
+
+
+def _sink_specs(sink, sinks, buffer_size, flush_interval):
+    """Normalize ``sink``/``sinks`` to validated option dicts, or ``None`` to keep the current sinks."""
+    if sink is not None and sinks is not None:
+        raise ValueError("pass either sink or sinks, not both")
+    if (buffer_size is not None or flush_interval is not None) and not isinstance(sink, str):
+        raise ValueError("buffer_size and flush_interval need a file path sink")
+    if sink is not None:
+        return [{"sink": sink, "buffer_size": buffer_size, "flush_interval": flush_interval}]
+    if sinks is None:
+        return None
+    specs = []
+    for entry in sinks:
+        spec = dict(entry) if isinstance(entry, dict) else {"sink": entry}
+        unknown = set(spec) - set(SINK_OPTIONS)
+        if unknown:
+            raise ValueError(f"unknown sink options {sorted(unknown)}; expected some of {SINK_OPTIONS}")
+        if spec.get("sink") is None:
+            raise ValueError(f"sink entry {entry!r} has no 'sink'")
+        if ((spec.get("buffer_size") is not None or spec.get("flush_interval") is not None)
+                and not isinstance(spec["sink"], str)):
+            raise ValueError("buffer_size and flush_interval need a file path sink")
+        if spec.get("level") is not None:
+            spec["level"] = _parse_level(spec["level"])
+        if spec.get("format") is not None:
+            _compile_format(spec["format"], False)
+        ts_format = spec.get("ts_format")
+        if ts_format is not None and ts_format not in TS_FORMATS:
+            raise ValueError(f"ts_format must be one of {TS_FORMATS}, got {ts_format!r}")
+        specs.append(spec)
+    return specs
+
+
+def _open_output(spec):
+    stream = spec["sink"]
+    owned = isinstance(stream, str)
+    if owned:
+        flush_interval = spec.get("flush_interval")
+        stream = _FileSink(
+            stream,
+            buffer_size=spec.get("buffer_size") or 0,
+            flush_interval=DEFAULT_FLUSH_INTERVAL if flush_interval is None else flush_interval,
+        )
+    return _Output(stream, owned=owned, level=spec.get("level"), format=spec.get("format"),
+                   structured=spec.get("structured"), ts_format=spec.get("ts_format"),
+                   colorize=spec.get("colorize"))
+
+
+def configure(
+    sink=None,
+    level=None,
+    format=None,
+    logger=_UNSET,
+    structured=None,
+    ts_format=None,
+    async_=None,
+    queue_size=None,
+    overflow=None,
+    trace=_UNSET,
+    buffer_size=None,
+    flush_interval=None,
+    sinks=None,
+    dedup=None,
+    progress_style=None,
+    progress_refresh=None,
+    progress_interval=None,
+):
+    """Reconfigure where logmap writes output.
+
+    Omitted args keep their current value.
+
+    Args:
+        sink: writable stream (``sys.stdout``, ``StringIO``, open file) or
+            file path string (``"run.log"``); replaces all current sinks.
+        level: level name (``"INFO"``) or int (``20``); messages below the
+            threshold are suppressed. Sinks without a level of their own
+            use this one.
+        format: format string with ``{color}``, ``{msg}``, ``{reset}``,
+            ``{cyan}``, ``{time}`` placeholders. See :data:`DEFAULT_FORMAT`.
+            Compiled once here; an unknown placeholder raises ``ValueError``.
+        logger: a :class:`logging.Logger`; when set, output is forwarded via
+            ``logger.log()`` instead of writing to the sink directly.
+            Pass ``None`` to clear.
+        structured: if ``True``, emit JSON-lines output instead of
+            human-readable text.  Each line is a JSON object with ``ts``,
+            ``level``, ``msg``, ``depth``, and ``task`` keys.
+        ts_format: how structured output writes ``ts`` — ``"iso"`` (default)
+            for a local ISO-8601 string, ``"ns"`` for integer nanoseconds
+            since the epoch.
+        async_: if ``True``, hand records to a background writer thread
+            through a bounded queue instead of writing them inline; ``False``
+            drains the queue and returns to synchronous writes.
+        queue_size: capacity of the async queue (default
+            :data:`DEFAULT_QUEUE_SIZE`).
+        overflow: what to do when the async queue is full — ``"block"``
+            (default) waits for space, ``"drop_oldest"`` / ``"drop_newest"``
+            discard a record and bump :attr:`logmap.dropped`.
+        trace: path of a Chrome trace-event file to stream span begin/end
+            events and parallel-map item timings to; ``None`` closes it.
+        buffer_size: with a file path ``sink``, hold up to this many
+            characters of output before writing them in one go. The
+            default ``0`` writes every record as it comes. ``ERROR`` and
+            ``CRITICAL`` records, :func:`flush` and interpreter exit always
+            write out the buffer.
+        flush_interval: with a file path ``sink``, the longest buffered
+            output may wait before a background thread writes it (default
+            :data:`DEFAULT_FLUSH_INTERVAL` seconds; ``0`` disables the timer).
+        sinks: list of sinks to write to at once, replacing the current
+            ones. Each entry is a stream, a path, or a dict with a
+            ``"sink"`` and any of ``level``, ``format``, ``structured``,
+            ``ts_format``, ``colorize`` (default: whether the stream is a
+            TTY), ``buffer_size`` and ``flush_interval`` for that sink
+            alone (see :data:`SINK_OPTIONS`); unset options follow the
+            arguments above.
+        dedup: if ``True``, collapse consecutive identical ``lm.log`` calls
+            (same level, depth, message and args) into one line followed by
+            ``"last message repeated N times"``.
+        progress_style: ``"bar"`` for tqdm progress bars, ``"log"`` for a
+            ``n/total, rate, ETA`` line every ``progress_interval`` seconds
+            at the loop's depth, or ``"auto"`` (default): bars only when the
+            first sink is a TTY.
+        progress_refresh: least time between bar redraws caused by
+            ``lm.log`` updating the description (default
+            :data:`PROGRESS_REFRESH_SECONDS`).
+        progress_interval: seconds between logged progress lines (default
+            :data:`PROGRESS_INTERVAL_SECONDS`).
+
+    Any queued records are flushed before the new settings take effect.
+    """
+    global _sink, _level, _min_level, _format, _colorize, _logger, _structured, _ts_format
+    global _writer, _trace, _outputs, _routes, _dedup
+    global _progress_style, _progress_refresh, _progress_interval
+    if overflow is not None and overflow not in OVERFLOW_POLICIES:
+        raise ValueError(
+            f"overflow must be one of {OVERFLOW_POLICIES}, got {overflow!r}"
+        )
+    if ts_format is not None and ts_format not in TS_FORMATS:
+        raise ValueError(f"ts_format must be one of {TS_FORMATS}, got {ts_format!r}")
+    if progress_style is not None and progress_style not in PROGRESS_STYLES:
+        raise ValueError(
+            f"progress_style must be one of {PROGRESS_STYLES}, got {progress_style!r}"
+        )
+    specs = _sink_specs(sink, sinks, buffer_size, flush_interval)
+    if level is not None:
+        level = _parse_level(level)
+    if format is not None:
+        _compile_format(format, False)
+    # Drain with the old settings; the writer thread needs _lock to write.
+    flush()
+    writer = _writer
+    if writer is not None and (
+        async_ is False
+        or (queue_size is not None and queue_size != writer.maxsize)
+        or (overflow is not None and overflow != writer.overflow)
+    ):
+        _stop_writer()
+        if async_ is None:
+            async_ = True
+    if async_ and _writer is None:
+        _writer = _AsyncWriter(
+            maxsize=queue_size or (writer.maxsize if writer else DEFAULT_QUEUE_SIZE),
+            overflow=overflow or (writer.overflow if writer else "block"),
+        )
+    with _lock:
+        if specs is not None:
+            outputs = []
+            try:
+                for spec in specs:
+                    outputs.append(_open_output(spec))
+            except BaseException:
+                for out in outputs:
+                    if out.owned:
+                        out.stream.close()
+                raise
+            for out in _outputs:
+                if out.owned:
+                    try:
+                        out.stream.close()
+                    except Exception:
+                        pass
+            _outputs = tuple(outputs)
+        if level is not None:
+            _level = level
+        if format is not None:
+            _format = format
+        if logger is not _UNSET:
+            _logger = logger
+        if structured is not None:
+            _structured = bool(structured)
+        if ts_format is not None:
+            _ts_format = ts_format
+        if dedup is not None:
+            _dedup = bool(dedup)
+        if progress_style is not None:
+            _progress_style = progress_style
+        if progress_refresh is not None:
+            _progress_refresh = progress_refresh
+        if progress_interval is not None:
+            _progress_interval = progress_interval
+        _routes = _build_routes(_outputs)
+        resolved = [out.resolve() for out in _outputs]
+        if _logger is not None or not resolved:
+            _min_level = _level if _logger is not None else LEVELS["CRITICAL"] + 1
+        else:
+            _min_level = min(lvl for _, lvl, _ in resolved)
+        _sink = _outputs[0].stream if _outputs else sys.stderr
+        _colorize = resolved[0][2] if resolved else False
+    if trace is not _UNSET:
+        _stop_trace()
+        if trace is not None:
+            _trace = _TraceWriter(trace)
+
+
+# ---------------------------------------------------------------------------
+# Shared-memory transport
+# ---------------------------------------------------------------------------
+
+# Default size at which shm=True moves a buffer into shared memory
+SHM_MIN_BYTES = 1024 * 1024
+
+# Worker-created result segments must outlive the worker's handle until the
+# parent attaches; only POSIX keeps a closed, unlinked-later segment around.
+_SHM_RESULTS = os.name == "posix"
+
+_BYTES_TYPES = (bytes, bytearray, memoryview)
+
+_shm_local = threading.local()
+# Handles whose close() failed because a view was still alive; retried later
+_lingering_shm = []
+
+
+def _drop_shm(shm, unlink=False):
+    try:
+        shm.close()
+    except BufferError:
+        _lingering_shm.append(shm)
+    if unlink:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _retry_lingering_shm():
+    pending = list(_lingering_shm)
+    del _lingering_shm[:]
+    for shm in pending:
+        _drop_shm(shm)
+
+
+class _ShmPickler(pickle.Pickler):
+    """Protocol-5 pickler that moves large buffers into shared memory.
+
+    Out-of-band buffers (NumPy arrays and anything else exposing
+    ``PickleBuffer``) and ``bytes``/``bytearray``/``memoryview`` objects of at
+    least ``threshold`` bytes are copied into new segments, which are
+    appended to ``segments``. Everything else is pickled as usual.
+    """
+
+    def __init__(self, file, threshold, segments, copy=False):
+        super().__init__(file, protocol=5, buffer_callback=self._buffer_callback)
+        self.threshold = threshold
+        self.segments = segments
+        self.copy = copy
+        self.oob = []
+
+    def _new_segment(self, mv):
+        if not mv.c_contiguous:
+            mv = memoryview(mv.tobytes())
+        mv = mv.cast("B")
+        shm = shared_memory.SharedMemory(create=True, size=max(1, mv.nbytes))
+        self.segments.append(shm)
+        shm.buf[:mv.nbytes] = mv
+        return shm.name, mv.nbytes
+
+    def _buffer_callback(self, buf):
+        raw = buf.raw()
+        if raw.nbytes < self.threshold:
+            return True
+        self.oob.append(self._new_segment(raw))
+        return False
+
+    def reducer_override(self, obj):
+        cls = type(obj)
+        if cls is _BytesRef:
+            obj = obj.obj
+            cls = type(obj)
+        elif cls not in _BYTES_TYPES:
+            return NotImplemented
+        mv = memoryview(obj)
+        if mv.nbytes < self.threshold:
+            # memoryview isn't picklable on its own; ship small ones as bytes
+            return (memoryview, (mv.tobytes(),)) if cls is memoryview else NotImplemented
+        name, nbytes = self._new_segment(mv)
+        return _shm_rebuild, (name, nbytes, cls.__name__, self.copy)
+
+
+class _BytesRef:
+    """Marks a large ``bytes`` for :class:`_ShmPickler`.
+
+    Pickle never calls ``reducer_override`` for exact ``bytes``, so large
+    ones are wrapped in this before dumping.
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+
+def _mark_bytes(obj, threshold, depth=3):
+    """Wrap large ``bytes`` inside plain lists, tuples and dicts."""
+    cls = type(obj)
+    if cls is bytes:
+        return _BytesRef(obj) if len(obj) >= threshold else obj
+    if depth <= 0:
+        return obj
+    if cls is list or cls is tuple:
+        return cls(_mark_bytes(x, threshold, depth - 1) for x in obj)
+    if cls is dict:
+        return {k: _mark_bytes(v, threshold, depth - 1) for k, v in obj.items()}
+    return obj
+
+
+def _shm_dumps(obj, threshold, segments, copy=False):
+    """Pickle ``obj``, parking large buffers in shared memory.
+
+    Returns ``(data, oob)``: the pickle and the ``(name, nbytes)`` of each
+    out-of-band segment. With ``copy=True`` the receiver copies bytes-like
+    objects out and unlinks their segments instead of viewing them.
+    """
+    buf = io.BytesIO()
+    pickler = _ShmPickler(buf, threshold, segments, copy=copy)
+    pickler.dump(_mark_bytes(obj, threshold))
+    return buf.getvalue(), pickler.oob
+
+
+def _shm_rebuild(name, nbytes, kind, copy):
+    shm = shared_memory.SharedMemory(name=name)
+    if copy:
+        data = bytes(shm.buf[:nbytes])
+        _drop_shm(shm, unlink=True)
+        if kind == "bytearray":
+            return bytearray(data)
+        return memoryview(data) if kind == "memoryview" else data
+    _shm_local.handles.append(shm)
+    view = shm.buf[:nbytes]
+    return view.toreadonly() if kind == "bytes" else view
+
+
+def _shm_loads(data, oob, copy=False):
+    """Inverse of :func:`_shm_dumps`; returns ``(obj, handles)``.
+
+    Without ``copy``, large buffers come back as views on the attached
+    segments, which stay valid until ``handles`` are closed. With ``copy``
+    every segment is copied out and unlinked right away.
+    """
+    handles = []
+    _shm_local.handles = handles
+    try:
+        buffers = []
+        for name, nbytes in oob:
+            shm = shared_memory.SharedMemory(name=name)
+            if copy:
+                buffers.append(bytearray(shm.buf[:nbytes]))
+                _drop_shm(shm, unlink=True)
+            else:
+                handles.append(shm)
+                buffers.append(shm.buf[:nbytes])
+        obj = pickle.loads(data, buffers=buffers)
+    finally:
+        _shm_local.handles = None
+    return obj, handles
+
+
+# ---------------------------------------------------------------------------
+# Map tasks
+# ---------------------------------------------------------------------------
+
+# Calls pickled smaller than this travel inline with each task; larger ones
+# are written to a temp file once and loaded by each worker on first use.
+BROADCAST_MIN_BYTES = 64 * 1024
+
+_job_ids = count(1)
+_NO_RESULTS = pickle.dumps([])
+# Numbers of the jobs whose maps are still running in this process
+_live_jobs = set()
+
+# Worker-side cache: job token -> ((func, args, kwargs, opts), shm handles)
+_worker_calls = {}
+
+
+@contextmanager
+def _broadcast(func, args, kwargs, opts):
+    """Pickle ``(func, args, kwargs, opts)`` once; yield ``(token, blob, from_main, flag)``.
+
+    ``opts`` holds per-map settings the worker needs (``shm``,
+    ``batch_size``). ``blob`` is ``(data, oob, cancel)``: ``data`` is the
+    pickle itself when small, else the path of a temp file holding it,
+    ``oob`` lists the shared memory segments holding large buffers when
+    ``opts["shm"]`` is a threshold, and ``cancel`` names ``flag``, a
+    one-byte segment set by :func:`_end_job`. When the block exits,
+    ``flag`` is set and the file and segments are removed. Tasks then carry
+    only the token, blob and their chunk of objs; workers drop the call
+    once a task shows that the job's map has finished. ``from_main`` tells
+    whether the pickle may refer to anything in ``__main__``, which workers
+    forked earlier may not have.
+    """
+    flag = shared_memory.SharedMemory(create=True, size=1)
+    call = (func, args, kwargs, opts)
+    segments = []
+    job = next(_job_ids)
+    token = f"{os.getpid()}:{job}"
+    _live_jobs.add(job)
+    path = None
+    try:
+        if opts["shm"]:
+            data, oob = _shm_dumps(call, opts["shm"], segments)
+        else:
+            data = pickle.dumps(call, protocol=pickle.HIGHEST_PROTOCOL)
+            oob = []
+        from_main = b"__main__" in data
+        if len(data) < BROADCAST_MIN_BYTES:
+            yield token, (data, oob, flag.name), from_main, flag
+            return
+        fd, path = tempfile.mkstemp(prefix="logmap-", suffix=".pkl")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        del data
+        yield token, (path, oob, flag.name), from_main, flag
+    finally:
+        _live_jobs.discard(job)
+        _end_job(flag)
+        if path is not None:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        _drop_shm(flag, unlink=True)
+        for seg in segments:
+            _drop_shm(seg, unlink=True)
+
+
+def _end_job(flag):
+    # Workers skip whatever is left of the job: chunks still queued, and
+    # the rest of any chunk in progress.
+    flag.buf[0] = 1
+
+
+def _job_number(token):
+    return int(token.rpartition(":")[2])
+
+
+def _load_call(token, blob, floor):
+    """Return ``(call, stop)`` for ``token``, unpickling it on the job's first task.
+
+    ``stop`` is the job's cancel flag. ``floor`` is the oldest job still
+    running in the parent. Calls of older jobs are dropped, with their
+    shared memory handles, so a large broadcast argument doesn't outlive
+    its map in every worker. Returns ``None`` if the job is already over.
+    """
+    entry = _worker_calls.get(token)
+    if entry is None:
+        for old in [t for t in _worker_calls if _job_number(t) < floor]:
+            for shm in _worker_calls.pop(old)[1]:
+                _drop_shm(shm)
+        data, oob, cancel = blob
+        try:
+            flag = shared_memory.SharedMemory(name=cancel)
+        except FileNotFoundError:
+            flag = None
+        if flag is None or flag.buf[0]:
+            # The map ended before this task ran; its files may be gone.
+            if flag is not None:
+                _drop_shm(flag)
+            return None
+        if isinstance(data, str):
+            with open(data, "rb") as f:
+                data = f.read()
+        call, handles = _shm_loads(data, oob)
+        handles.append(flag)
+        entry = _worker_calls[token] = ((call, flag.buf), handles)
+    return entry[0]
+
+
+def _call_batch(func, batch, args, kwargs):
+    results = func(batch, *args, **kwargs)
+    if results is None or len(results) != len(batch):
+        raise ValueError(
+            f"{getattr(func, '__name__', func)!s} returned "
+            f"{'None' if results is None else len(results)} results "
+            f"for a batch of {len(batch)}"
+        )
+    return list(results)
+
+
+def _call_chunk(func, chunk, args, kwargs, batch_size=None, trace=False, stop=None):
+    """Run one chunk; returns ``(results, elapsed_seconds, meta)``.
+
+    With ``batch_size``, ``func`` is called on lists of up to that many objs
+    and must return a list of as many results. ``meta`` names the worker
+    (``pid``, ``tid``) and counts its objs (``n``); with ``trace`` it also
+    holds the wall-clock start of every item (or batch) plus the end of the
+    last. Once ``stop[0]`` is set, the rest of the chunk is skipped.
+    """
+    t0 = time.perf_counter()
+    stamps = [] if trace else None
+    if batch_size:
+        results = []
+        for i in range(0, len(chunk), batch_size):
+            if stop is not None and stop[0]:
+                break
+            if trace:
+                stamps.append(time.time())
+            results.extend(_call_batch(func, chunk[i:i + batch_size], args, kwargs))
+    elif trace or stop is not None:
+        results = []
+        for obj in chunk:
+            if stop is not None and stop[0]:
+                break
+            if trace:
+                stamps.append(time.time())
+            results.append(func(obj, *args, **kwargs))
+    else:
+        results = [func(obj, *args, **kwargs) for obj in chunk]
+    elapsed = time.perf_counter() - t0
+    meta = {"pid": os.getpid(), "tid": threading.get_native_id(), "n": len(results)}
+    if trace:
+        stamps.append(time.time())
+        meta["stamps"] = stamps
+        meta["step"] = batch_size or 1
+    return results, elapsed, meta
+
+
+def _pmap_chunk(task):
+    token, blob, chunk, floor = task
+    loaded = _load_call(token, blob, floor)
+    if loaded is None:
+        meta = {"pid": os.getpid(), "tid": threading.get_native_id(), "n": 0}
+        return (_NO_RESULTS, []), 0.0, meta
+    (func, args, kwargs, opts), stop = loaded
+    forwarder = _forwarder
+    if forwarder is None:
+        return _run_chunk(func, chunk, args, kwargs, opts, stop)
+    # Log like the parent would, then send the records its way.
+    global _min_level
+    _min_level = opts["level"]
+    _nesting.is_quiet = opts["quiet"]
+    forwarder.token = token
+    sent = forwarder.seq
+    try:
+        results, elapsed, meta = _run_chunk(func, chunk, args, kwargs, opts, stop)
+    finally:
+        seq = forwarder.flush()
+    if seq != sent:
+        # Tells the parent which batch to wait for before taking the results.
+        meta["log_seq"] = (os.getpid(), seq)
+    return results, elapsed, meta
+
+
+def _run_chunk(func, chunk, args, kwargs, opts, stop=None):
+    """Decode a chunk's objs, run it, and return its results pickled.
+
+    ``chunk`` and the returned results are ``(data, oob)`` pairs as made by
+    :func:`_shm_dumps` (``oob`` is empty without ``shm``), so both sides
+    know exactly how many bytes crossed the pipe.
+    """
+    shm, batch_size, trace = opts["shm"], opts["batch_size"], opts["trace"]
+    if shm:
+        _retry_lingering_shm()
+    objs, handles = _shm_loads(*chunk)
+    try:
+        results, elapsed, meta = _call_chunk(func, objs, args, kwargs, batch_size, trace, stop)
+        del objs
+        if shm and _SHM_RESULTS:
+            segments = []
+            results = _shm_dumps(results, shm, segments, copy=True)
+            for seg in segments:
+                seg.close()
+        else:
+            results = (pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL), [])
+    finally:
+        for h in handles:
+            _drop_shm(h)
+    meta["bytes_out"] = len(results[0])
+    return results, elapsed, meta
+
+
+def _release_live_segments(live):
+    """Unlink input segments of chunks that never completed."""
+    while live:
+        _, segments = live.popitem()
+        for seg in segments:
+            _drop_shm(seg, unlink=True)
+
+
+def _process_submitter(pools, token, blob, shm=None, live=None, listener=None):
+    """Submit chunks to ``pools`` (a :class:`_MapPools`); with ``shm``, track segments in ``live``.
+
+    A chunk whose worker forwarded log records completes only once
+    ``listener`` has written them, so they appear before its results.
+    """
+    def submit(chunk, callback, error_callback):
+        start, objs = chunk
+        segments = []
+        if shm:
+            live[id(segments)] = segments
+            payload = _shm_dumps(objs, shm, segments)
+        else:
+            payload = (pickle.dumps(objs, protocol=pickle.HIGHEST_PROTOCOL), [])
+        bytes_in = len(payload[0])
+
+        def release():
+            if live is not None and live.pop(id(segments), None) is not None:
+                for seg in segments:
+                    _drop_shm(seg, unlink=True)
+
+        def on_done(res):
+            # Runs on the pool's result thread, which must never see an error.
+            try:
+                release()
+                results, elapsed, meta = res
+                t0 = time.perf_counter()
+                results, _ = _shm_loads(*results, copy=True)
+                meta["unpickle"] = time.perf_counter() - t0
+                meta["bytes_in"] = bytes_in
+                if listener is not None and "log_seq" in meta:
+                    listener.wait(*meta["log_seq"])
+            except Exception as e:
+                error_callback(e)
+            else:
+                callback((start, (results, elapsed, meta)))
+
+        def on_error(err):
+            release()
+            error_callback(err)
+
+        pools.for_chunk(objs, payload[0]).apply_async(
+            _pmap_chunk,
+            ((token, blob, payload, min(_live_jobs, default=0)),),
+            callback=on_done,
+            error_callback=on_error,
+        )
+    return submit
+
+
+def _thread_submitter(executor, func, args, kwargs, batch_size=None, trace=False):
+    def submit(chunk, callback, error_callback):
+        start, objs = chunk
+
+        def done(fut):
+            if fut.cancelled():
+                return
+            err = fut.exception()
+            if err is not None:
+                error_callback(err)
+            else:
+                callback((start, fut.result()))
+
+        # In a copy of the caller's context, so spans nest under its span.
+        executor.submit(
+            contextvars.copy_context().run,
+            _call_chunk, func, objs, args, kwargs, batch_size, trace,
+        ).add_done_callback(done)
+    return submit
+
+
+def _serial_submitter(func, args, kwargs, batch_size=None, trace=False):
+    """Run each chunk inline, in the calling thread."""
+    def submit(chunk, callback, error_callback):
+        start, objs = chunk
+        try:
+            res = _call_chunk(func, objs, args, kwargs, batch_size, trace)
+        except Exception as e:
+            error_callback(e)
+        else:
+            callback((start, res))
+    return submit
+
+
+def _windowed(submit, chunks, window, ordered=True):
+    """Drive ``submit`` over ``chunks`` with at most ``window`` outstanding.
+
+    ``submit(chunk, callback, error_callback)`` starts one chunk; the
+    callbacks fire from whatever thread completes it. Yields each chunk's
+    result as it completes, or in submission order if ``ordered`` (holding
+    finished chunks back until their predecessors arrive; held chunks still
+    count against the window).
+    """
+    done = queue.SimpleQueue()
+    chunks = iter(chunks)
+    buffered = {}
+    next_seq = next_yield = outstanding = 0
+
+    def fill():
+        nonlocal next_seq, outstanding
+        while outstanding < window:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            seq = next_seq
+            next_seq += 1
+            outstanding += 1
+            submit(
+                chunk,
+                lambda res, seq=seq: done.put((seq, res, None)),
+                lambda err, seq=seq: done.put((seq, None, err)),
+            )
+
+    fill()
+    while outstanding:
+        seq, res, err = done.get()
+        if err is not None:
+            raise err
+        if not ordered:
+            outstanding -= 1
+            fill()
+            yield res
+            continue
+        buffered[seq] = res
+        while next_yield in buffered:
+            res = buffered.pop(next_yield)
+            next_yield += 1
+            outstanding -= 1
+            # Refill before yielding so workers stay busy while the
+            # consumer handles this chunk.
+            fill()
+            yield res
+
+
+# Adaptive chunking aims for tasks of about this many seconds each
+DEFAULT_CHUNK_TARGET = 0.1
+MAX_CHUNKSIZE = 10000
+
+
+class _ChunkSizer:
+    """Size chunks from measured per-item latency.
+
+    The first chunks hold a single item each. Once results come back, each
+    new chunk is sized so that it should take about ``target`` seconds, using
+    a moving average of seconds per item. When ``total`` is known, chunks
+    are also capped at ``remaining / (4 * num_proc)`` items. Chunks shrink
+    toward the end of the job, so the last workers don't straggle on one
+    oversized chunk.
+    """
+
+    def __init__(self, num_proc, total=None, target=DEFAULT_CHUNK_TARGET, log=None,
+                 multiple=1):
+        self.num_proc = num_proc
+        self.multiple = multiple
+        self.total = total
+        self.target = target
+        self.log = log
+        self.per_item = None
+        self.dispatched = 0
+        self.n_chunks = 0
+        self.min_size = self.max_size = None
+        self._last_logged = None
+
+    def observe(self, n_items, elapsed):
+        if n_items <= 0:
+            return
+        rate = elapsed / n_items
+        self.per_item = rate if self.per_item is None else 0.7 * self.per_item + 0.3 * rate
+
+    def __call__(self):
+        if self.per_item is None:
+            size = 1
+        elif self.per_item <= 0:
+            size = MAX_CHUNKSIZE
+        else:
+            size = max(1, min(int(self.target / self.per_item), MAX_CHUNKSIZE))
+        if self.total is not None:
+            remaining = self.total - self.dispatched
+            size = max(1, min(size, remaining // (self.num_proc * 4)))
+        if self.multiple > 1:
+            size = -(-size // self.multiple) * self.multiple
+        self.dispatched += size
+        last = self._last_logged
+        if self.log is not None and (last is None or size >= 2 * last or 2 * size <= last):
+            self._last_logged = size
+            per_item = self.per_item
+            self.log(lambda: (
+                f"chunksize -> {size}"
+                + (f" (~{per_item * 1000:.3g} ms/item)" if per_item is not None else "")
+            ))
+        return size
+
+    def sent(self, n_items):
+        """Count a chunk of ``n_items`` actually dispatched."""
+        self.n_chunks += 1
+        self.min_size = n_items if self.min_size is None else min(self.min_size, n_items)
+        self.max_size = n_items if self.max_size is None else max(self.max_size, n_items)
+
+    def summary(self):
+        return (f"{self.n_chunks} chunks, chunksize "
+                f"{self.min_size}-{self.max_size}, target {self.target:g}s")
+
+
+class WorkerStats:
+    """Counters for one worker of a parallel map; see :class:`MapStats`."""
+
+    __slots__ = ("items", "chunks", "busy", "idle", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.items = self.chunks = self.bytes_in = self.bytes_out = 0
+        self.busy = self.idle = 0.0
+
+    def __repr__(self):
+        return (f"WorkerStats(items={self.items}, chunks={self.chunks}, "
+                f"busy={self.busy:.3f}, idle={self.idle:.3f}, "
+                f"bytes_in={self.bytes_in}, bytes_out={self.bytes_out})")
+
+
+class MapStats:
+    """Where a parallel map's time went, per worker.
+
+    ``workers`` maps a worker id (the pid of a worker process, the thread
+    id of a worker thread) to its :class:`WorkerStats`: items processed,
+    chunks, ``busy`` seconds running ``func``, ``idle`` seconds of the map's
+    ``wall`` time spent waiting instead, and bytes pickled to it
+    (``bytes_in``) and back (``bytes_out``). ``unpickle`` is the parent's
+    time decoding results. Items served from a cache or journal aren't
+    attributed to any worker. Filled in as the map runs.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.num_proc = None
+        self.workers = {}
+        self.unpickle = 0.0
+        self.wall = 0.0
+        self._t0 = None
+
+    def _start(self, backend, num_proc):
+        self.backend = backend
+        self.num_proc = num_proc
+        self._t0 = time.perf_counter()
+
+    def _record(self, meta, elapsed):
+        wid = meta["pid"] if self.backend == "process" else meta["tid"]
+        w = self.workers.get(wid)
+        if w is None:
+            w = self.workers[wid] = WorkerStats()
+        w.items += meta["n"]
+        w.chunks += 1
+        w.busy += elapsed
+        w.bytes_in += meta.get("bytes_in", 0)
+        w.bytes_out += meta.get("bytes_out", 0)
+        self.unpickle += meta.get("unpickle", 0.0)
+
+    def _finish(self):
+        self.wall = time.perf_counter() - self._t0
+        for w in self.workers.values():
+            w.idle = max(0.0, self.wall - w.busy)
+
+    @property
+    def items(self):
+        return sum(w.items for w in self.workers.values())
+
+    @property
+    def busy(self):
+        return sum(w.busy for w in self.workers.values())
+
+    @property
+    def utilization(self):
+        """Busy time over ``num_proc * wall``: 1.0 means workers never waited."""
+        capacity = (self.num_proc or 1) * self.wall
+        return self.busy / capacity if capacity > 0 else 0.0
+
+    def summary(self):
+        bytes_in = sum(w.bytes_in for w in self.workers.values())
+        bytes_out = sum(w.bytes_out for w in self.workers.values())
+        line = (f"{self.items} items on {len(self.workers)}/{self.num_proc} "
+                f"{self.backend} workers in {self.wall:.3g}s, "
+                f"{self.utilization:.0%} busy")
+        if bytes_in or bytes_out:
+            line += (f", pickled {format_size(bytes_in)} in / {format_size(bytes_out)} out, "
+                     f"{self.unpickle:.3g}s unpickling")
+        return line
+
+    def __repr__(self):
+        return f"<MapStats {self.summary()}>"
+
+
+def _observed(submit, sizer):
+    """Wrap a submitter so each finished chunk's timing feeds ``sizer``."""
+    def wrapped(chunk, callback, error_callback):
+        sizer.sent(len(chunk[1]))
+
+        def on_done(res):
+            results, elapsed, _ = res[1]
+            sizer.observe(len(results), elapsed)
+            callback(res)
+        submit(chunk, on_done, error_callback)
+    return wrapped
+
+
+def _span_log(span, msg, level="DEBUG"):
+    """Log one level inside ``span`` (or at top level), bypassing any progress bar."""
+    if not is_enabled_for(level):
+        return
+    msg = _render_msg(msg, ())
+    if span is None:
+        _emit(msg, level, extra={"depth": 0, "task": None, "msg": msg})
+    else:
+        _emit(f"{span.inner_pref}{msg}", level,
+              extra={"depth": span.num, "task": span.task_name, "msg": msg})
+
+
+def _iter_chunks(iterable, size):
+    """Yield ``(start_index, [objs])`` chunks of at most ``size`` items.
+
+    ``size`` may be a zero-argument callable, asked once per chunk.
+    """
+    it = iter(iterable)
+    start = 0
+    while True:
+        chunk = list(islice(it, size() if callable(size) else size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+def _input_total(objs, lim=None, total=None):
+    """Best-effort item count for progress bars; ``None`` if unknown."""
+    if total is None:
+        try:
+            total = len(objs)
+        except TypeError:
+            total = None
+    if lim is not None:
+        total = lim if total is None else min(total, lim)
+    return total
+
+
+# ---------------------------------------------------------------------------
+# Result cache
+# ---------------------------------------------------------------------------
+
+# Size bound for a ResultCache opened from a plain path
+DEFAULT_CACHE_BYTES = 1024 ** 3
+_CACHE_FILE = "logmap-cache.sqlite"
+# Stay well under sqlite's bound-parameter limit
+_CACHE_QUERY_BATCH = 500
+
+
+class _StablePickler(pickle.Pickler):
+    """Pickler whose output doesn't depend on the hash seed.
+
+    Sets and frozensets pickle in iteration order, which for strings changes
+    with every interpreter; they are written as their sorted members instead.
+    The output is only fit for hashing.
+    """
+
+    def persistent_id(self, obj):
+        if type(obj) in (set, frozenset):
+            return type(obj).__name__, sorted(_stable_dumps(member) for member in obj)
+        return None
+
+
+# Opcodes that start a set or frozenset in protocol 4
+_SET_OPCODES = (pickle.EMPTY_SET, pickle.FROZENSET)
+
+
+def _stable_dumps(obj):
+    """Pickle ``obj`` into the same bytes in every process, for hashing."""
+    data = pickle.dumps(obj, protocol=4)
+    if not any(op in data for op in _SET_OPCODES):
+        return data
+    buf = io.BytesIO()
+    _StablePickler(buf, protocol=4).dump(obj)
+    return buf.getvalue()
+
+
+def _func_identity(func, _seen=None):
+    """Qualified name, source and bound state of ``func``, for cache keys.
+
+    Editing the source invalidates its entries, and so does changing its
+    defaults, the values it closes over (functions among them identified
+    the same way), a method's instance or, for a callable object, the
+    object itself. Raises ``TypeError`` if that state can't be pickled,
+    rather than let different calls share a key.
+    """
+    if isinstance(func, functools.partial):
+        bound = _stable_dumps((func.args, sorted(func.keywords.items())))
+        return _func_identity(func.func, _seen) + b"\0" + bound
+    if inspect.isroutine(func) or inspect.isclass(func):
+        owner, instance = func, None
+    else:
+        # A callable object: its class's code and its own state.
+        owner, instance = type(func), func
+    name = f"{getattr(owner, '__module__', None)}.{getattr(owner, '__qualname__', None)}"
+    try:
+        src = inspect.getsource(owner).encode()
+    except (OSError, TypeError):
+        code = getattr(func, "__code__", None)
+        src = code.co_code if code is not None else b""
+    if _seen is None:
+        _seen = set()
+    _seen.add(id(func))
+    cells = []
+    for cell in getattr(func, "__closure__", None) or ():
+        try:
+            value = cell.cell_contents
+        except ValueError:
+            value = None
+        if inspect.isfunction(value):
+            # Local helpers can't be pickled; recursive ones close over themselves.
+            value = b"" if id(value) in _seen else _func_identity(value, _seen)
+        cells.append(value)
+    state = (
+        getattr(func, "__defaults__", None),
+        getattr(func, "__kwdefaults__", None),
+        cells,
+        func.__self__ if inspect.ismethod(func) else instance,
+    )
+    try:
+        bound = _stable_dumps(state)
+    except Exception as e:
+        raise TypeError(
+            f"can't cache results of {name}: its defaults, closure or "
+            f"instance can't be pickled ({e})"
+        ) from e
+    return name.encode() + b"\0" + src + b"\0" + bound
+
+
+class ResultCache:
+    """Size-bounded on-disk store of map results, evicting least recently used.
+
+    ``path`` is a directory (created if needed) that holds a
+    ``logmap-cache.sqlite`` file, or the path of the sqlite file itself.
+    Results are pickled, and several processes may share one cache. Pass an
+    instance as ``cache=`` to choose ``max_bytes``; a plain path opens one
+    with :data:`DEFAULT_CACHE_BYTES`.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_BYTES):
+        path = os.fspath(path)
+        if os.path.isdir(path) or path.endswith(("/", os.sep)) or not os.path.splitext(path)[1]:
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, _CACHE_FILE)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key BLOB PRIMARY KEY, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, atime REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_atime ON results (atime)")
+        self._db.commit()
+        self._size = self._stored_bytes()
+
+    def __repr__(self):
+        return f"ResultCache({self.path!r}, max_bytes={self.max_bytes})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
 
-CONTEXT = _default_mp_context()
+    def _stored_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
 
-_cpu = mp.cpu_count()
-DEFAULT_NUM_PROC = 1 if _cpu <= 1 else (2 if _cpu <= 3 else _cpu - 2)
+    @staticmethod
+    def call_key(func, args=(), kwargs=None):
+        """Digest of everything but the obj; combine with :meth:`key`."""
+        h = hashlib.blake2b(_func_identity(func), digest_size=16)
+        h.update(_stable_dumps((tuple(args), sorted((kwargs or {}).items()))))
+        return h.digest()
 
-# Level dispatch — int values follow stdlib logging convention
-LEVELS = {
-    "TRACE": 5,
-    "DEBUG": 10,
-    "INFO": 20,
-    "WARNING": 30,
-    "ERROR": 40,
-    "CRITICAL": 50,
-}
+    @staticmethod
+    def key(call_key, obj):
+        h = hashlib.blake2b(call_key, digest_size=16)
+        h.update(_stable_dumps(obj))
+        return h.digest()
+
+    def get_many(self, keys):
+        """Return ``{key: result}`` for the keys present, marking them used."""
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(keys), _CACHE_QUERY_BATCH):
+                part = keys[i:i + _CACHE_QUERY_BATCH]
+                marks = ",".join("?" * len(part))
+                rows = self._db.execute(
+                    f"SELECT key, value FROM results WHERE key IN ({marks})", part
+                ).fetchall()
+                if rows:
+                    self._db.execute(
+                        f"UPDATE results SET atime = ? WHERE key IN ({','.join('?' * len(rows))})",
+                        [time.time(), *(k for k, _ in rows)],
+                    )
+                found.update(rows)
+            if found:
+                self._db.commit()
+        return {k: pickle.loads(v) for k, v in found.items()}
+
+    def put_many(self, items):
+        """Store ``(key, result)`` pairs, then evict down to ``max_bytes``."""
+        now = time.time()
+        rows = []
+        for k, result in items:
+            blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((k, blob, len(blob), now))
+        if not rows:
+            return
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results (key, value, size, atime) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._size += sum(r[2] for r in rows)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # Other processes may have written too; start from the real total.
+        self._size = self._stored_bytes()
+        while self._size > self.max_bytes:
+            victims = self._db.execute(
+                "SELECT key, size FROM results ORDER BY atime LIMIT ?", (_CACHE_QUERY_BATCH,)
+            ).fetchall()
+            if not victims:
+                break
+            drop = []
+            for k, size in victims:
+                drop.append((k,))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    break
+            self._db.executemany("DELETE FROM results WHERE key = ?", drop)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM results")
+            self._db.commit()
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _prefilled(submit, lookup, store=None):
+    """Wrap a submitter so items whose result is already known skip dispatch.
+
+    ``lookup(start, objs)`` returns ``(known, state)``, where ``known`` maps
+    positions in the chunk to results. Only the other objs are submitted;
+    their results go to ``store(state, positions, results)`` before being
+    merged back in. A chunk known in full completes at once with zero
+    elapsed time. Worker metadata gains ``positions``, the indexes within
+    the chunk of the objs that were submitted.
+    """
+    def wrapped(chunk, callback, error_callback):
+        start, objs = chunk
+        known, state = lookup(start, objs)
+        if len(known) == len(objs):
+            callback((start, ([known[i] for i in range(len(objs))], 0.0, None)))
+            return
+        todo = [i for i in range(len(objs)) if i not in known]
+
+        def on_done(res):
+            try:
+                computed, elapsed, meta = res[1]
+                if store is not None:
+                    store(state, todo, computed)
+                results = [known.get(i) for i in range(len(objs))]
+                for i, result in zip(todo, computed):
+                    results[i] = result
+                # Worker metadata describes the submitted objs only.
+                meta["positions"] = todo
+            except Exception as e:
+                error_callback(e)
+            else:
+                callback((start, (results, elapsed, meta)))
 
-# ANSI color codes used in output
-_RESET = "\033[0m"
-_CYAN = "\033[0;36m"
-TOP_CHAR = "⎾"
-BOTTOM_CHAR = "⎿"
-VERTICAL_CHAR = " "
+        submit((start, [objs[i] for i in todo]), on_done, error_callback)
+    return wrapped
 
-LEVEL_COLORS = {
-    "TRACE":    "\033[0;36m",
-    "DEBUG":    "\033[1;34m",
-    "INFO":     "\033[1;32m",
-    "WARNING":  "\033[1;33m",
-    "ERROR":    "\033[1;31m",
-    "CRITICAL": "\033[1;35m",
-}
 
-# Format string — understood placeholders: {color} {msg} {reset} {cyan} {time}
-DEFAULT_FORMAT = "{color}{msg}{reset}{cyan} @ {time}{reset}"
+def _cached(submit, cache, call_key, counts):
+    """Serve results from ``cache`` and store the misses; tallies ``counts``."""
+    def lookup(start, objs):
+        keys = [cache.key(call_key, obj) for obj in objs]
+        found = cache.get_many(keys)
+        known = {i: found[k] for i, k in enumerate(keys) if k in found}
+        counts["hits"] += len(known)
+        counts["misses"] += len(objs) - len(known)
+        return known, keys
 
-# Legacy palette used by iter_progress's tqdm bar_format
-COLORS = {
-    "default": "\033[0;39m",
-    "light-blue": "\033[0;34m",
-    "light-cyan": "\033[0;36m",
-    "light-yellow": "\033[0;33m",
-    "light-magenta": "\033[0;35m",
-}
+    def store(keys, positions, results):
+        cache.put_many(zip((keys[i] for i in positions), results))
+
+    return _prefilled(submit, lookup, store)
 
 
 # ---------------------------------------------------------------------------
-# Thread-local nesting state + shared output config
+# Run journal
 # ---------------------------------------------------------------------------
 
-class _NestingState(threading.local):
-    def __init__(self):
-        self.num_logwatches = 0
-        self.logwatch_id = 0
-        self.is_quiet = False
+# Journal appends are batched: at most this many items or seconds between writes
+_JOURNAL_FLUSH_ITEMS = 1000
+_JOURNAL_FLUSH_SECONDS = 1.0
+_JOURNAL_SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
 
 
-_nesting = _NestingState()
-_lock = threading.Lock()
+class _Skipped:
+    """Placeholder result for a journaled item whose result wasn't kept."""
 
-# Output config — module-level, shared across threads, guarded by _lock
-_sink = sys.stderr
-_min_level = LEVELS["DEBUG"]
-_format = DEFAULT_FORMAT
-_opened_file = None
-_colorize = False
-_logger = None
-_structured = False
+    def __repr__(self):
+        return "<skipped>"
 
 
-def _refresh_colorize():
-    global _colorize
-    try:
-        _colorize = bool(_sink.isatty())
-    except (AttributeError, ValueError):
-        _colorize = False
+_SKIPPED = _Skipped()
 
 
-_refresh_colorize()
+class _Journal:
+    """Append-only record of finished item indexes, and optionally results.
 
-_UNSET = object()
+    ``done`` maps each finished index to its result, or :data:`_SKIPPED`
+    when results weren't kept. :meth:`record` buffers entries and writes
+    them in one append every :data:`_JOURNAL_FLUSH_ITEMS` items or
+    :data:`_JOURNAL_FLUSH_SECONDS` seconds, whichever comes first.
+    """
 
+    def __init__(self, path, func_name, keep_results=False):
+        self.path = os.fspath(path)
+        self.func_name = func_name
+        self.keep_results = keep_results
+        self.done = {}
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._open()
 
-def _emit(msg, level="DEBUG", extra=None):
-    """Write one formatted log line to the current sink."""
-    level = level.upper()
-    lvl_int = LEVELS.get(level, 0)
-    if lvl_int < _min_level:
-        return
-    n = datetime.now()
+    def __enter__(self):
+        return self
 
-    if _logger is not None:
-        clean = extra.get("msg", msg) if extra else msg
-        _logger.log(lvl_int, clean)
-        return
+    def __exit__(self, *exc):
+        self.close()
 
-    if _structured:
-        record = {"ts": n.isoformat(), "level": level, "msg": msg}
-        if extra:
-            record.update(extra)
-        line = json.dumps(record, default=str)
-    else:
-        ts = (f"{n.year:04d}-{n.month:02d}-{n.day:02d} "
-              f"{n.hour:02d}:{n.minute:02d}:{n.second:02d},{n.microsecond // 1000:03d}")
-        if _colorize:
-            line = _format.format(
-                color=LEVEL_COLORS.get(level, ""),
-                msg=msg, reset=_RESET, cyan=_CYAN, time=ts,
+    def _check_func(self, recorded):
+        if recorded is not None and recorded != self.func_name:
+            raise ValueError(
+                f"journal {self.path!r} belongs to {recorded}(), not {self.func_name}()"
             )
-        else:
-            line = _format.format(color="", msg=msg, reset="", cyan="", time=ts)
 
-    with _lock:
-        _sink.write(line + "\n")
+    def record(self, start, results):
+        """Note a chunk handed to the consumer; skips indexes already done."""
+        for i, result in enumerate(results, start):
+            if i not in self.done:
+                # Each index comes back once per run, so don't hold results.
+                self.done[i] = _SKIPPED
+                self._pending.append((i, result))
+        if (len(self._pending) >= _JOURNAL_FLUSH_ITEMS
+                or time.monotonic() - self._last_flush >= _JOURNAL_FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._append(self._pending)
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._close()
+
+
+class _JsonlJournal(_Journal):
+    """JSON lines: a header, then one line per flushed batch.
+
+    Kept results must be JSON-serializable. A torn last line (from a killed
+    process) is ignored on load.
+    """
+
+    def _open(self):
+        recorded = None
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "func" in entry:
+                        recorded = entry["func"]
+                        continue
+                    results = entry.get("results")
+                    for n, i in enumerate(entry.get("i", ())):
+                        self.done[i] = results[n] if results is not None else _SKIPPED
+        self._check_func(recorded)
+        self._file = open(self.path, "a", encoding="utf-8")
+        if recorded is None:
+            self._file.write(json.dumps({"func": self.func_name}) + "\n")
+            self._file.flush()
+
+    def _append(self, entries):
+        entry = {"i": [i for i, _ in entries]}
+        if self.keep_results:
+            entry["results"] = [r for _, r in entries]
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close(self):
+        self._file.close()
+
+
+class _SqliteJournal(_Journal):
+    """sqlite file; kept results are pickled, so any picklable result works."""
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, timeout=60)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS done (i INTEGER PRIMARY KEY, result BLOB)")
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'func'").fetchone()
+        self._check_func(row[0] if row else None)
+        if row is None:
+            self._db.execute("INSERT INTO meta VALUES ('func', ?)", (self.func_name,))
+        self._db.commit()
+        for i, blob in self._db.execute("SELECT i, result FROM done"):
+            self.done[i] = pickle.loads(blob) if blob is not None else _SKIPPED
+
+    def _append(self, entries):
+        keep = self.keep_results
+        self._db.executemany(
+            "INSERT OR REPLACE INTO done (i, result) VALUES (?, ?)",
+            [(i, pickle.dumps(r, protocol=pickle.HIGHEST_PROTOCOL) if keep else None)
+             for i, r in entries],
+        )
+        self._db.commit()
 
+    def _close(self):
+        self._db.close()
 
-def configure(sink=None, level=None, format=None, logger=_UNSET, structured=None):
-    """Reconfigure where logmap writes output.
 
-    Omitted args keep their current value.
+def _open_journal(path, func, keep_results=False):
+    name = f"{getattr(func, '__module__', None)}.{getattr(func, '__qualname__', func)}"
+    if os.fspath(path).endswith(_JOURNAL_SQLITE_SUFFIXES):
+        return _SqliteJournal(path, name, keep_results)
+    return _JsonlJournal(path, name, keep_results)
 
-    Args:
-        sink: writable stream (``sys.stdout``, ``StringIO``, open file),
-            file path string (``"run.log"``), or ``None`` to reset to stderr.
-        level: level name (``"INFO"``) or int (``20``); messages below the
-            threshold are suppressed.
-        format: format string with ``{color}``, ``{msg}``, ``{reset}``,
-            ``{cyan}``, ``{time}`` placeholders. See :data:`DEFAULT_FORMAT`.
-        logger: a :class:`logging.Logger`; when set, output is forwarded via
-            ``logger.log()`` instead of writing to the sink directly.
-            Pass ``None`` to clear.
-        structured: if ``True``, emit JSON-lines output instead of
-            human-readable text.  Each line is a JSON object with ``ts``,
-            ``level``, ``msg``, ``depth``, and ``task`` keys.
+
+def _journaled(submit, journal):
+    """Skip items ``journal`` already has; their recorded results are reused."""
+    done = journal.done
+
+    def lookup(start, objs):
+        return {i: done[start + i] for i in range(len(objs)) if start + i in done}, None
+
+    return _prefilled(submit, lookup)
+
+
+# ---------------------------------------------------------------------------
+# Worker log forwarding
+# ---------------------------------------------------------------------------
+
+# Workers send buffered records at least this often while they log, and
+# whenever this many have accumulated; the rest go at the end of each chunk.
+FORWARD_BATCH = 256
+FORWARD_SECONDS = 0.2
+# How long a finished chunk waits for its worker's records to be written
+_FORWARD_WAIT = 5.0
+
+# Set in pool workers: records go to the parent instead of the sink
+_forwarder = None
+
+
+class _LogForwarder:
+    """Worker side: batch records onto the parent's queue, tagged by job."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.token = None
+        self.seq = 0
+        self._buf = []
+        self._since = None
+        self._lock = threading.Lock()
+
+    def put(self, record):
+        with self._lock:
+            if not self._buf:
+                self._since = record[0]
+            self._buf.append(record)
+            if len(self._buf) >= FORWARD_BATCH or record[0] - self._since >= FORWARD_SECONDS:
+                self._send()
+
+    def flush(self):
+        """Send anything buffered; returns the last batch number sent."""
+        with self._lock:
+            if self._buf:
+                self._send()
+            return self.seq
+
+    def _send(self):
+        self.seq += 1
+        self.queue.put((self.token, os.getpid(), self.seq, self._buf))
+        self._buf = []
+
+
+class _LogListener:
+    """Parent side: write forwarded records nested under their map's span.
+
+    ``targets`` maps a job token to ``(depth, prefix)`` of the span the map
+    was called from. Records are re-indented beneath it, tagged with the
+    worker's pid, filtered by the parent's level, and written through the
+    parent's sink (clearing and redrawing any progress bar around them).
     """
-    global _sink, _min_level, _format, _opened_file, _colorize, _logger, _structured
-    with _lock:
-        if sink is not None:
-            if _opened_file is not None:
-                try:
-                    _opened_file.close()
-                except Exception:
-                    pass
-                _opened_file = None
-            if isinstance(sink, str):
-                _opened_file = open(sink, "a", encoding="utf-8", buffering=1)
-                _sink = _opened_file
-            else:
-                _sink = sink
-            _refresh_colorize()
-        if level is not None:
-            _min_level = LEVELS[level.upper()] if isinstance(level, str) else int(level)
-        if format is not None:
-            _format = format
-        if logger is not _UNSET:
-            _logger = logger
-        if structured is not None:
-            _structured = bool(structured)
+
+    def __init__(self, context):
+        self.queue = mp.get_context(context).Queue()
+        self.targets = {}
+        self._seen = {}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="logmap-forward", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get()
+            except (EOFError, OSError):
+                return
+            if item is None:
+                return
+            token, pid, seq, records = item
+            try:
+                self._write(self.targets.get(token, (0, "")), pid, records)
+            except Exception:
+                pass
+            with self._cond:
+                self._seen[pid] = max(seq, self._seen.get(pid, 0))
+                self._cond.notify_all()
+
+    def _write(self, target, pid, records):
+        depth, prefix = target
+        tag = f"[worker {pid}] "
+        out = []
+        for ts, level, lvl_int, msg, extra in records:
+            if lvl_int < _min_level:
+                continue
+            extra = dict(extra) if extra else {}
+            extra["depth"] = depth + extra.get("depth", 0)
+            extra["worker"] = pid
+            out.append((ts, level, lvl_int, f"{prefix}{tag}{msg}", extra))
+        if not out:
+            return
+        if _logger is not None or _writer is not None:
+            for record in out:
+                _dispatch(record)
+            return
+        with tqdm.external_write_mode(file=_sink):
+            _write_records(out)
+
+    def wait(self, pid, seq, timeout=_FORWARD_WAIT):
+        """Block until batch ``seq`` from ``pid`` has been written."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seen.get(pid, 0) >= seq, timeout)
+
+    def stop(self):
+        try:
+            self.queue.put(None)
+        except (OSError, ValueError):
+            pass
+        self._thread.join(timeout=1)
+
+
+# context -> _LogListener shared by that context's pools
+_listeners = {}
+
+
+def _get_listener(context):
+    listener = _listeners.get(context)
+    if listener is None:
+        listener = _listeners[context] = _LogListener(context)
+    return listener
+
+
+@contextmanager
+def _forwarding(listener, token, span):
+    """Route records tagged ``token`` beneath ``span`` (or the current depth)."""
+    if span is not None:
+        target = (span.num, span.inner_pref)
+    else:
+        depth = _nesting.num_logwatches
+        target = (depth, f"{VERTICAL_CHAR} " * depth)
+    listener.targets[token] = target
+    try:
+        yield
+    finally:
+        listener.targets.pop(token, None)
 
 
 # ---------------------------------------------------------------------------
-# Parallel map helpers
+# Persistent worker pools
 # ---------------------------------------------------------------------------
 
-def _pmap_do(inp):
-    func, obj, args, kwargs = inp
-    return func(obj, *args, **kwargs)
+# (context, num_proc, initializer, initargs) -> multiprocessing Pool. Pools
+# outlive a single map call so repeated small maps don't pay fork/join cost.
+_pools = {}
+_pools_lock = threading.Lock()
+# Pool key -> number of maps and logmap.pool() blocks using that pool
+_pool_users = {}
+# Forked pool -> __main__'s globals when its workers were forked
+_forked_main = weakref.WeakKeyDictionary()
+
+
+def _pool_key(context, num_proc, initializer, initargs):
+    try:
+        hash(initargs)
+    except TypeError:
+        initargs = repr(initargs)
+    return (context, num_proc, initializer, initargs)
+
+
+def _worker_init(initializer, initargs, log_queue=None):
+    global _forwarder, _profiler
+    # A forked worker inherits the depth of whatever span created the pool;
+    # its own spans start from the top, and the parent nests them.
+    _nesting.num_logwatches = _nesting.logwatch_id = 0
+    _nesting.pool_scope = None
+    _profiler = None
+    if log_queue is not None:
+        _forwarder = _LogForwarder(log_queue)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _start_pool(context, num_proc, initializer, initargs):
+    # Under _pools_lock.
+    if os.name == "posix":
+        # Workers must share the parent's tracker, or shared-memory
+        # segments they touch look leaked to a tracker of their own.
+        resource_tracker.ensure_running()
+    pool = mp.get_context(context).Pool(
+        num_proc,
+        initializer=_worker_init,
+        initargs=(initializer, initargs, _get_listener(context).queue),
+    )
+    if context == "fork":
+        _forked_main[pool] = _main_snapshot()
+    return pool
+
+
+def _get_pool(context, num_proc, initializer=None, initargs=()):
+    """Return ``(key, pool)``, starting the pool on first use.
+
+    Counts the caller as a user of the pool until :func:`_release_pool`.
+    """
+    initargs = tuple(initargs)
+    key = _pool_key(context, num_proc, initializer, initargs)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = _start_pool(context, num_proc, initializer, initargs)
+        _pool_users[key] = _pool_users.get(key, 0) + 1
+    return key, pool
+
+
+def _release_pool(key):
+    with _pools_lock:
+        users = _pool_users.pop(key, 0) - 1
+        if users > 0:
+            _pool_users[key] = users
+
+
+def _discard_pool(key):
+    """Remove a pool from the registry and let its workers finish and exit."""
+    with _pools_lock:
+        pool = _pools.pop(key, None)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def _main_snapshot():
+    """What each of ``__main__``'s globals is bound to, as of now."""
+    snapshot = {}
+    for name, value in list(vars(sys.modules["__main__"]).items()):
+        try:
+            # Unlike an id, a weak reference can't match a new object that
+            # happens to reuse a freed one's address.
+            snapshot[name] = weakref.ref(value)
+        except TypeError:
+            snapshot[name] = id(value)
+    return snapshot
+
+
+def _main_changed(pool, names):
+    """Whether ``__main__`` defined or rebound any of ``names`` since ``pool`` forked."""
+    snapshot = _forked_main.get(pool)
+    if snapshot is None:
+        return False
+    main = vars(sys.modules["__main__"])
+    for name in names:
+        if name not in main:
+            continue
+        seen = snapshot.get(name)
+        if seen is None:
+            return True
+        if isinstance(seen, weakref.ref):
+            if seen() is not main[name]:
+                return True
+        elif seen != id(main[name]):
+            return True
+    return False
+
+
+def _code_names(code):
+    """Global (and attribute) names read by ``code`` and the code nested in it."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+class _NullFile:
+    def write(self, data):
+        return len(data)
+
+
+class _MainNames(pickle.Pickler):
+    """Pickles into nothing, collecting the ``__main__`` globals an object needs.
+
+    Those are the ``__main__`` functions and classes it refers to by name,
+    and the names their code reads. Large buffers are skipped.
+    """
 
+    def __init__(self):
+        super().__init__(_NullFile(), protocol=5, buffer_callback=lambda buf: None)
+        self.names = set()
+
+    def reducer_override(self, obj):
+        if ((inspect.isfunction(obj) or inspect.isclass(obj))
+                and getattr(obj, "__module__", None) == "__main__"):
+            self.names.add(obj.__qualname__.partition(".")[0])
+            funcs = [obj] if inspect.isfunction(obj) else [
+                getattr(attr, "__func__", attr) for attr in vars(obj).values()]
+            for func in funcs:
+                if inspect.isfunction(func):
+                    self.names |= _code_names(func.__code__)
+        return NotImplemented
+
+
+class _MapPools:
+    """The pools one process map submits its chunks to.
+
+    Forked workers only have the ``__main__`` globals that existed when
+    they were forked. With ``watch_main``, once the call or a chunk needs a
+    name ``__main__`` has defined or rebound since, the rest of the map
+    goes to freshly forked workers. They replace the registry's pool if no
+    other map is using it, so later calls reuse them; otherwise they are
+    the map's own, and :meth:`close` shuts them down.
+    """
 
-def _auto_chunksize(n_items, num_proc):
-    if num_proc <= 1 or n_items <= 0:
-        return 1
-    return max(1, n_items // (num_proc * 4))
+    def __init__(self, context, num_proc, initializer, initargs, watch_main):
+        self.args = (context, num_proc, initializer, tuple(initargs))
+        self.key, self.pool = _get_pool(*self.args)
+        self.watch_main = watch_main and context == "fork"
+        self.own = []
+
+    def check(self, obj):
+        """Move to fresh workers if ``obj`` needs a newer ``__main__``."""
+        if not self.watch_main:
+            return
+        pickler = _MainNames()
+        pickler.dump(obj)
+        if not _main_changed(self.pool, pickler.names):
+            return
+        with _pools_lock:
+            fresh = _start_pool(*self.args)
+            if _pools.get(self.key) is self.pool and _pool_users.get(self.key) == 1:
+                _pools[self.key] = fresh
+                self.own.append(self.pool)
+            else:
+                self.own.append(fresh)
+        self.pool = fresh
+
+    def for_chunk(self, objs, data):
+        """The pool for a chunk of ``objs`` pickled into ``data``."""
+        if self.watch_main and b"__main__" in data:
+            self.check(objs)
+        return self.pool
+
+    def close(self):
+        _release_pool(self.key)
+        for pool in self.own:
+            pool.close()
+        for pool in self.own:
+            pool.join()
+
+
+def shutdown_pools():
+    """Terminate every pooled worker process. Runs automatically at exit."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+        _pool_users.clear()
+    for pool in pools:
+        pool.terminate()
+        pool.join()
+    with _pools_lock:
+        listeners = list(_listeners.values())
+        _listeners.clear()
+    for listener in listeners:
+        listener.stop()
+
+
+atexit.register(shutdown_pools)
+
+
+def _after_fork_in_child():
+    # Threads and pools belong to the parent. The writer thread does not
+    # survive fork, so fall back to synchronous writes instead of queueing
+    # into a dead buffer, and forget the parent's pools. The writer may have
+    # been holding _lock mid-batch when the fork happened; nobody in the
+    # child will ever release that copy.
+    global _lock, _writer, _pools_lock, _trace, _forwarder, _exit_flush_armed
+    global _dedup_lock, _dedup_key, _repeats
+    _lock = threading.Lock()
+    _writer = None
+    _pools.clear()
+    _pool_users.clear()
+    _forked_main.clear()
+    _pools_lock = threading.Lock()
+    _listeners.clear()
+    _forwarder = None
+    # The trace file belongs to the parent; a child writing (or flushing a
+    # copy of the parent's buffer) into it would corrupt the array.
+    if _trace is not None:
+        _trace._file = None
+        _trace = None
+    _exit_flush_armed = False
+    _dedup_lock = threading.Lock()
+    _dedup_key = _repeats = None
+    for sink in _file_sinks:
+        sink._after_fork()
+
+
+def _before_fork():
+    trace = _trace
+    if trace is not None:
+        trace.flush()
+    _flush_file_sinks()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork_in_child)
+
+
+def _resolve_num_proc(num_proc, default, clamp=True):
+    """Apply an enclosing :meth:`logmap.pool` scope and clamp to the CPU count."""
+    scope = _nesting.pool_scope
+    if num_proc is _UNSET:
+        num_proc = scope["num_proc"] if scope else default
+    if num_proc is None or num_proc < 1:
+        num_proc = 1
+    return min(num_proc, mp.cpu_count()) if clamp else num_proc
 
 
 def pmap_iter(
@@ -210,56 +2920,273 @@ def pmap_iter(
     args=(),
     kwargs=None,
     lim=None,
-    num_proc=DEFAULT_NUM_PROC,
+    num_proc=_UNSET,
     progress=True,
     progress_pos=0,
     desc=None,
     shuffle=False,
-    context=CONTEXT,
+    context=None,
     chunksize=None,
+    initializer=None,
+    initargs=(),
+    total=None,
+    max_inflight=None,
+    ordered=True,
+    with_index=False,
+    backend=None,
+    chunk_target=DEFAULT_CHUNK_TARGET,
+    shm=None,
+    batch_size=None,
+    cache=None,
+    journal=None,
+    journal_results=False,
+    stats=None,
+    span=None,
     **_unused,
 ):
     """Yield func(obj) for each obj in objs, optionally in parallel.
 
-    Does not mutate the caller's input. Uses ``multiprocessing.Pool(num_proc)``
-    when ``num_proc > 1`` and there is more than one item.
+    Does not mutate the caller's input. ``objs`` is consumed lazily, so it
+    may be an unbounded generator: at most ``max_inflight`` chunks (default
+    ``4 * num_proc``) are submitted ahead of the consumer, and ``lim`` stops
+    reading after that many items. ``total`` sizes the progress bar when
+    ``objs`` has no ``len()``. ``shuffle=True`` has to materialize the input.
+
+    With ``ordered=False`` results are yielded as soon as their chunk
+    finishes, so one slow item no longer holds back everything behind it.
+    ``with_index=True`` yields ``(index, result)`` pairs, where ``index`` is
+    the item's position in the (shuffled, truncated) input, so callers can
+    restore order themselves.
+
+    When ``num_proc > 1`` and there is more than one item, work runs on a
+    persistent ``multiprocessing`` pool keyed by ``(context, num_proc,
+    initializer)`` that is reused by later calls; see :meth:`logmap.pool`.
+    Forked workers only have the ``__main__`` globals that existed when
+    they were forked. Outside a ``logmap.pool()`` block, once the call or a
+    chunk of items needs a ``__main__`` function, class or global that was
+    defined or rebound since (in a notebook, say), the pool is forked
+    afresh, and later calls reuse the new workers.
+    ``num_proc``, ``context`` and ``initializer`` default to the enclosing
+    ``logmap.pool()`` scope, if any.
+
+    ``backend="thread"`` runs chunks on a ``ThreadPoolExecutor`` of
+    ``num_proc`` threads instead (not capped at the CPU count), which suits
+    I/O-bound work and accepts lambdas and closures; ``backend="serial"``
+    runs everything in the calling thread.
+
+    Unless ``chunksize`` is given, chunks are sized adaptively: per-item
+    latency is measured on the first single-item tasks, then each chunk is
+    sized to take about ``chunk_target`` seconds, and chunks shrink near the
+    end of the input. Each change of size by 2x or more is logged at TRACE,
+    and the chunk count and size range go into the map's summary.
+
+    ``shm=True`` (or a byte threshold, default :data:`SHM_MIN_BYTES`) sends
+    large NumPy arrays and ``bytes``/``bytearray``/``memoryview`` objects,
+    in items, ``args``/``kwargs`` and results, through
+    ``multiprocessing.shared_memory`` instead of the pool pipe. Workers see
+    arrays as views on the segment, and bytes-like items as ``memoryview``
+    objects (read-only for ``bytes``). Results are copied out
+    once in the parent. Smaller buffers are pickled as usual. Process
+    backend only.
+
+    With ``batch_size=N``, ``func`` receives lists of up to ``N`` objs and
+    must return a list with one result per obj; results are flattened back
+    into the per-item stream and progress still counts items.
+
+    ``cache="path/"`` (or a :class:`ResultCache`) keeps each result on disk,
+    keyed by a hash of ``func``'s qualified name, source, defaults and
+    closure (or a callable object's own state), the pickled obj, ``args``
+    and ``kwargs``. Items already in the cache are served in
+    the parent without being dispatched; the progress bar shows hits and
+    misses. Objs must be picklable to be hashed, and results to be stored.
+
+    ``journal="run.jsonl"`` (or a ``.db``/``.sqlite`` file) appends the index
+    of every item handed back to the caller, in batches. Calling again with
+    the same journal skips the recorded items, so an interrupted run picks
+    up where it stopped. With ``journal_results=True`` their results are
+    recorded too (JSON-serializable for ``.jsonl``) and yielded again on
+    resume; otherwise skipped items are left out of the output, and
+    ``with_index=True`` tells which ones came back. Indexes are positions in
+    the input, which must therefore be the same on every run; ``journal``
+    can't be combined with ``shuffle=True``.
+
+    Pass a :class:`MapStats` as ``stats`` to have it filled with per-worker
+    counters: items, busy and idle time, bytes pickled each way, and the
+    parent's time unpickling results. A one-line summary is logged when a
+    parallel map finishes: at DEBUG, nested under ``span`` (the calling
+    :class:`logmap`), if given, else at TRACE.
     """
+    if shuffle and journal is not None:
+        raise ValueError("journal can't be combined with shuffle=True: "
+                         "a resumed run would draw a different order")
     kwargs = dict(kwargs) if kwargs else {}
     args = tuple(args)
+    scope = _nesting.pool_scope
+    if context is None:
+        context = scope["context"] if scope else CONTEXT
+    if initializer is None and scope:
+        initializer, initargs = scope["initializer"], scope["initargs"]
 
-    items = list(objs)
     if shuffle:
+        items = list(objs)
         items = random.sample(items, k=len(items))
-    if lim is not None:
-        items = items[:lim]
-
-    n_items = len(items)
+    else:
+        items = objs
+    total = _input_total(items, lim, total)
+    items = iter(items) if lim is None else islice(items, lim)
+    # Peek so a single item (or none) skips the pool entirely.
+    head = list(islice(items, 2))
+    items = chain(head, items)
+
+    if backend is None:
+        backend = "process"
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}, got {backend!r}")
     num_cpu = mp.cpu_count()
-    if num_proc is None or num_proc < 1:
-        num_proc = 1
-    if num_proc > num_cpu:
-        num_proc = num_cpu
-    if num_proc > n_items:
-        num_proc = max(1, n_items)
+    # Threads waiting on I/O don't compete for cores, so don't cap them.
+    num_proc = _resolve_num_proc(num_proc, DEFAULT_NUM_PROC, clamp=backend != "thread")
+    parallel = backend != "serial" and num_proc > 1 and len(head) > 1
 
     if not desc:
         desc = f"Mapping {func.__name__}()"
-    if num_cpu > 1 and num_proc > 1:
+    if (num_cpu > 1 or backend == "thread") and parallel:
         desc = f"{desc} [x{num_proc}]"
 
-    if num_proc > 1 and n_items > 1:
-        payload = ((func, obj, args, kwargs) for obj in items)
-        cs = chunksize if chunksize else _auto_chunksize(n_items, num_proc)
-        with mp.get_context(context).Pool(num_proc) as pool:
-            iterr = pool.imap(_pmap_do, payload, chunksize=cs)
+    if (parallel or batch_size or cache is not None or journal is not None
+            or _trace is not None):
+        sizer = None
+        if not parallel:
+            window, cs = 1, batch_size or 1
+        else:
+            window = max_inflight if max_inflight else num_proc * 4
+            if chunksize:
+                # Keep whole batches in each chunk.
+                cs = -(-chunksize // batch_size) * batch_size if batch_size else chunksize
+            else:
+                sizer = cs = _ChunkSizer(
+                    num_proc, total, target=chunk_target,
+                    log=lambda msg: _span_log(span, msg, "TRACE"),
+                    multiple=batch_size or 1,
+                )
+        trace = _trace
+        if stats is None:
+            stats = MapStats()
+        stats._start(backend if parallel else "serial", num_proc if parallel else 1)
+        with ExitStack() as stack:
+            if not parallel:
+                if initializer is not None:
+                    initializer(*initargs)
+                submit = _serial_submitter(func, args, kwargs, batch_size, trace is not None)
+            elif backend == "thread":
+                executor = ThreadPoolExecutor(
+                    num_proc,
+                    thread_name_prefix="logmap",
+                    initializer=initializer,
+                    initargs=tuple(initargs),
+                )
+                stack.callback(executor.shutdown, wait=False, cancel_futures=True)
+                submit = _thread_submitter(executor, func, args, kwargs, batch_size,
+                                           trace is not None)
+            else:
+                if shm is True:
+                    shm = SHM_MIN_BYTES
+                live = {}
+                stack.callback(_release_live_segments, live)
+                token, blob, from_main, flag = stack.enter_context(_broadcast(
+                    func, args, kwargs,
+                    {"shm": shm, "batch_size": batch_size, "trace": trace is not None,
+                     "level": _min_level, "quiet": _nesting.is_quiet},
+                ))
+                pools = _MapPools(context, num_proc, initializer, initargs,
+                                  watch_main=scope is None)
+                stack.callback(pools.close)
+                if from_main:
+                    pools.check((func, args, kwargs))
+                # A map that fails or is abandoned leaves chunks queued on
+                # the pool; first thing on the way out, tell them to stop.
+                stack.callback(_end_job, flag)
+                with _pools_lock:
+                    listener = _get_listener(context)
+                stack.enter_context(_forwarding(listener, token, span))
+                submit = _process_submitter(pools, token, blob, shm, live, listener)
+            counts = None
+            if cache is not None:
+                if not isinstance(cache, ResultCache):
+                    cache = stack.enter_context(ResultCache(cache))
+                counts = {"hits": 0, "misses": 0}
+                submit = _cached(submit, cache, ResultCache.call_key(func, args, kwargs), counts)
+            if journal is not None:
+                journal = stack.enter_context(_open_journal(journal, func, journal_results))
+                if journal.done:
+                    _span_log(span, f"resuming from {journal.path}: "
+                                    f"{len(journal.done)} items already done", "INFO")
+                    submit = _journaled(submit, journal)
+            if sizer is not None:
+                # Cache hits count as free items, so chunks grow to keep the
+                # misses in each one near the target.
+                submit = _observed(submit, sizer)
+            pbar = None
             if progress:
-                iterr = tqdm(iterr, total=n_items, desc=desc, position=progress_pos)
-            for res in iterr:
-                yield res
+                pbar = _progress_for(total=total, desc=desc, position=progress_pos, span=span)
+                stack.callback(pbar.close)
+            bar = pbar if pbar is not None else getattr(span, "pbar", None)
+
+            for start, (results, elapsed, meta) in _windowed(
+                submit, _iter_chunks(items, cs), window, ordered=ordered
+            ):
+                if meta is not None:
+                    stats._record(meta, elapsed)
+                    if trace is not None:
+                        trace.items(func.__name__, start, meta, meta.get("positions"))
+                if pbar is not None:
+                    pbar.update(len(results))
+                if counts is not None and bar is not None:
+                    bar.set_postfix(counts, refresh=False)
+                if with_index:
+                    pairs = enumerate(results, start)
+                    if journal is not None:
+                        pairs = [(i, r) for i, r in pairs if r is not _SKIPPED]
+                    yield from pairs
+                elif journal is None:
+                    yield from results
+                else:
+                    yield from [r for r in results if r is not _SKIPPED]
+                if journal is not None:
+                    # Only once the consumer has taken the whole chunk.
+                    journal.record(start, results)
+            stats._finish()
+            # DEBUG is the default level: only a map run inside a span
+            # reports there, and a bare pmap() call leaves it to TRACE.
+            summary_level = "TRACE" if span is None else "DEBUG"
+            _span_log(span, lambda: stats.summary() + (f"; {sizer.summary()}" if sizer else ""),
+                      summary_level)
+            if counts is not None:
+                _span_log(span, lambda: f"cache: {counts['hits']} hits, {counts['misses']} misses",
+                          summary_level)
     else:
-        iterr = tqdm(items, desc=desc, position=progress_pos) if progress else items
-        for obj in iterr:
-            yield func(obj, *args, **kwargs)
+        if initializer is not None:
+            initializer(*initargs)
+        iterr = (_progress_for(items, total=total, desc=desc, position=progress_pos, span=span)
+                 if progress else items)
+        if stats is None:
+            for i, obj in enumerate(iterr):
+                res = func(obj, *args, **kwargs)
+                yield (i, res) if with_index else res
+            return
+        stats._start("serial", 1)
+        meta = {"pid": os.getpid(), "tid": threading.get_native_id(), "n": 0}
+        busy = 0.0
+        try:
+            for i, obj in enumerate(iterr):
+                t0 = time.perf_counter()
+                res = func(obj, *args, **kwargs)
+                busy += time.perf_counter() - t0
+                meta["n"] += 1
+                yield (i, res) if with_index else res
+        finally:
+            if meta["n"]:
+                stats._record(meta, busy)
+            stats._finish()
 
 
 def pmap(*a, **kw):
@@ -277,6 +3204,95 @@ def pmap_run(*a, **kw):
 # Helpers
 # ---------------------------------------------------------------------------
 
+class _ProgressReporter:
+    """Stand-in for a tqdm bar that logs ``n/total, rate, ETA`` lines instead.
+
+    Used when output isn't going to a terminal, where redrawn bars are only
+    noise. A line goes out through :func:`_span_log`, at ``span``'s depth,
+    at most every ``interval`` seconds, plus a closing one if the loop ran
+    long enough to report at all. Supports the parts of the tqdm API that
+    logmap uses.
+    """
+
+    def __init__(self, iterable=None, desc="", total=None, disable=False, span=None,
+                 level="INFO", prefix="", interval=None, **_bar_kwargs):
+        if total is None and iterable is not None:
+            try:
+                total = len(iterable)
+            except (TypeError, AttributeError):
+                total = None
+        self.iterable = iterable
+        self.total = total
+        self.n = 0
+        self.prefix = prefix
+        self.desc = desc or ""
+        self.postfix = None
+        self.disable = disable
+        self.span = span
+        self.level = level
+        self.interval = _progress_interval if interval is None else interval
+        self.start_t = time.monotonic()
+        self._next = self.start_t + self.interval
+        self._reported = False
+
+    def __iter__(self):
+        for obj in self.iterable:
+            yield obj
+            self.update()
+
+    def __len__(self):
+        return self.total
+
+    def update(self, n=1):
+        self.n += n
+        if not self.disable:
+            now = time.monotonic()
+            if now >= self._next:
+                self._next = now + self.interval
+                self._report(now)
+
+    def _report(self, now, final=False):
+        elapsed = now - self.start_t
+        rate = self.n / elapsed if elapsed > 0 else 0.0
+        parts = [f"{self.n}/{self.total} ({self.n / self.total:.0%})" if self.total else str(self.n),
+                 f"{rate:,.1f}/s"]
+        if final:
+            parts.append(f"done in {format_timespan(elapsed)}")
+        elif self.total and rate > 0 and self.n < self.total:
+            parts.append(f"ETA {format_timespan((self.total - self.n) / rate)}")
+        if self.postfix:
+            parts.append(" ".join(f"{k}={v}" for k, v in self.postfix.items()))
+        _span_log(self.span, f"{self.desc}: {', '.join(parts)}", self.level)
+        self._reported = True
+
+    def set_description(self, desc=None, refresh=True):
+        desc = desc or ""
+        self.desc = desc[len(self.prefix):] if desc.startswith(self.prefix) else desc
+
+    def set_postfix(self, ordered_dict=None, refresh=True, **kwargs):
+        self.postfix = dict(ordered_dict or {}, **kwargs)
+
+    def refresh(self):
+        pass
+
+    def close(self):
+        if not self.disable and self._reported:
+            self._report(time.monotonic(), final=True)
+        self.disable = True
+
+
+def _progress_for(iterable=None, desc="", total=None, disable=False, span=None,
+                  level="INFO", prefix="", **bar_kwargs):
+    """A tqdm bar, or a :class:`_ProgressReporter` if the sink isn't a terminal."""
+    style = _progress_style
+    if style == "auto":
+        style = "bar" if _isatty(bar_kwargs.get("file", _sink)) else "log"
+    if style == "log":
+        return _ProgressReporter(iterable, desc=desc, total=total, disable=disable,
+                                 span=span, level=level, prefix=prefix)
+    return tqdm(iterable, desc=f"{prefix}{desc}", total=total, disable=disable, **bar_kwargs)
+
+
 def padmin(xstr, lim=40):
     xstr = str(xstr)
     return xstr + (" " * (lim - len(xstr))) if len(xstr) < lim else xstr[:lim]
@@ -308,6 +3324,105 @@ def _format_call(func, args, kwargs, maxlen=60):
     return f"{name}({params})"
 
 
+# ---------------------------------------------------------------------------
+# Span profiler
+# ---------------------------------------------------------------------------
+
+class _ProfileNode:
+    __slots__ = ("name", "parent", "children", "count", "total", "child")
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.count = 0
+        self.total = 0.0
+        self.child = 0.0
+
+
+# Innermost profiled span of the current thread or task: (Profile, node)
+_profile_node = contextvars.ContextVar("logmap.profile_node", default=None)
+# Profile recording spans right now, if any
+_profiler = None
+
+
+class Profile:
+    """Aggregated timings of logmap spans, keyed by their nesting path.
+
+    Returned by :meth:`logmap.profile`. Each distinct path of span names is
+    one node holding a call count, total time, and the time spent in child
+    spans; :meth:`stats` and :meth:`report` derive self and mean times.
+    Children running concurrently (threads, gathered tasks) can add up to
+    more than their parent, in which case its self time is reported as 0.
+    """
+
+    def __init__(self):
+        self.root = _ProfileNode(None)
+        self._lock = threading.Lock()
+        self._outer = None
+
+    def __enter__(self):
+        global _profiler
+        self._outer, _profiler = _profiler, self
+        return self
+
+    def __exit__(self, *exc):
+        global _profiler
+        _profiler = self._outer
+
+    def _enter(self, name):
+        current = _profile_node.get()
+        parent = current[1] if current is not None and current[0] is self else self.root
+        node = parent.children.get(name)
+        if node is None:
+            with self._lock:
+                node = parent.children.setdefault(name, _ProfileNode(name, parent))
+        return self, node, _profile_node.set((self, node)), time.perf_counter()
+
+    def _exit(self, frame):
+        _, node, token, t0 = frame
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            node.count += 1
+            node.total += elapsed
+            node.parent.child += elapsed
+        try:
+            _profile_node.reset(token)
+        except ValueError:
+            # Stopped in another context than the one it started in.
+            pass
+
+    def stats(self):
+        """``(path, calls, total, self, mean)`` rows, slowest cumulative first.
+
+        ``path`` is a tuple of span names from the outermost span down.
+        """
+        rows = []
+        stack = [((), self.root)]
+        while stack:
+            path, node = stack.pop()
+            for name, child in node.children.items():
+                sub = path + (name,)
+                if child.count:
+                    rows.append((sub, child.count, child.total,
+                                 max(0.0, child.total - child.child),
+                                 child.total / child.count))
+                stack.append((sub, child))
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+    def report(self, limit=None, sep=" > "):
+        """The :meth:`stats` table as text, at most ``limit`` rows."""
+        lines = [f"{'calls':>8} {'total s':>10} {'self s':>10} {'mean s':>10}  path"]
+        for path, calls, total, self_time, mean in self.stats()[:limit]:
+            lines.append(f"{calls:>8} {total:>10.4f} {self_time:>10.4f} {mean:>10.4f}  "
+                         f"{sep.join(path)}")
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.report()
+
+
 # ---------------------------------------------------------------------------
 # The logmap class
 # ---------------------------------------------------------------------------
@@ -321,6 +3436,12 @@ class _LogmapMeta(type):
     def is_quiet(cls, value):
         _nesting.is_quiet = value
 
+    @property
+    def dropped(cls):
+        """Records discarded by the async writer's overflow policy."""
+        writer = _writer
+        return writer.dropped if writer is not None else 0
+
 
 class logmap(metaclass=_LogmapMeta):
     """Monitor and log the duration of a task, with hierarchical indentation.
@@ -359,6 +3480,71 @@ class logmap(metaclass=_LogmapMeta):
     disabled = quiet
     enabled = loud
 
+    @staticmethod
+    def flush():
+        """Block until queued output is written; see :func:`flush`."""
+        flush()
+
+    @staticmethod
+    def profile():
+        """Record every span entered in the block into a :class:`Profile`::
+
+            with logmap.profile() as prof:
+                run_pipeline()
+            print(prof.report())
+
+        Spans are grouped by their path of names; ``@logmap.fn`` spans are
+        named after the function, without arguments. Recording costs a
+        couple of microseconds per span, and nothing when no profile is
+        active. Spans in worker processes are not recorded.
+        """
+        return Profile()
+
+    @staticmethod
+    @contextmanager
+    def pool(num_proc=None, context=None, initializer=None, initargs=()):
+        """Keep a worker pool warm for every parallel map inside the block.
+
+        ``pmap``/``pmap_iter``/``pmap_run`` and ``lm.map``/``imap``/``run``
+        calls in the block default to this pool's ``num_proc``, ``context``
+        and ``initializer``, and reuse its workers instead of forking new
+        ones, even when ``__main__`` changes. Workers are forked when the
+        block starts, so they only see what ``__main__`` defined by then.
+        The pool is shut down when the block exits::
+
+            with logmap.pool(num_proc=8):
+                for batch in batches:
+                    lm.map(process, batch)
+        """
+        num_proc = _resolve_num_proc(
+            DEFAULT_NUM_PROC if num_proc is None else num_proc, DEFAULT_NUM_PROC
+        )
+        context = context or CONTEXT
+        initargs = tuple(initargs)
+        key, pool = _get_pool(context, num_proc, initializer, initargs)
+        outer = _nesting.pool_scope
+        _nesting.pool_scope = {
+            "num_proc": num_proc,
+            "context": context,
+            "initializer": initializer,
+            "initargs": initargs,
+        }
+        try:
+            yield pool
+        finally:
+            _nesting.pool_scope = outer
+            _release_pool(key)
+            if outer is None or _pool_key(
+                outer["context"], outer["num_proc"],
+                outer["initializer"], outer["initargs"],
+            ) != key:
+                _discard_pool(key)
+
+    @staticmethod
+    def is_enabled_for(level):
+        """Whether ``level`` would currently be logged; see :func:`is_enabled_for`."""
+        return is_enabled_for(level)
+
     @staticmethod
     def enable():
         _nesting.is_quiet = False
@@ -395,20 +3581,28 @@ class logmap(metaclass=_LogmapMeta):
             if inspect.iscoroutinefunction(func):
                 @functools.wraps(func)
                 async def wrapper(*args, **kwargs):
-                    desc = _format_call(func, args, kwargs) if log_args else func.__qualname__ + "()"
-                    async with logmap(desc, level=level) as lm:
+                    desc = (_format_call(func, args, kwargs)
+                            if log_args and is_enabled_for(level)
+                            else func.__qualname__ + "()")
+                    span = logmap(desc, level=level)
+                    span.profile_name = func.__qualname__ + "()"
+                    async with span as lm:
                         result = await func(*args, **kwargs)
                         if log_return and result is not None:
-                            lm.log(f">>> {_short_repr(result)}")
+                            lm.log(lambda: f">>> {_short_repr(result)}")
                         return result
                 return wrapper
             @functools.wraps(func)
             def wrapper(*args, **kwargs):
-                desc = _format_call(func, args, kwargs) if log_args else func.__qualname__ + "()"
-                with logmap(desc, level=level) as lm:
+                desc = (_format_call(func, args, kwargs)
+                        if log_args and is_enabled_for(level)
+                        else func.__qualname__ + "()")
+                span = logmap(desc, level=level)
+                span.profile_name = func.__qualname__ + "()"
+                with span as lm:
                     result = func(*args, **kwargs)
                     if log_return and result is not None:
-                        lm.log(f">>> {_short_repr(result)}")
+                        lm.log(lambda: f">>> {_short_repr(result)}")
                     return result
             return wrapper
         if _func is not None:
@@ -438,12 +3632,19 @@ class logmap(metaclass=_LogmapMeta):
         self.bottom_char = BOTTOM_CHAR
         self.last_lap = None
         self.pbar = None
+        self._desc_drawn = 0.0
         self.num_proc = None
         self.precision = precision
         self.iterated_num = False
         self.num = 0
+        # Name under which logmap.profile() aggregates this span
+        self.profile_name = name
+        self._profile_frame = None
+        self._trace_lane = None
+        # MapStats of the latest imap/map/run on this span
+        self.last_map_stats = None
 
-    # -- is_quiet (instance-level, delegates to thread-local) -----------------
+    # -- is_quiet (instance-level, delegates to the current context) ---------
 
     @property
     def is_quiet(self):
@@ -455,34 +3656,78 @@ class logmap(metaclass=_LogmapMeta):
 
     # -- log ------------------------------------------------------------------
 
-    def log(self, msg, pref=None, inner_pref=True, level=None, linelim=None):
+    def log(self, msg, *args, pref=None, inner_pref=True, level=None, linelim=None,
+            every=None, max_per_second=None, sample=None):
+        """Log ``msg`` at the current depth (or onto the active progress bar).
+
+        Only a tqdm bar takes messages as its description. Where progress is
+        reported as log lines, as on a non-TTY sink, they are written out.
+
+        Formatting is deferred until the record is known to be emitted:
+        ``args`` are %-interpolated stdlib-style (``lm.debug("x=%s", x)``) and
+        ``msg`` may be a zero-argument callable returning the message.
+
+        ``every``, ``max_per_second`` and ``sample`` thin out a noisy call
+        site (the source line calling ``log`` or a level helper): keep only
+        every Nth call, at most R calls a second, or a random fraction of
+        calls. They are checked before the message is built.
+        """
         if _nesting.is_quiet or not msg:
             return
-        msg = padmin(msg, linelim) if linelim else msg
-        if self.pbar is None:
+        level = level or self.level
+        if _level_int(level) < _min_level:
+            return
+        if ((every or max_per_second is not None or sample is not None)
+                and not _site_allows(every, max_per_second, sample)):
+            return
+        on_bar = self.pbar is not None and not isinstance(self.pbar, _ProgressReporter)
+        if not on_bar:
             prefix = (self.inner_pref if inner_pref else self.pref) if pref is None else pref
+            if _dedup and _is_repeat((level, self.num, self.task_name, prefix, msg, args, linelim),
+                                     prefix, level, self.num, self.task_name):
+                return
+        msg = _render_msg(msg, args)
+        if not msg:
+            return
+        msg = padmin(msg, linelim) if linelim else msg
+        if not on_bar:
             _emit(
                 f"{prefix}{msg}",
-                level=level or self.level,
+                level=level,
                 extra={"depth": self.num, "task": self.task_name, "msg": msg},
             )
         else:
-            self.set_progress_desc(msg)
+            self.set_progress_desc(msg, level=level)
 
-    def warning(self, *a, **kw):
-        return self.log(*a, **{**kw, "level": "warning"})
+    def warning(self, msg, *args, **kw):
+        if _min_level > LEVELS["WARNING"] or _nesting.is_quiet:
+            return
+        kw["level"] = "WARNING"
+        return self.log(msg, *args, **kw)
 
-    def trace(self, *a, **kw):
-        return self.log(*a, **{**kw, "level": "trace"})
+    def trace(self, msg, *args, **kw):
+        if _min_level > LEVELS["TRACE"] or _nesting.is_quiet:
+            return
+        kw["level"] = "TRACE"
+        return self.log(msg, *args, **kw)
 
-    def error(self, *a, **kw):
-        return self.log(*a, **{**kw, "level": "error"})
+    def error(self, msg, *args, **kw):
+        if _min_level > LEVELS["ERROR"] or _nesting.is_quiet:
+            return
+        kw["level"] = "ERROR"
+        return self.log(msg, *args, **kw)
 
-    def info(self, *a, **kw):
-        return self.log(*a, **{**kw, "level": "info"})
+    def info(self, msg, *args, **kw):
+        if _min_level > LEVELS["INFO"] or _nesting.is_quiet:
+            return
+        kw["level"] = "INFO"
+        return self.log(msg, *args, **kw)
 
-    def debug(self, *a, **kw):
-        return self.log(*a, **{**kw, "level": "debug"})
+    def debug(self, msg, *args, **kw):
+        if _min_level > LEVELS["DEBUG"] or _nesting.is_quiet:
+            return
+        kw["level"] = "DEBUG"
+        return self.log(msg, *args, **kw)
 
     # -- iteration ------------------------------------------------------------
 
@@ -497,24 +3742,38 @@ class logmap(metaclass=_LogmapMeta):
         shuffle=False,
         **kwargs,
     ):
+        self.pbar = self._progress_bar(
+            shuffled(iterator) if shuffle else iterator,
+            desc=desc,
+            pref=pref,
+            position=position,
+            total=total,
+            progress=progress,
+            **kwargs,
+        )
+        yield from self.pbar
+        self.pbar.close()
+        self.pbar = None
+
+    def _progress_bar(self, iterable=None, desc=None, pref=None, position=0,
+                      total=None, progress=True, **kwargs):
         bar_format = "%s{l_bar}%s{bar}%s{r_bar}" % (
             LEVEL_COLORS.get(self.level, ""),
             COLORS["light-cyan"],
             COLORS["light-cyan"],
         )
-        desc = f'{self.inner_pref if pref is None else pref}{desc if desc is not None else "iterating"}'
-        self.pbar = tqdm(
-            shuffled(iterator) if shuffle else iterator,
-            desc=desc,
+        return _progress_for(
+            iterable,
+            desc=desc if desc is not None else "iterating",
+            prefix=self.inner_pref if pref is None else pref,
             position=position,
             total=total,
             bar_format=bar_format,
             disable=not progress or _nesting.is_quiet,
+            span=self,
+            level=self.level,
             **kwargs,
         )
-        yield from self.pbar
-        self.pbar.close()
-        self.pbar = None
 
     def progress(self, iterable, desc="iterating", **kwargs):
         """Iterate with a progress bar at the current nesting depth.
@@ -537,35 +3796,47 @@ class logmap(metaclass=_LogmapMeta):
         num_proc=None,
         desc=None,
         shuffle=False,
-        context=CONTEXT,
+        context=None,
         progress=True,
+        backend=None,
         **pmap_kwargs,
     ):
-        items = list(objs)
-        if lim is not None:
-            items = items[:lim]
+        if shuffle and pmap_kwargs.get("journal") is not None:
+            raise ValueError("journal can't be combined with shuffle=True: "
+                             "a resumed run would draw a different order")
+        total = _input_total(objs, lim, pmap_kwargs.pop("total", None))
         if desc is None:
-            desc = f"mapping {func.__name__} to {len(items)} objects"
+            desc = (f"mapping {func.__name__} to {total} objects"
+                    if total is not None else f"mapping {func.__name__}")
 
-        if num_proc is None:
-            num_proc = max(1, mp.cpu_count() // 2)
-        num_proc = max(1, min(num_proc, mp.cpu_count()))
+        num_proc = _resolve_num_proc(
+            _UNSET if num_proc is None else num_proc,
+            max(1, mp.cpu_count() // 2),
+            clamp=backend != "thread",
+        )
         if num_proc > 1:
             desc = f"{desc} [{num_proc}x]"
         self.num_proc = num_proc
+        self.last_map_stats = pmap_kwargs.setdefault("stats", MapStats())
+        if lim is not None:
+            # Truncate before any shuffling, so lim picks the first items.
+            objs, lim = islice(objs, lim), None
         iterr = pmap_iter(
             func,
-            items,
+            objs,
             args=args,
             kwargs=kwargs,
+            lim=lim,
             num_proc=num_proc,
             desc=None,
             shuffle=shuffle,
             context=context,
             progress=False,
+            backend=backend,
+            span=self,
             **pmap_kwargs,
         )
-        yield from self.iter_progress(iterr, desc=desc, total=len(items), progress=progress)
+        yield from self.iter_progress(iterr, desc=desc, total=total, progress=progress)
 
     def map(self, *a, **kw):
         return list(self.imap(*a, **kw))
@@ -573,6 +3844,74 @@ class logmap(metaclass=_LogmapMeta):
     def run(self, *a, **kw):
         deque(self.imap(*a, **kw), maxlen=0)
 
+    async def aimap(
+        self,
+        func,
+        objs,
+        args=(),
+        kwargs=None,
+        concurrency=DEFAULT_CONCURRENCY,
+        lim=None,
+        desc=None,
+        progress=True,
+        with_index=False,
+    ):
+        """Async-iterate ``await func(obj, *args, **kwargs)`` as calls complete.
+
+        At most ``concurrency`` calls run at once, each in its own task;
+        ``objs`` is read lazily. Tasks start from a copy of the current
+        context, so spans they open nest under this one without disturbing
+        each other's depth. ``with_index=True`` yields ``(index, result)``
+        pairs. If a call raises, the others are cancelled and the error
+        propagates.
+        """
+        kwargs = kwargs or {}
+        total = _input_total(objs, lim)
+        if desc is None:
+            desc = (f"mapping {func.__name__} to {total} objects"
+                    if total is not None else f"mapping {func.__name__}")
+        if concurrency > 1:
+            desc = f"{desc} [{concurrency}x]"
+        items = enumerate(iter(objs) if lim is None else islice(objs, lim))
+
+        async def call(i, obj):
+            return i, await func(obj, *args, **kwargs)
+
+        done = asyncio.Queue()
+        pending = set()
+
+        def launch():
+            for i, obj in islice(items, concurrency - len(pending)):
+                task = asyncio.ensure_future(call(i, obj))
+                task.add_done_callback(done.put_nowait)
+                pending.add(task)
+
+        self.pbar = self._progress_bar(desc=desc, total=total, progress=progress)
+        try:
+            launch()
+            while pending:
+                task = await done.get()
+                pending.discard(task)
+                i, result = task.result()
+                launch()
+                self.pbar.update()
+                yield (i, result) if with_index else result
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            self.pbar.close()
+            self.pbar = None
+
+    async def amap(self, func, objs, *a, **kw):
+        """Like :meth:`aimap`, but returns every result in input order."""
+        kw["with_index"] = True
+        out = {}
+        async for i, result in self.aimap(func, objs, *a, **kw):
+            out[i] = result
+        return [out[i] for i in sorted(out)]
+
     # -- misc -----------------------------------------------------------------
 
     def nap(self):
@@ -581,10 +3920,21 @@ class logmap(metaclass=_LogmapMeta):
         time.sleep(naptime)
         return naptime
 
-    def set_progress_desc(self, desc, pref=None, **kwargs):
+    def set_progress_desc(self, desc, pref=None, level=None, **kwargs):
+        if not desc or _nesting.is_quiet:
+            return
+        if _level_int(level or self.level) < _min_level:
+            return
+        desc = _render_msg(desc, ())
         if desc:
-            desc = f'{self.inner_pref if pref is None else pref}{desc if desc is not None else ""}'
-            self.pbar.set_description(desc, **kwargs)
+            desc = f'{self.inner_pref if pref is None else pref}{desc}'
+            # Redraw at most every _progress_refresh seconds; the bar shows
+            # the latest description on its next update either way.
+            self.pbar.set_description(desc, refresh=False)
+            now = time.monotonic()
+            if kwargs.get("refresh", True) and now - self._desc_drawn >= _progress_refresh:
+                self._desc_drawn = now
+                self.pbar.refresh()
 
     # -- timing ---------------------------------------------------------------
 
@@ -645,12 +3995,16 @@ class logmap(metaclass=_LogmapMeta):
             return self
         self.started = self.last_lap = time.time()
         self.ended = None
+        if _profiler is not None:
+            self._profile_frame = _profiler._enter(self.profile_name)
+        if _trace is not None:
+            self._trace_lane = (_trace, _trace.begin(self.task_name, self.level))
         if self.announce or not _nesting.num_logwatches:
             _nesting.num_logwatches += 1
             self.iterated_num = True
         self.num = _nesting.num_logwatches
         if self.announce:
-            self.log(self.desc, inner_pref=False)
+            self.log(lambda: self.desc, inner_pref=False)
         return self
 
     def stop(self, exc_type=None, exc_value=None, traceback=None):
@@ -661,6 +4015,12 @@ class logmap(metaclass=_LogmapMeta):
         """
         if self.started is None or self.ended is not None:
             return
+        if self._profile_frame is not None:
+            frame, self._profile_frame = self._profile_frame, None
+            frame[0]._exit(frame)
+        if self._trace_lane is not None:
+            (trace, tid), self._trace_lane = self._trace_lane, None
+            trace.end(tid, f"{exc_type.__name__}: {exc_value}" if exc_type else None)
         if exc_type:
             _nesting.logwatch_id = 0
             _nesting.num_logwatches = 0
@@ -673,7 +4033,7 @@ class logmap(metaclass=_LogmapMeta):
             if (not self.min_seconds_logworthy
                     or self.duration >= self.min_seconds_logworthy):
                 if self.announce:
-                    self.log(self.desc, inner_pref=False)
+                    self.log(lambda: self.desc, inner_pref=False)
             if _nesting.num_logwatches == 0:
                 _nesting.logwatch_id = 0
 
@@ -702,3 +4062,9 @@ class logmap(metaclass=_LogmapMeta):
     @property
     def safety(self):
         return self.safespace()
+
+
+# Level helpers forward to log(); call-site limits look past them.
+_LEVEL_HELPERS = frozenset(
+    getattr(logmap, name).__code__ for name in ("trace", "debug", "info", "warning", "error")
+)
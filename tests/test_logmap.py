@@ -4,6 +4,7 @@ import io
 import json
 import logging
 import logging.handlers
+import os
 import platform
 import sys
 import threading
@@ -11,7 +12,7 @@ import time
 
 import pytest
 
-from logmap import VERTICAL_CHAR, configure, logmap, pmap, pmap_iter, pmap_run
+from logmap import MapStats, ResultCache, RotatingSink, VERTICAL_CHAR, configure, flush, logmap, pmap, pmap_iter, pmap_run
 
 
 # Module-level functions so they're picklable by multiprocess workers.
@@ -37,6 +38,133 @@ def _raise(x):
     raise RuntimeError("boom")
 
 
+def _pid(x):
+    import os
+    return os.getpid()
+
+
+def _touch_slowly(x, folder):
+    time.sleep(0.05)
+    if x == 3:
+        raise RuntimeError("boom")
+    open(os.path.join(folder, str(x)), "w").close()
+    return x
+
+
+def _slow_first(x):
+    if x == 0:
+        time.sleep(0.5)
+    return x
+
+
+_unpickle_count = 0
+
+
+class _CountsUnpickles:
+    """Payload that counts how often it is unpickled in the current process."""
+
+    def __init__(self, size=0):
+        self.data = b"x" * size
+
+    def __setstate__(self, state):
+        global _unpickle_count
+        _unpickle_count += 1
+        self.__dict__.update(state)
+
+
+def _report_unpickles(x, payload=None):
+    import os
+    return os.getpid(), _unpickle_count
+
+
+def _cached_calls(x):
+    import importlib
+    return list(importlib.import_module("logmap.logmap")._worker_calls)
+
+
+def _unpickled_once_per_worker(out):
+    """Each worker's unpickle count must not move during a single map."""
+    counts = {}
+    for pid, n in out:
+        counts.setdefault(pid, set()).add(n)
+    return all(len(ns) == 1 for ns in counts.values())
+
+
+def _describe_buffer(obj, extra=None):
+    return type(obj).__name__, len(obj), bytes(obj[:3]), extra is None or len(extra)
+
+
+def _echo(obj):
+    return obj
+
+
+def _array_info(arr):
+    return bool(arr.flags.owndata), float(arr.sum())
+
+
+def _double(arr):
+    return arr * 2
+
+
+def _shm_segments():
+    import os
+    return {n for n in os.listdir("/dev/shm") if n.startswith("psm_")}
+
+
+def _square_batch(xs, offset=0):
+    return [x * x + offset for x in xs]
+
+
+def _batch_lens(xs):
+    return [len(xs)] * len(xs)
+
+
+def _bad_batch(xs):
+    return xs[:-1]
+
+
+_init_value = None
+
+
+def _set_init_value(value):
+    global _init_value
+    _init_value = value
+
+
+def _get_init_value(x):
+    return _init_value
+
+
+def _logging_work(x):
+    with logmap(f"item {x}") as lm:
+        lm.log(f"working on {x}")
+        lm.info(f"info {x}")
+    return x
+
+
+def _append_lines(tag, n):
+    # Each line is longer than PIPE_BUF, so only O_APPEND + one write keeps it whole.
+    with logmap(f"writer {tag}") as lm:
+        for i in range(n):
+            lm.info(f"{tag}:{i:04d}:" + tag * 8000)
+
+
+_calls = []
+
+
+def _record_call(x, offset=0):
+    _calls.append(x)
+    return x + offset
+
+
+class _Scale:
+    def __init__(self, k):
+        self.k = k
+
+    def __call__(self, x):
+        return x * self.k
+
+
 class TestContextManager:
     def test_started_and_ended_set(self):
         with logmap("task") as lm:
@@ -213,6 +341,16 @@ class TestVersion:
         assert pkg.__version__
 
 
+@pytest.fixture
+def bar_progress():
+    """Draw tqdm bars even though the test's output isn't a terminal."""
+    configure(progress_style="bar")
+    try:
+        yield
+    finally:
+        configure(progress_style="auto")
+
+
 @pytest.fixture
 def captured_sink():
     """Route logmap output to a StringIO for the duration of the test."""
@@ -450,6 +588,54 @@ class TestColorizedOutput:
             configure(sink=sys.stderr)
 
 
+class TestCompiledFormat:
+    @pytest.mark.parametrize("fmt", [
+        "{color}{msg}{reset}{cyan} @ {time}{reset}",
+        "[{time}] {msg!r:>12} |{color}{{literal}}{reset}",
+        "{msg}",
+        "",
+    ])
+    @pytest.mark.parametrize("colorize", [False, True])
+    def test_matches_str_format(self, fmt, colorize):
+        from datetime import datetime
+        from logmap.logmap import _CYAN, _RESET, LEVEL_COLORS, _compile_format
+        t = 1_700_000_000.123456
+        n = datetime.fromtimestamp(t)
+        ts = n.strftime("%Y-%m-%d %H:%M:%S") + f",{n.microsecond // 1000:03d}"
+        if colorize:
+            expected = fmt.format(color=LEVEL_COLORS["WARNING"], msg=42,
+                                  reset=_RESET, cyan=_CYAN, time=ts)
+        else:
+            expected = fmt.format(color="", msg=42, reset="", cyan="", time=ts)
+        assert _compile_format(fmt, colorize)(t, "WARNING", 42) == expected
+
+    def test_timestamp_cache_crosses_seconds(self):
+        from datetime import datetime
+        from logmap.logmap import _timestamp
+        base = 1_700_000_000
+        for t in (base + 0.998, base + 0.999, base + 1.0, base + 1.001, base + 0.5, base + 61.25):
+            n = datetime.fromtimestamp(t)
+            assert _timestamp(t) == n.strftime("%Y-%m-%d %H:%M:%S") + f",{n.microsecond // 1000:03d}"
+
+    def test_custom_format_applied(self, captured_sink):
+        from logmap.logmap import DEFAULT_FORMAT
+        configure(sink=captured_sink, format="<{msg}>")
+        try:
+            with logmap("fmt") as lm:
+                lm.log("hello")
+            assert captured_sink.getvalue().splitlines()[1] == "<  hello>"
+        finally:
+            configure(format=DEFAULT_FORMAT)
+
+    def test_unknown_placeholder_rejected(self, captured_sink):
+        configure(sink=captured_sink)
+        with pytest.raises(ValueError, match="level"):
+            configure(format="{level} {msg}")
+        with logmap("still-default") as lm:
+            lm.log("ok")
+        assert " @ " in captured_sink.getvalue()
+
+
 class TestConfigureFileSwitch:
     def test_reconfigure_closes_previous_file(self, tmp_path, captured_sink):
         file1 = tmp_path / "a.log"
@@ -465,6 +651,304 @@ class TestConfigureFileSwitch:
         assert "second" in file2.read_text()
 
 
+class TestMultipleSinks:
+    def test_per_sink_level_format_and_mode(self, tmp_path, captured_sink):
+        term = io.StringIO()
+        debug_path = tmp_path / "debug.jsonl"
+        error_path = tmp_path / "errors.log"
+        configure(sinks=[
+            {"sink": term, "level": "INFO", "colorize": True},
+            {"sink": str(debug_path), "level": "DEBUG", "structured": True},
+            {"sink": str(error_path), "level": "ERROR", "format": "{msg}"},
+        ])
+        try:
+            with logmap("fanout") as lm:
+                lm.debug("detail")
+                lm.info("progress")
+                lm.error("failure")
+        finally:
+            configure(sink=captured_sink)
+        assert "detail" not in term.getvalue()
+        assert "progress" in term.getvalue()
+        assert "\033[" in term.getvalue()
+        records = [json.loads(l) for l in debug_path.read_text().splitlines()]
+        assert [r["msg"] for r in records][1:4] == ["detail", "progress", "failure"]
+        assert error_path.read_text().splitlines() == ["  failure"]
+
+    def test_shared_format_rendered_once(self):
+        from logmap.logmap import LEVELS
+        a, b = io.StringIO(), io.StringIO()
+        configure(sinks=[a, {"sink": b, "level": "WARNING"}])
+        try:
+            from logmap.logmap import _routes
+            (fmt, streams), = _routes[LEVELS["ERROR"]]
+            assert streams == (a, b)
+            (fmt, streams), = _routes[LEVELS["INFO"]]
+            assert streams == (a,)
+        finally:
+            configure(sink=sys.stderr)
+
+    def test_min_level_is_lowest_sink_level(self, captured_sink):
+        import importlib
+        _mod = importlib.import_module("logmap.logmap")
+        quiet, chatty = io.StringIO(), io.StringIO()
+        configure(level="ERROR", sinks=[quiet, {"sink": chatty, "level": "DEBUG"}])
+        try:
+            assert _mod._min_level == _mod.LEVELS["DEBUG"]
+            assert _mod.is_enabled_for("DEBUG")
+            with logmap("levels") as lm:
+                lm.debug("fine print")
+                lm.error("alarm")
+            assert "fine print" not in quiet.getvalue()
+            assert "alarm" in quiet.getvalue()
+            assert "fine print" in chatty.getvalue()
+            configure(level="WARNING")  # only the sink without its own level changes
+            assert _mod._min_level == _mod.LEVELS["DEBUG"]
+            configure(sinks=[quiet])
+            assert _mod._min_level == _mod.LEVELS["WARNING"]
+        finally:
+            configure(sink=captured_sink, level="DEBUG")
+
+    def test_defaults_follow_configure(self, captured_sink):
+        a, b = io.StringIO(), io.StringIO()
+        configure(sinks=[a, {"sink": b, "structured": False}])
+        try:
+            configure(structured=True)
+            with logmap("inherit") as lm:
+                lm.info("both")
+            json.loads(a.getvalue().splitlines()[1])
+            with pytest.raises(json.JSONDecodeError):
+                json.loads(b.getvalue().splitlines()[1])
+        finally:
+            configure(sink=captured_sink, structured=False)
+
+    def test_path_sinks_closed_on_reconfigure(self, tmp_path, captured_sink):
+        import importlib
+        _mod = importlib.import_module("logmap.logmap")
+        configure(sinks=[str(tmp_path / "a.log"), str(tmp_path / "b.log")])
+        files = [out.stream for out in _mod._outputs]
+        configure(sink=captured_sink)
+        assert all(f._fd is None for f in files)
+
+    def test_invalid_sinks(self, captured_sink):
+        with pytest.raises(ValueError, match="unknown sink options"):
+            configure(sinks=[{"sink": captured_sink, "colour": True}])
+        with pytest.raises(ValueError, match="either sink or sinks"):
+            configure(sink=captured_sink, sinks=[captured_sink])
+        with pytest.raises(ValueError, match="placeholder"):
+            configure(sinks=[{"sink": captured_sink, "format": "{when}"}])
+        with logmap("unchanged") as lm:
+            lm.info("still here")
+        assert "still here" in captured_sink.getvalue()
+
+
+class TestBufferedFileSink:
+    def test_default_writes_through(self, tmp_path, captured_sink):
+        path = tmp_path / "run.log"
+        configure(sink=str(path))
+        with logmap("through") as lm:
+            lm.info("now")
+        assert "now" in path.read_text()
+        configure(sink=captured_sink)
+
+    def test_buffers_until_flush(self, tmp_path, captured_sink):
+        path = tmp_path / "run.log"
+        configure(sink=str(path), buffer_size=1 << 20, flush_interval=0)
+        try:
+            with logmap("buffered") as lm:
+                lm.info("held back")
+            assert path.read_text() == ""
+            flush()
+            assert "held back" in path.read_text()
+        finally:
+            configure(sink=captured_sink)
+
+    def test_buffer_size_triggers_write(self, tmp_path, captured_sink):
+        path = tmp_path / "run.log"
+        configure(sink=str(path), buffer_size=200, flush_interval=0)
+        try:
+            with logmap("sized") as lm:
+                for i in range(50):
+                    lm.info(f"line {i}")
+                written = path.read_text()
+                assert "line 0" in written
+                assert "line 49" not in written
+            flush()
+            assert "line 49" in path.read_text()
+        finally:
+            configure(sink=captured_sink)
+
+    def test_error_flushes_immediately(self, tmp_path, captured_sink):
+        path = tmp_path / "run.log"
+        configure(sink=str(path), buffer_size=1 << 20, flush_interval=0)
+        try:
+            with logmap("errors") as lm:
+                lm.info("before")
+                lm.error("boom")
+                assert "before" in path.read_text()
+                assert "boom" in path.read_text()
+        finally:
+            configure(sink=captured_sink)
+
+    def test_timer_flushes_idle_buffer(self, tmp_path, captured_sink):
+        path = tmp_path / "run.log"
+        configure(sink=str(path), buffer_size=1 << 20, flush_interval=0.05)
+        try:
+            with logmap("idle") as lm:
+                lm.info("eventually")
+            deadline = time.monotonic() + 5
+            while "eventually" not in path.read_text() and time.monotonic() < deadline:
+                time.sleep(0.02)
+            assert "eventually" in path.read_text()
+        finally:
+            configure(sink=captured_sink)
+
+    def test_flushed_at_exit(self, tmp_path):
+        import subprocess
+        path = tmp_path / "run.log"
+        code = (
+            "from logmap import configure, logmap\n"
+            f"configure(sink={str(path)!r}, buffer_size=1 << 20, flush_interval=0)\n"
+            "with logmap('exiting') as lm:\n"
+            "    lm.info('last words')\n"
+        )
+        subprocess.run([sys.executable, "-c", code], check=True,
+                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        assert "last words" in path.read_text()
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+    @pytest.mark.parametrize("buffer_size", [0, 50_000])
+    def test_processes_share_file_without_tearing(self, tmp_path, captured_sink, buffer_size):
+        import multiprocessing as mp
+        path = tmp_path / "shared.log"
+        configure(sink=str(path), buffer_size=buffer_size or None, flush_interval=0)
+        try:
+            ctx = mp.get_context("fork")
+            procs = [ctx.Process(target=_append_lines, args=(tag, 100)) for tag in "abcd"]
+            for p in procs:
+                p.start()
+            _append_lines("p", 100)
+            for p in procs:
+                p.join()
+                assert p.exitcode == 0
+            flush()
+        finally:
+            configure(sink=captured_sink)
+        seen = {}
+        for line in path.read_text().splitlines():
+            if ":" not in line or line.lstrip().startswith(("⎾", "⎿")):
+                continue
+            tag, i, body = line.strip().split(" @ ")[0].split(":", 2)
+            assert body == tag * 8000
+            seen.setdefault(tag, []).append(int(i))
+        assert seen == {tag: list(range(100)) for tag in "abcdp"}
+
+    def test_requires_path_sink(self, captured_sink):
+        with pytest.raises(ValueError, match="file path"):
+            configure(sink=captured_sink, buffer_size=4096)
+
+
+def _read_segments(sink):
+    import gzip
+    text = ""
+    for seg in sink.segments():
+        opener = gzip.open if seg.endswith(".gz") else open
+        with opener(seg, "rt", encoding="utf-8") as f:
+            text += f.read()
+    with open(sink.path, encoding="utf-8") as f:
+        return text + f.read()
+
+
+class TestRotatingSink:
+    def test_size_rotation_keeps_every_line(self, tmp_path, captured_sink):
+        sink = RotatingSink(str(tmp_path / "app.log"), max_bytes=500, backups=0)
+        configure(sink=sink)
+        try:
+            with logmap("rotate") as lm:
+                for i in range(100):
+                    lm.info(f"line {i:03d}")
+        finally:
+            configure(sink=captured_sink)
+            sink.close()
+        segments = sink.segments()
+        assert len(segments) > 5
+        assert all(seg.endswith(".gz") for seg in segments)
+        assert all(os.path.getsize(seg) > 0 for seg in segments)
+        lines = [l for l in _read_segments(sink).splitlines() if "line " in l]
+        assert [l.split("line ")[1][:3] for l in lines] == [f"{i:03d}" for i in range(100)]
+
+    def test_segments_stay_under_max_bytes(self, tmp_path):
+        sink = RotatingSink(str(tmp_path / "app.log"), max_bytes=100, backups=0, compress=False)
+        for i in range(50):
+            sink.write(f"record {i:02d}\n")
+        sink.close()
+        for seg in sink.segments():
+            assert os.path.getsize(seg) <= 100
+            with open(seg) as f:
+                assert f.read().endswith("\n")
+
+    def test_backups_pruned(self, tmp_path):
+        sink = RotatingSink(str(tmp_path / "app.log"), max_bytes=10, backups=3)
+        for i in range(20):
+            sink.write(f"entry {i:02d}\n")
+        sink.close()
+        segments = sink.segments()
+        assert len(segments) == 3
+        assert "entry 18" in _read_segments(sink)
+        assert "entry 00" not in _read_segments(sink)
+
+    def test_names_sort_after_pruning(self, tmp_path, monkeypatch):
+        import datetime
+        import importlib
+        mod = importlib.import_module("logmap.logmap")
+
+        class FrozenClock(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return cls(2024, 1, 2, 3, 4, 5)
+
+        monkeypatch.setattr(mod, "datetime", FrozenClock)
+        sink = RotatingSink(str(tmp_path / "app.log"), max_bytes=10, backups=2, compress=False)
+        for i in range(6):
+            sink.write(f"entry {i:02d}\n")
+            sink.wait()
+        sink.close()
+        segments = sink.segments()
+        assert [os.path.basename(s) for s in segments] == [
+            "app.log.20240102-030405.3", "app.log.20240102-030405.4",
+        ]
+        with open(segments[-1]) as f:
+            assert f.read() == "entry 04\n"
+
+    def test_time_rotation(self, tmp_path):
+        sink = RotatingSink(str(tmp_path / "app.log"), when="h", compress=False)
+        sink.write("first hour\n")
+        assert sink.segments() == []
+        sink._rollover_at = time.time() - 1
+        sink.write("next hour\n")
+        sink.close()
+        (segment,) = sink.segments()
+        with open(segment) as f:
+            assert f.read() == "first hour\n"
+        with open(sink.path) as f:
+            assert f.read() == "next hour\n"
+        assert sink._rollover_at > time.time()
+
+    def test_buffered_rotation(self, tmp_path):
+        sink = RotatingSink(str(tmp_path / "app.log"), max_bytes=200, backups=0,
+                            buffer_size=120, flush_interval=0)
+        for i in range(40):
+            sink.write(f"buffered {i:02d}\n")
+        sink.close()
+        assert len(sink.segments()) >= 3
+        text = _read_segments(sink)
+        assert [int(l.split()[1]) for l in text.splitlines()] == list(range(40))
+
+    def test_invalid_when(self, tmp_path):
+        with pytest.raises(ValueError, match="when"):
+            RotatingSink(str(tmp_path / "app.log"), when="fortnight")
+
+
 class TestPadmin:
     def test_pads_short_string(self):
         from logmap.logmap import padmin
@@ -598,6 +1082,44 @@ class TestStructuredOutput:
         finally:
             configure(structured=False)
 
+    @pytest.mark.parametrize("msg, extra", [
+        ("plain", {"depth": 2, "task": "outer", "msg": "plain"}),
+        ('quote " slash \\ tab \t ü \u2603 \ud800', {"depth": 0, "task": 'a"b', "msg": "x\ny"}),
+        ("no task", {"depth": 1, "task": None, "msg": "no task"}),
+        ("forwarded", {"depth": 1, "task": "w", "msg": "forwarded", "worker": 4242}),
+        ([1, {"a": 2.5}], None),
+        (object(), {"depth": 0, "task": None, "msg": object()}),
+    ])
+    def test_encoder_matches_json_dumps(self, msg, extra):
+        from datetime import datetime
+        from logmap.logmap import _json_line
+        for t in (1_700_000_000.0, 1_700_000_000.123456, time.time()):
+            out = {"ts": datetime.fromtimestamp(t).isoformat(), "level": "INFO", "msg": msg}
+            if extra:
+                out.update(extra)
+            expected = json.loads(json.dumps(out, default=str))
+            assert json.loads(_json_line(t, "INFO", msg, extra)) == expected
+
+    def test_ts_format_ns(self, captured_sink):
+        configure(sink=captured_sink, structured=True, ts_format="ns")
+        try:
+            before = time.time_ns()
+            with logmap("ns") as lm:
+                lm.info("stamped")
+            after = time.time_ns()
+            records = [json.loads(l) for l in captured_sink.getvalue().splitlines()]
+            assert [r["msg"] for r in records][1] == "stamped"
+            for r in records:
+                assert isinstance(r["ts"], int)
+                assert before - 1000 <= r["ts"] <= after + 1000
+                assert set(r) == {"ts", "level", "msg", "depth", "task"}
+        finally:
+            configure(structured=False, ts_format="iso")
+
+    def test_ts_format_rejects_unknown(self):
+        with pytest.raises(ValueError, match="ts_format"):
+            configure(ts_format="epoch")
+
     def test_structured_off_by_default(self, captured_sink):
         with logmap("plain") as lm:
             lm.log("not json")
@@ -768,3 +1290,1517 @@ class TestAsyncFnDecorator:
 
         with pytest.raises(RuntimeError, match="async boom"):
             asyncio.run(explode())
+
+
+class _SlowSink(io.StringIO):
+    """StringIO whose writes take a while, to expose blocking behaviour."""
+
+    def __init__(self, delay=0.05):
+        super().__init__()
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, s):
+        time.sleep(self.delay)
+        self.writes += 1
+        return super().write(s)
+
+
+class TestAsyncWriter:
+    def test_async_output_arrives_after_flush(self, captured_sink):
+        configure(sink=captured_sink, async_=True)
+        try:
+            with logmap("async-sink") as lm:
+                lm.log("queued line")
+            logmap.flush()
+            output = captured_sink.getvalue()
+            assert "async-sink" in output
+            assert "queued line" in output
+        finally:
+            configure(async_=False)
+
+    def test_caller_does_not_wait_for_slow_sink(self):
+        sink = _SlowSink(delay=0.2)
+        configure(sink=sink, async_=True)
+        try:
+            t0 = time.time()
+            lm = logmap("fast")
+            for i in range(5):
+                lm.log(f"line {i}")
+            assert time.time() - t0 < 0.2
+        finally:
+            configure(sink=sys.stderr, async_=False)
+        assert all(f"line {i}" in sink.getvalue() for i in range(5))
+
+    def test_batches_writes(self):
+        sink = _SlowSink(delay=0.05)
+        configure(sink=sink, async_=True)
+        try:
+            lm = logmap("batched")
+            for i in range(50):
+                lm.log(f"line {i}")
+            logmap.flush()
+        finally:
+            configure(sink=sys.stderr, async_=False)
+        assert sink.getvalue().count("line ") == 50
+        assert sink.writes < 50
+
+    def test_drop_newest_counts_dropped(self):
+        sink = _SlowSink(delay=0.2)
+        configure(sink=sink, async_=True, queue_size=2, overflow="drop_newest")
+        try:
+            lm = logmap("overflow")
+            for i in range(20):
+                lm.log(f"line {i}")
+            assert logmap.dropped > 0
+            logmap.flush()
+            assert "line 0" in sink.getvalue()
+            assert "line 19" not in sink.getvalue()
+        finally:
+            configure(sink=sys.stderr, async_=False)
+
+    def test_drop_oldest_keeps_latest(self):
+        sink = _SlowSink(delay=0.2)
+        configure(sink=sink, async_=True, queue_size=2, overflow="drop_oldest")
+        try:
+            lm = logmap("overflow")
+            for i in range(20):
+                lm.log(f"line {i}")
+            assert logmap.dropped > 0
+            logmap.flush()
+            assert "line 19" in sink.getvalue()
+        finally:
+            configure(sink=sys.stderr, async_=False)
+
+    def test_reconfigure_flushes_queue(self, captured_sink):
+        configure(sink=captured_sink, async_=True)
+        logmap("before switch").log("pending")
+        configure(async_=False)
+        assert "pending" in captured_sink.getvalue()
+
+    def test_invalid_overflow_policy(self):
+        with pytest.raises(ValueError):
+            configure(async_=True, overflow="explode")
+        configure(async_=False)
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+    def test_child_forked_mid_write_can_log(self):
+        sink = _SlowSink(delay=0.5)
+        configure(sink=sink, async_=True)
+        try:
+            logmap("parent").log("slow line")
+            time.sleep(0.1)  # the writer thread is now inside sink.write
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    sink.delay = 0
+                    logmap("child").log("from child")
+                    configure(async_=False)
+                finally:
+                    os._exit(0)
+            deadline = time.monotonic() + 5
+            while not os.waitpid(pid, os.WNOHANG)[0]:
+                if time.monotonic() > deadline:
+                    os.kill(pid, 9)
+                    os.waitpid(pid, 0)
+                    pytest.fail("forked child hung on the log lock")
+                time.sleep(0.02)
+        finally:
+            configure(sink=sys.stderr, async_=False)
+
+
+class TestDeferredFormatting:
+    def test_percent_args_are_interpolated(self, captured_sink):
+        with logmap("t") as lm:
+            lm.debug("x=%s y=%d", "abc", 42)
+        assert "x=abc y=42" in captured_sink.getvalue()
+
+    def test_bad_format_does_not_raise(self, captured_sink):
+        with logmap("t") as lm:
+            lm.log("progress: 100%", 3)
+            lm.info("rows %d", "abc")
+        output = captured_sink.getvalue()
+        assert "progress: 100% (3,)" in output
+        assert "rows %d ('abc',)" in output
+
+    def test_callable_message_is_resolved(self, captured_sink):
+        with logmap("t") as lm:
+            lm.info(lambda: "computed later")
+        assert "computed later" in captured_sink.getvalue()
+
+    def test_filtered_level_skips_formatting(self, captured_sink):
+        calls = []
+
+        class Expensive:
+            def __str__(self):
+                calls.append(1)
+                return "expensive"
+
+        def build():
+            calls.append(1)
+            return "built"
+
+        configure(sink=captured_sink, level="INFO")
+        try:
+            with logmap("t") as lm:
+                lm.debug("value=%s", Expensive())
+                lm.debug(build)
+                lm.trace(build)
+        finally:
+            configure(level="DEBUG")
+        assert calls == []
+        assert "expensive" not in captured_sink.getvalue()
+
+    def test_quiet_skips_formatting(self, captured_sink):
+        calls = []
+        with logmap.quiet():
+            logmap("t").warning(lambda: calls.append(1) or "x")
+        assert calls == []
+
+    def test_is_enabled_for(self):
+        configure(level="INFO")
+        try:
+            assert logmap.is_enabled_for("INFO")
+            assert logmap.is_enabled_for("error")
+            assert logmap.is_enabled_for(50)
+            assert not logmap.is_enabled_for("DEBUG")
+            with logmap.quiet():
+                assert not logmap.is_enabled_for("ERROR")
+        finally:
+            configure(level="DEBUG")
+
+    def test_progress_desc_respects_level(self, captured_sink, bar_progress):
+        configure(sink=captured_sink, level="INFO")
+        try:
+            with logmap("t") as lm:
+                for _ in lm.progress([1], file=io.StringIO()):
+                    lm.debug("hidden desc")
+                    assert "hidden desc" not in lm.pbar.desc
+                    lm.info("shown desc")
+                    assert "shown desc" in lm.pbar.desc
+        finally:
+            configure(level="DEBUG")
+
+
+class TestProgressReporting:
+    def test_reporter_for_non_tty_sink(self, captured_sink):
+        from logmap.logmap import _ProgressReporter
+        with logmap("r") as lm:
+            for _ in lm.progress(range(2)):
+                assert isinstance(lm.pbar, _ProgressReporter)
+
+    def test_bar_for_tty_sink(self):
+        from tqdm.auto import tqdm
+        buf = io.StringIO()
+        buf.isatty = lambda: True
+        configure(sink=buf)
+        try:
+            with logmap("b") as lm:
+                for _ in lm.progress(range(2)):
+                    assert isinstance(lm.pbar, tqdm)
+        finally:
+            configure(sink=sys.stderr)
+
+    def test_periodic_lines_at_loop_depth(self, captured_sink):
+        configure(structured=True, progress_interval=0)
+        try:
+            with logmap("outer"):
+                with logmap("inner") as lm:
+                    for _ in lm.progress(range(4), desc="rows"):
+                        pass
+                    depth = lm.num
+        finally:
+            configure(structured=False, progress_interval=10.0)
+        records = [json.loads(l) for l in captured_sink.getvalue().splitlines()]
+        lines = [r for r in records if r["msg"].startswith("rows: ")]
+        assert [r["msg"].split(", ")[0] for r in lines] == [
+            "rows: 1/4 (25%)", "rows: 2/4 (50%)", "rows: 3/4 (75%)", "rows: 4/4 (100%)",
+            "rows: 4/4 (100%)",
+        ]
+        assert "ETA" in lines[0]["msg"]
+        assert "/s" in lines[0]["msg"]
+        assert "done in" in lines[-1]["msg"]
+        assert all(r["depth"] == depth and r["task"] == "inner" for r in lines)
+
+    def test_short_loops_stay_silent(self, captured_sink):
+        with logmap("quick") as lm:
+            for _ in lm.progress(range(100), desc="fast"):
+                pass
+        assert "fast" not in captured_sink.getvalue()
+
+    def test_quiet_suppresses_reports(self, captured_sink):
+        configure(progress_interval=0)
+        try:
+            with logmap.quiet():
+                with logmap("q") as lm:
+                    for _ in lm.progress(range(3), desc="hush"):
+                        pass
+        finally:
+            configure(progress_interval=10.0)
+        assert "hush" not in captured_sink.getvalue()
+
+    def test_logs_in_loop_are_written(self, captured_sink):
+        configure(progress_interval=0)
+        try:
+            with logmap("d") as lm:
+                for i in lm.progress(range(2), desc="start"):
+                    lm.log(f"item {i}")
+        finally:
+            configure(progress_interval=10.0)
+        output = captured_sink.getvalue()
+        assert "item 0" in output and "item 1" in output
+        assert "start: 2/2" in output
+
+    def test_warning_in_short_loop_is_written(self, captured_sink):
+        with logmap("w") as lm:
+            for i in lm.progress(range(3)):
+                if i == 1:
+                    lm.warning("odd row")
+        assert "odd row" in captured_sink.getvalue()
+
+    def test_description_redraws_are_throttled(self, bar_progress, captured_sink):
+        configure(progress_refresh=60)
+        try:
+            with logmap("t") as lm:
+                for _ in lm.progress([1], file=io.StringIO()):
+                    redraws = []
+                    lm.pbar.refresh = lambda *a, **k: redraws.append(1)
+                    for i in range(100):
+                        lm.log(f"step {i}")
+                    assert len(redraws) <= 1
+                    assert "step 99" in lm.pbar.desc
+        finally:
+            configure(progress_refresh=0.1)
+
+    def test_invalid_style(self):
+        with pytest.raises(ValueError, match="progress_style"):
+            configure(progress_style="spinner")
+
+
+def _body_lines(buf, word):
+    return [l.strip().split(" @ ")[0] for l in buf.getvalue().splitlines() if word in l]
+
+
+class TestLogLimits:
+    def test_every(self, captured_sink):
+        with logmap("every") as lm:
+            for i in range(10):
+                lm.info("tick %d", i, every=3)
+        assert _body_lines(captured_sink, "tick") == ["tick 0", "tick 3", "tick 6", "tick 9"]
+
+    def test_sites_are_separate_and_shared_across_instances(self, captured_sink):
+        for i in range(4):
+            with logmap("loop") as lm:
+                lm.warning("a%d", i, every=2)
+                lm.log("b%d", i, every=4)
+        assert _body_lines(captured_sink, "a") == ["a0", "a2"]
+        assert _body_lines(captured_sink, "b") == ["b0"]
+
+    def test_max_per_second(self, captured_sink):
+        with logmap("rate") as lm:
+            t0 = time.monotonic()
+            for i in range(2000):
+                lm.info("burst %d", i, max_per_second=5)
+            elapsed = time.monotonic() - t0
+        assert 5 <= len(_body_lines(captured_sink, "burst")) <= 5 + 5 * elapsed + 1
+
+    def test_sample(self, captured_sink):
+        import random
+        random.seed(1)
+        with logmap("sample") as lm:
+            for i in range(1000):
+                lm.debug("never", sample=0.0)
+                lm.debug("always", sample=1.0)
+                lm.debug("some", sample=0.1)
+        assert _body_lines(captured_sink, "never") == []
+        assert len(_body_lines(captured_sink, "always")) == 1000
+        assert 50 < len(_body_lines(captured_sink, "some")) < 150
+
+    def test_checked_before_formatting(self, captured_sink):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return "built"
+
+        with logmap("lazy") as lm:
+            for _ in range(10):
+                lm.info(build, every=5)
+                lm.info(build, sample=0.0)
+        assert len(calls) == 2
+
+    def test_dedup(self, captured_sink):
+        configure(dedup=True)
+        try:
+            with logmap("dedup") as lm:
+                for _ in range(5):
+                    lm.info("same")
+                lm.info("value %s", 1)
+                lm.info("value %s", 1)
+                lm.info("value %s", 2)
+                lm.info("tail")
+                lm.info("tail")
+                flush()
+        finally:
+            configure(dedup=False)
+        bodies = [l.strip().split(" @ ")[0] for l in captured_sink.getvalue().splitlines()][1:-1]
+        assert bodies == [
+            "same", "last message repeated 4 times",
+            "value 1", "last message repeated 1 time", "value 2",
+            "tail", "last message repeated 1 time",
+        ]
+
+    def test_dedup_off_by_default(self, captured_sink):
+        with logmap("plain") as lm:
+            lm.info("again")
+            lm.info("again")
+        assert len(_body_lines(captured_sink, "again")) == 2
+
+
+@pytest.fixture
+def multi_cpu(monkeypatch):
+    """Pretend there are several CPUs so the pool path runs on small CI boxes."""
+    import multiprocessing as mp
+    monkeypatch.setattr(mp, "cpu_count", lambda: 4)
+
+
+@pytest.mark.usefixtures("multi_cpu")
+class TestPersistentPools:
+    def test_workers_are_reused_across_calls(self):
+        pids1 = set(pmap(_pid, range(8), num_proc=2, chunksize=1, progress=False))
+        pids2 = set(pmap(_pid, range(8), num_proc=2, chunksize=1, progress=False))
+        assert pids1 & pids2
+
+    def test_lm_map_reuses_pmap_pool(self):
+        pids1 = set(pmap(_pid, range(8), num_proc=2, chunksize=1, progress=False))
+        with logmap("m") as lm:
+            pids2 = set(lm.map(_pid, range(8), num_proc=2, chunksize=1, progress=False))
+        assert pids1 & pids2
+
+    def test_pool_scope_sets_default_num_proc(self):
+        from logmap.logmap import _pools
+        with logmap.pool(num_proc=2) as pool:
+            pids = set(pmap(_pid, range(8), chunksize=1, progress=False))
+            assert len(pids) <= 2
+            assert pool in _pools.values()
+        assert pool not in _pools.values()
+
+    def test_pool_scope_initializer(self):
+        with logmap.pool(num_proc=2, initializer=_set_init_value, initargs=("ready",)):
+            out = pmap(_get_init_value, range(4), progress=False)
+        assert out == ["ready"] * 4
+
+    def test_failed_map_leaves_registry_usable(self):
+        with pytest.raises(RuntimeError):
+            pmap(_raise, range(4), num_proc=2, progress=False)
+        assert pmap(_square, range(4), num_proc=2, progress=False) == [0, 1, 4, 9]
+
+    def test_abandoned_iterator_leaves_registry_usable(self):
+        it = pmap_iter(_square, range(100), num_proc=2, progress=False)
+        assert next(it) == 0
+        it.close()
+        assert pmap(_square, range(4), num_proc=2, progress=False) == [0, 1, 4, 9]
+
+    @staticmethod
+    def _define_main(monkeypatch, name, func):
+        func.__module__, func.__qualname__ = "__main__", name
+        monkeypatch.setattr(sys.modules["__main__"], name, func, raising=False)
+        return func
+
+    def test_main_function_defined_after_first_map(self, monkeypatch):
+        main = sys.modules["__main__"]
+        first = self._define_main(monkeypatch, "_logmap_first", lambda x: x + 1)
+        assert pmap(first, range(4), num_proc=2, progress=False) == [1, 2, 3, 4]
+        monkeypatch.setattr(main, "_logmap_offset", 10, raising=False)
+        second = self._define_main(monkeypatch, "_logmap_second",
+                                   lambda x: x + main._logmap_offset)
+        assert pmap(second, range(4), num_proc=2, progress=False) == [10, 11, 12, 13]
+        monkeypatch.setattr(main, "_logmap_offset", 20)
+        assert pmap(second, range(4), num_proc=2, progress=False) == [20, 21, 22, 23]
+
+    def test_unchanged_main_function_reuses_workers(self, monkeypatch):
+        from logmap import shutdown_pools
+        from logmap.logmap import _pools
+        func = self._define_main(monkeypatch, "_logmap_pid", lambda x: os.getpid())
+        shutdown_pools()
+        pids = [set(pmap(func, range(8), num_proc=2, chunksize=1, progress=False))
+                for _ in range(3)]
+        assert len(set().union(*pids)) <= 2
+        assert _pools
+
+    def test_refreshed_workers_are_reused(self, monkeypatch):
+        from logmap.logmap import _pools
+        pmap(_square, range(4), num_proc=2, progress=False)
+        before = set(_pools.values())
+        func = self._define_main(monkeypatch, "_logmap_ident", lambda x: x)
+        assert pmap(func, range(4), num_proc=2, progress=False) == [0, 1, 2, 3]
+        after = set(_pools.values())
+        assert after != before
+        assert pmap(func, range(4), num_proc=2, progress=False) == [0, 1, 2, 3]
+        assert set(_pools.values()) == after
+
+    def test_main_item_class_defined_mid_stream(self, monkeypatch):
+        from logmap.logmap import _pools
+        pmap(_square, range(4), num_proc=2, progress=False)
+        pools = set(_pools.values())
+        item_type = self._define_main(monkeypatch, "_LogmapItem", type("_LogmapItem", (), {}))
+
+        def items():
+            yield from range(4)
+            yield from (item_type() for _ in range(4))
+
+        out = pmap(_echo, items(), num_proc=2, chunksize=2, progress=False)
+        assert out[:4] == [0, 1, 2, 3]
+        assert [type(x).__name__ for x in out[4:]] == ["_LogmapItem"] * 4
+        assert set(_pools.values()) != pools
+
+    def test_main_function_in_busy_pool_gets_own_workers(self, monkeypatch):
+        from logmap.logmap import _pools
+        func = self._define_main(monkeypatch, "_logmap_inner", lambda x: -x)
+        out = []
+        for x in pmap_iter(_square, range(6), num_proc=2, chunksize=1, progress=False):
+            if x == 0:
+                pools = dict(_pools)
+                assert pmap(func, range(4), num_proc=2, progress=False) == [0, -1, -2, -3]
+                assert _pools == pools
+            out.append(x)
+        assert out == [i * i for i in range(6)]
+
+    def test_failed_map_stops_queued_work(self, tmp_path):
+        with pytest.raises(RuntimeError, match="boom"):
+            pmap(_touch_slowly, range(200), args=(str(tmp_path),), num_proc=2,
+                 chunksize=1, progress=False)
+        time.sleep(0.2)
+        done = len(os.listdir(tmp_path))
+        time.sleep(0.5)
+        assert len(os.listdir(tmp_path)) == done < 50
+
+    def test_closed_iterator_stops_queued_work(self, tmp_path):
+        it = pmap_iter(_touch_slowly, range(4, 200), args=(str(tmp_path),), num_proc=2,
+                       chunksize=1, progress=False)
+        assert next(it) == 4
+        it.close()
+        time.sleep(0.2)
+        done = len(os.listdir(tmp_path))
+        time.sleep(0.5)
+        assert len(os.listdir(tmp_path)) == done < 50
+
+    def test_failed_inner_map_leaves_outer_map_running(self):
+        out = []
+        for x in pmap_iter(_square, range(6), num_proc=2, chunksize=1, progress=False):
+            with pytest.raises(RuntimeError):
+                pmap(_raise, range(4), num_proc=2, progress=False)
+            out.append(x)
+        assert out == [i * i for i in range(6)]
+
+    def test_shutdown_pools(self):
+        from logmap import shutdown_pools
+        from logmap.logmap import _pools
+        pmap(_square, range(4), num_proc=2, progress=False)
+        assert _pools
+        shutdown_pools()
+        assert not _pools
+
+
+class _CountingIter:
+    """Unsized iterator that records how many items have been pulled."""
+
+    def __init__(self, n=None):
+        self.n = n
+        self.pulled = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.n is not None and self.pulled >= self.n:
+            raise StopIteration
+        self.pulled += 1
+        return self.pulled - 1
+
+
+class TestStreamingInput:
+    def test_unbounded_generator_with_lim(self):
+        src = _CountingIter()
+        assert pmap(_square, src, lim=5, num_proc=1, progress=False) == [0, 1, 4, 9, 16]
+        assert src.pulled == 5
+
+    def test_serial_pulls_lazily(self):
+        src = _CountingIter()
+        it = pmap_iter(_square, src, num_proc=1, progress=False)
+        assert next(it) == 0
+        assert src.pulled <= 2
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_parallel_pulls_bounded_window(self):
+        src = _CountingIter()
+        it = pmap_iter(_square, src, num_proc=2, chunksize=3, max_inflight=2, progress=False)
+        assert [next(it) for _ in range(4)] == [0, 1, 4, 9]
+        # two chunks in flight plus a refill per consumed chunk, never the
+        # whole (infinite) input
+        assert src.pulled <= 3 * 4
+        it.close()
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_parallel_generator_preserves_order(self):
+        out = pmap(_square, (i for i in range(50)), num_proc=2, progress=False)
+        assert out == [i * i for i in range(50)]
+
+    def test_total_for_unsized_input(self, captured_sink):
+        with logmap("m") as lm:
+            it = lm.imap(_square, (i for i in range(3)), total=3, num_proc=1, progress=False)
+            assert next(it) == 0
+            assert lm.pbar.total == 3
+            assert list(it) == [1, 4]
+
+    def test_imap_lim_on_generator(self):
+        src = _CountingIter()
+        with logmap("m") as lm:
+            out = lm.map(_square, src, lim=4, num_proc=1, progress=False)
+        assert out == [0, 1, 4, 9]
+        assert src.pulled == 4
+
+
+class TestUnordered:
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_slow_head_does_not_block_later_results(self):
+        it = pmap_iter(_slow_first, range(6), num_proc=2, chunksize=1,
+                       ordered=False, progress=False)
+        assert next(it) != 0
+        rest = list(it)
+        assert 0 in rest
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_with_index_restores_order(self):
+        pairs = pmap(_slow_first, range(6), num_proc=2, chunksize=1,
+                     ordered=False, with_index=True, progress=False)
+        assert sorted(pairs) == [(i, i) for i in range(6)]
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_ordered_default_unchanged(self):
+        out = pmap(_slow_first, range(6), num_proc=2, chunksize=1, progress=False)
+        assert out == list(range(6))
+
+    def test_with_index_serial(self):
+        out = pmap(_square, [3, 4], num_proc=1, with_index=True, progress=False)
+        assert out == [(0, 9), (1, 16)]
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_lm_imap_unordered(self):
+        with logmap("m") as lm:
+            out = lm.map(_square, range(10), num_proc=2, ordered=False, progress=False)
+        assert sorted(out) == [i * i for i in range(10)]
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_unordered_error_propagates(self):
+        with pytest.raises(RuntimeError, match="boom"):
+            pmap(_raise, range(4), num_proc=2, ordered=False, progress=False)
+
+
+@pytest.mark.usefixtures("multi_cpu")
+class TestBroadcast:
+    def test_small_call_unpickled_once_per_worker(self):
+        out = pmap(_report_unpickles, range(12), kwargs={"payload": _CountsUnpickles()},
+                   num_proc=2, chunksize=1, progress=False)
+        assert _unpickled_once_per_worker(out)
+
+    def test_large_call_goes_through_temp_file(self, monkeypatch):
+        import importlib
+        import os
+        import tempfile
+        mod = importlib.import_module("logmap.logmap")
+        created = []
+        real_mkstemp = tempfile.mkstemp
+
+        def spy(*a, **kw):
+            fd, path = real_mkstemp(*a, **kw)
+            created.append(path)
+            return fd, path
+
+        monkeypatch.setattr(mod.tempfile, "mkstemp", spy)
+        payload = _CountsUnpickles(size=mod.BROADCAST_MIN_BYTES * 2)
+        out = pmap(_report_unpickles, range(12), kwargs={"payload": payload},
+                   num_proc=2, chunksize=1, progress=False)
+        assert _unpickled_once_per_worker(out)
+        assert len(created) == 1
+        assert not os.path.exists(created[0])
+
+    def test_workers_drop_calls_of_finished_maps(self):
+        pmap(_report_unpickles, range(8), kwargs={"payload": _CountsUnpickles(size=1000)},
+             num_proc=2, chunksize=1, progress=False)
+        out = pmap(_cached_calls, range(8), num_proc=2, chunksize=1, progress=False)
+        assert all(len(tokens) == 1 for tokens in out)
+
+    def test_args_and_kwargs_still_forwarded(self):
+        assert pmap(_add, range(4), args=(10,), num_proc=2, progress=False) == [10, 11, 12, 13]
+
+
+class TestThreadBackend:
+    def test_lambda_and_closure(self):
+        offset = 100
+        out = pmap(lambda x: x + offset, range(6), num_proc=3, backend="thread", progress=False)
+        assert out == [100, 101, 102, 103, 104, 105]
+
+    def test_runs_concurrently(self):
+        t0 = time.time()
+        pmap(lambda x: time.sleep(0.1), range(8), num_proc=8, chunksize=1,
+             backend="thread", progress=False)
+        assert time.time() - t0 < 0.5
+
+    def test_not_capped_at_cpu_count(self):
+        import multiprocessing as mp
+        n = mp.cpu_count() + 4
+        names = pmap(lambda x: (time.sleep(0.05), threading.current_thread().name)[1],
+                     range(n), num_proc=n, chunksize=1, backend="thread", progress=False)
+        assert len(set(names)) > mp.cpu_count()
+
+    def test_lim_shuffle_and_index(self):
+        pairs = pmap(_square, range(10), lim=4, shuffle=True, num_proc=2,
+                     backend="thread", with_index=True, progress=False)
+        assert len(pairs) == 4
+        assert [i for i, _ in pairs] == [0, 1, 2, 3]
+
+    def test_unordered(self):
+        out = pmap(_slow_first, range(6), num_proc=2, chunksize=1, backend="thread",
+                   ordered=False, progress=False)
+        assert out[0] != 0
+        assert sorted(out) == list(range(6))
+
+    def test_error_propagates(self):
+        with pytest.raises(RuntimeError, match="boom"):
+            pmap(_raise, range(4), num_proc=2, backend="thread", progress=False)
+
+    def test_lm_map_thread_backend(self):
+        with logmap("m") as lm:
+            out = lm.map(lambda x: x * 2, range(5), num_proc=2, backend="thread", progress=False)
+        assert out == [0, 2, 4, 6, 8]
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_serial_backend_stays_in_caller_thread(self):
+        caller = threading.current_thread().name
+        names = pmap(lambda x: threading.current_thread().name, range(4), num_proc=4,
+                     backend="serial", progress=False)
+        assert set(names) == {caller}
+
+    def test_invalid_backend(self):
+        with pytest.raises(ValueError):
+            pmap(_square, range(4), backend="gpu", progress=False)
+
+
+class TestAdaptiveChunks:
+    def test_first_chunk_probes_single_item(self):
+        from logmap.logmap import _ChunkSizer
+        sizer = _ChunkSizer(num_proc=2, total=1000, target=0.1)
+        assert sizer() == 1
+
+    def test_sizes_to_target_duration(self):
+        from logmap.logmap import _ChunkSizer
+        sizer = _ChunkSizer(num_proc=2, total=None, target=0.1)
+        sizer()
+        sizer.observe(1, 0.001)
+        assert sizer() == 100
+
+    def test_shrinks_toward_tail(self):
+        from logmap.logmap import _ChunkSizer
+        sizer = _ChunkSizer(num_proc=2, total=1000, target=0.1)
+        sizer()
+        sizer.observe(1, 1e-6)
+        sizes = []
+        while sizer.dispatched < 1000:
+            sizes.append(sizer())
+        assert sizes[0] > sizes[-1]
+        assert sizes[-1] == 1
+        assert sizes == sorted(sizes, reverse=True)
+
+    def test_explicit_chunksize_disables_adaptive(self, captured_sink):
+        pmap(_square, range(20), num_proc=2, chunksize=5, backend="thread", progress=False)
+        assert "chunksize ->" not in captured_sink.getvalue()
+
+    def test_summary_at_debug_changes_at_trace(self, captured_sink):
+        with logmap("m") as lm:
+            out = lm.map(_square, range(500), num_proc=2, backend="thread", progress=False)
+        assert out == [i * i for i in range(500)]
+        output = captured_sink.getvalue()
+        assert "chunks, chunksize" in output
+        assert "chunksize ->" not in output
+        configure(sink=captured_sink, level="TRACE")
+        try:
+            pmap(_square, range(500), num_proc=2, backend="thread", progress=False)
+        finally:
+            configure(level="DEBUG")
+        assert "chunksize -> 1" in captured_sink.getvalue()
+
+    def test_summary_counts_dispatched_chunks(self, captured_sink):
+        import re
+        stats = MapStats()
+        with logmap("m") as lm:
+            lm.map(_square, range(20), num_proc=2, backend="thread", stats=stats, progress=False)
+        (n_chunks,) = re.findall(r"(\d+) chunks, chunksize", captured_sink.getvalue())
+        assert int(n_chunks) == sum(w.chunks for w in stats.workers.values())
+
+    def test_chunk_sizes_hidden_above_debug(self, captured_sink):
+        configure(sink=captured_sink, level="INFO")
+        try:
+            pmap(_square, range(50), num_proc=2, backend="thread", progress=False)
+        finally:
+            configure(level="DEBUG")
+        assert "chunksize" not in captured_sink.getvalue()
+
+
+@pytest.mark.usefixtures("multi_cpu")
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inspects /dev/shm")
+class TestSharedMemory:
+    def test_large_bytes_arrive_as_views(self):
+        blobs = [bytes([i]) * (2 * 1024 * 1024) for i in range(4)]
+        out = pmap(_describe_buffer, blobs, num_proc=2, chunksize=1, shm=True, progress=False)
+        assert [o[0] for o in out] == ["memoryview"] * 4
+        assert [o[1] for o in out] == [2 * 1024 * 1024] * 4
+        assert [o[2] for o in out] == [bytes([i]) * 3 for i in range(4)]
+
+    def test_small_bytes_pickled_normally(self):
+        out = pmap(_describe_buffer, [b"abc", b"def"], num_proc=2, shm=True, progress=False)
+        assert [o[0] for o in out] == ["bytes", "bytes"]
+
+    def test_large_results_round_trip(self):
+        blobs = [bytes([i]) * (2 * 1024 * 1024) for i in range(3)]
+        before = _shm_segments()
+        out = pmap(_echo, blobs, num_proc=2, chunksize=1, shm=True, progress=False)
+        assert [bytes(o) for o in out] == blobs
+        assert _shm_segments() <= before
+
+    def test_broadcast_kwarg_in_shared_memory(self):
+        big = b"x" * (3 * 1024 * 1024)
+        out = pmap(_describe_buffer, [b"abc"] * 4, kwargs={"extra": big},
+                   num_proc=2, chunksize=1, shm=True, progress=False)
+        assert all(o[3] == len(big) for o in out)
+
+    def test_threshold_controls_transport(self):
+        out = pmap(_describe_buffer, [b"x" * 100] * 2, num_proc=2, shm=50, progress=False)
+        assert [o[0] for o in out] == ["memoryview"] * 2
+
+    def test_segments_cleaned_up_on_error(self):
+        before = _shm_segments()
+        with pytest.raises(RuntimeError):
+            pmap(_raise, [b"x" * (2 * 1024 * 1024)] * 4, num_proc=2, chunksize=1,
+                 shm=True, progress=False)
+        time.sleep(0.2)
+        assert _shm_segments() <= before
+
+    def test_numpy_arrays_are_views(self):
+        np = pytest.importorskip("numpy")
+        arrays = [np.full(500_000, i, dtype=np.float64) for i in range(4)]
+        out = pmap(_array_info, arrays, num_proc=2, chunksize=1, shm=True, progress=False)
+        assert [owns for owns, _ in out] == [False] * 4
+        assert [total for _, total in out] == [500_000.0 * i for i in range(4)]
+
+    def test_numpy_results_round_trip(self):
+        np = pytest.importorskip("numpy")
+        before = _shm_segments()
+        arrays = [np.arange(300_000, dtype=np.int64) + i for i in range(3)]
+        out = pmap(_double, arrays, num_proc=2, chunksize=1, shm=True, progress=False)
+        for a, o in zip(arrays, out):
+            assert np.array_equal(o, a * 2)
+        assert _shm_segments() <= before
+
+
+class TestBatchMode:
+    def test_serial_batches(self):
+        out = pmap(_batch_lens, range(10), batch_size=4, num_proc=1, progress=False)
+        assert out == [4] * 8 + [2] * 2
+
+    def test_results_flattened_with_args(self):
+        out = pmap(_square_batch, range(7), kwargs={"offset": 1}, batch_size=3,
+                   num_proc=1, progress=False)
+        assert out == [x * x + 1 for x in range(7)]
+
+    def test_thread_backend_batches(self):
+        out = pmap(_batch_lens, range(20), batch_size=5, num_proc=2, backend="thread",
+                   progress=False)
+        assert out == [5] * 20
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_process_backend_batches(self):
+        out = pmap(_square_batch, range(50), batch_size=8, num_proc=2, progress=False)
+        assert out == [x * x for x in range(50)]
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_chunks_hold_whole_batches(self):
+        out = pmap(_batch_lens, range(40), batch_size=4, chunksize=6, num_proc=2,
+                   progress=False)
+        assert set(out) == {4}
+
+    def test_with_index(self):
+        out = pmap(_square_batch, range(5), batch_size=2, with_index=True,
+                   num_proc=2, backend="thread", ordered=False, progress=False)
+        assert sorted(out) == [(i, i * i) for i in range(5)]
+
+    def test_wrong_result_length_raises(self):
+        with pytest.raises(ValueError, match="batch of"):
+            pmap(_bad_batch, range(5), batch_size=5, num_proc=1, progress=False)
+
+    def test_lm_map_batch_size(self):
+        with logmap("m") as lm:
+            out = lm.map(_square_batch, range(9), batch_size=4, num_proc=1, progress=False)
+        assert out == [x * x for x in range(9)]
+
+    def test_progress_counts_items(self, capsys, bar_progress):
+        list(pmap_iter(_square_batch, range(10), batch_size=4, num_proc=1))
+        assert "10/10" in capsys.readouterr().err
+
+
+class TestResultCache:
+    @pytest.fixture(autouse=True)
+    def _reset_calls(self):
+        _calls.clear()
+
+    def test_hits_skip_the_call(self, tmp_path):
+        assert pmap(_record_call, range(5), cache=tmp_path, num_proc=1, progress=False) == list(range(5))
+        _calls.clear()
+        out = pmap(_record_call, range(7), cache=tmp_path, num_proc=1, progress=False)
+        assert out == list(range(7))
+        assert _calls == [5, 6]
+
+    def test_args_and_kwargs_are_part_of_the_key(self, tmp_path):
+        pmap(_record_call, range(3), cache=tmp_path, num_proc=1, progress=False)
+        _calls.clear()
+        out = pmap(_record_call, range(3), kwargs={"offset": 10}, cache=tmp_path,
+                   num_proc=1, progress=False)
+        assert out == [10, 11, 12]
+        assert _calls == [0, 1, 2]
+
+    def test_functions_do_not_share_entries(self, tmp_path):
+        pmap(_square, range(4), cache=tmp_path, num_proc=1, progress=False)
+        assert pmap(_record_call, range(4), cache=tmp_path, num_proc=1, progress=False) == list(range(4))
+        assert _calls == [0, 1, 2, 3]
+
+    def test_closures_do_not_share_entries(self, tmp_path):
+        def make(k):
+            return lambda x: x * k
+
+        assert pmap(make(2), range(4), cache=tmp_path, num_proc=1, progress=False) == [0, 2, 4, 6]
+        assert pmap(make(10), range(4), cache=tmp_path, num_proc=1, progress=False) == [0, 10, 20, 30]
+
+    def test_changed_defaults_invalidate(self, tmp_path):
+        def scale(x, k=2, *, offset=0):
+            return x * k + offset
+
+        assert pmap(scale, range(3), cache=tmp_path, num_proc=1, progress=False) == [0, 2, 4]
+        scale.__defaults__ = (3,)
+        assert pmap(scale, range(3), cache=tmp_path, num_proc=1, progress=False) == [0, 3, 6]
+        scale.__kwdefaults__ = {"offset": 1}
+        assert pmap(scale, range(3), cache=tmp_path, num_proc=1, progress=False) == [1, 4, 7]
+
+    def test_closure_over_local_helper(self, tmp_path):
+        def make(k):
+            def helper(x):
+                return x + k
+            return lambda x: helper(x) * 2
+
+        assert pmap(make(1), range(3), cache=tmp_path, num_proc=1, progress=False) == [2, 4, 6]
+        assert pmap(make(5), range(3), cache=tmp_path, num_proc=1, progress=False) == [10, 12, 14]
+
+    def test_callable_objects_do_not_share_entries(self, tmp_path):
+        kw = dict(cache=tmp_path, num_proc=1, progress=False, desc="scale")
+        assert pmap(_Scale(2), range(4), **kw) == [0, 2, 4, 6]
+        assert pmap(_Scale(10), range(4), **kw) == [0, 10, 20, 30]
+
+    def test_set_keys_stable_across_interpreters(self):
+        import subprocess
+        code = (
+            "from logmap import ResultCache\n"
+            "item = ({'alpha', 'beta', 'gamma', frozenset({'x', 'y', 'z'})}, ['a', {'q', 'r'}])\n"
+            "print(ResultCache.key(ResultCache.call_key(len, (), {'k': {'s', 't'}}), item).hex())\n"
+        )
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        keys = {
+            subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True,
+                           cwd=cwd, env={**os.environ, "PYTHONHASHSEED": str(seed)}).stdout
+            for seed in range(4)
+        }
+        assert len(keys) == 1
+
+    def test_unpicklable_closure_refused(self, tmp_path):
+        lock = threading.Lock()
+        with pytest.raises(TypeError, match="can't cache"):
+            pmap(lambda x: (lock, x)[1], range(3), cache=tmp_path, num_proc=1, progress=False)
+
+    def test_thread_backend_mixes_hits_and_misses_in_order(self, tmp_path):
+        pmap(_record_call, range(0, 40, 2), cache=tmp_path, num_proc=1, progress=False)
+        _calls.clear()
+        out = pmap(_record_call, range(40), cache=tmp_path, num_proc=4, backend="thread",
+                   progress=False)
+        assert out == list(range(40))
+        assert sorted(_calls) == list(range(1, 40, 2))
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_process_backend(self, tmp_path):
+        first = pmap(_square, range(30), cache=tmp_path, num_proc=2, progress=False)
+        again = pmap(_square, range(30), cache=tmp_path, num_proc=2, progress=False)
+        assert first == again == [x * x for x in range(30)]
+        with ResultCache(tmp_path) as cache:
+            assert len(cache) == 30
+
+    def test_batch_mode_only_batches_misses(self, tmp_path):
+        pmap(_batch_lens, range(4), batch_size=4, cache=tmp_path, num_proc=1, progress=False)
+        out = pmap(_batch_lens, range(8), batch_size=4, cache=tmp_path, num_proc=1, progress=False)
+        assert out == [4] * 8
+
+    def test_lru_eviction_bounds_size(self, tmp_path):
+        with ResultCache(tmp_path / "c.sqlite", max_bytes=2000) as cache:
+            pmap(_echo, [b"x" * 300 + bytes([i]) for i in range(20)],
+                 cache=cache, num_proc=1, progress=False)
+            assert len(cache) < 20
+            assert cache._stored_bytes() <= 2000
+
+    def test_eviction_prefers_least_recently_used(self, tmp_path):
+        with ResultCache(tmp_path, max_bytes=10 ** 6) as cache:
+            key = ResultCache.call_key(_square)
+            cache.put_many([(ResultCache.key(key, i), b"v" * 100) for i in range(3)])
+            time.sleep(0.01)
+            cache.get_many([ResultCache.key(key, 0)])
+            cache.max_bytes = 250
+            cache.put_many([(ResultCache.key(key, 3), b"v" * 10)])
+            kept = cache.get_many([ResultCache.key(key, i) for i in range(4)])
+        assert set(kept) == {ResultCache.key(key, 0), ResultCache.key(key, 3)}
+
+    def test_progress_shows_hits_and_misses(self, tmp_path, capsys, bar_progress):
+        pmap(_square, range(3), cache=tmp_path, num_proc=1, progress=False)
+        list(pmap_iter(_square, range(5), cache=tmp_path, num_proc=1))
+        assert "hits=3, misses=2" in capsys.readouterr().err
+
+    def test_lm_map_cache(self, tmp_path):
+        with logmap("m") as lm:
+            lm.map(_record_call, range(3), cache=tmp_path, num_proc=1)
+            _calls.clear()
+            assert lm.map(_record_call, range(3), cache=tmp_path, num_proc=1) == [0, 1, 2]
+        assert _calls == []
+
+    def test_counts_logged_under_span_only(self, tmp_path, captured_sink):
+        pmap(_square, range(3), cache=tmp_path, num_proc=2, backend="thread", progress=False)
+        assert "cache:" not in captured_sink.getvalue()
+        with logmap("m") as lm:
+            lm.map(_square, range(5), cache=tmp_path, num_proc=2, backend="thread")
+        assert "cache: 3 hits, 2 misses" in captured_sink.getvalue()
+
+
+class _Interrupt(Exception):
+    pass
+
+
+def _consume_until(it, n):
+    out = []
+    for x in it:
+        out.append(x)
+        if len(out) == n:
+            raise _Interrupt
+    return out
+
+
+class TestJournal:
+    @pytest.fixture(autouse=True)
+    def _reset_calls(self):
+        _calls.clear()
+
+    def test_resume_skips_finished_items(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        with pytest.raises(_Interrupt):
+            _consume_until(pmap_iter(_record_call, range(10), journal=path,
+                                     num_proc=1, progress=False), 4)
+        _calls.clear()
+        out = list(pmap_iter(_record_call, range(10), journal=path, with_index=True,
+                             num_proc=1, progress=False))
+        # The item the consumer was holding when it failed is redone.
+        assert out == [(i, i) for i in range(3, 10)]
+        assert _calls == list(range(3, 10))
+
+    @pytest.mark.parametrize("name", ["run.jsonl", "run.sqlite"])
+    def test_kept_results_are_replayed(self, tmp_path, name):
+        path = tmp_path / name
+        with pytest.raises(_Interrupt):
+            _consume_until(pmap_iter(_record_call, range(6), journal=path,
+                                     journal_results=True, num_proc=1, progress=False), 3)
+        _calls.clear()
+        out = pmap(_record_call, range(6), journal=path, journal_results=True,
+                   num_proc=1, progress=False)
+        assert out == list(range(6))
+        assert _calls == [2, 3, 4, 5]
+
+    def test_sqlite_journal_without_results(self, tmp_path):
+        path = tmp_path / "run.db"
+        pmap(_record_call, range(3), journal=path, num_proc=1, progress=False)
+        assert pmap(_record_call, range(5), journal=path, num_proc=1, progress=False) == [3, 4]
+
+    def test_writes_are_batched(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        pmap(_square_batch, range(50), journal=path, batch_size=5, num_proc=1, progress=False)
+        lines = path.read_text().splitlines()
+        assert json.loads(lines[0]) == {"func": f"{__name__}._square_batch"}
+        assert len(lines) == 2
+        assert json.loads(lines[1])["i"] == list(range(50))
+
+    def test_torn_last_line_is_ignored(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        pmap(_record_call, range(3), journal=path, num_proc=1, progress=False)
+        with open(path, "a") as f:
+            f.write('{"i": [3, 4')
+        assert pmap(_record_call, range(5), journal=path, num_proc=1, progress=False) == [3, 4]
+
+    def test_other_function_rejected(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        pmap(_record_call, range(3), journal=path, num_proc=1, progress=False)
+        with pytest.raises(ValueError, match="belongs to"):
+            pmap(_square, range(3), journal=path, num_proc=1, progress=False)
+
+    def test_shuffle_rejected(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        with pytest.raises(ValueError, match="shuffle"):
+            pmap(_record_call, range(10), journal=path, shuffle=True,
+                 num_proc=1, progress=False)
+        with pytest.raises(ValueError, match="shuffle"):
+            with logmap("m") as lm:
+                lm.map(_record_call, range(10), journal=path, shuffle=True, num_proc=1)
+        assert _calls == []
+        assert not path.exists()
+
+    def test_thread_backend_unordered(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        with pytest.raises(_Interrupt):
+            _consume_until(pmap_iter(_record_call, range(40), journal=path, num_proc=4,
+                                     backend="thread", ordered=False, chunksize=2,
+                                     progress=False), 10)
+        first = set(_calls)
+        _calls.clear()
+        rest = pmap(_record_call, range(40), journal=path, num_proc=4, backend="thread",
+                    ordered=False, progress=False)
+        assert len(rest) < 40
+        assert set(rest) | first == set(range(40))
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_process_backend(self, tmp_path):
+        path = tmp_path / "run.jsonl"
+        pmap(_square, range(20), journal=path, journal_results=True, num_proc=2, progress=False)
+        out = pmap(_square, range(30), journal=path, journal_results=True, num_proc=2,
+                   progress=False)
+        assert out == [x * x for x in range(30)]
+
+
+async def _adouble(x, delay=0.0):
+    await asyncio.sleep(delay)
+    return x * 2
+
+
+class TestAsyncMap:
+    def test_gathered_tasks_keep_their_own_depth(self):
+        async def task(name):
+            async with logmap(name) as lm:
+                await asyncio.sleep(0.01)
+                async with logmap(f"{name}-inner") as inner:
+                    await asyncio.sleep(0.01)
+                    return lm.num, inner.num
+
+        async def run():
+            async with logmap("outer") as lm:
+                return lm.num, await asyncio.gather(*(task(f"t{i}") for i in range(5)))
+
+        outer, depths = asyncio.run(run())
+        assert depths == [(outer + 1, outer + 2)] * 5
+
+    def test_amap_returns_results_in_order(self):
+        async def run():
+            async with logmap("m") as lm:
+                return await lm.amap(_adouble, range(20), kwargs={"delay": 0.001},
+                                     concurrency=4, progress=False)
+
+        assert asyncio.run(run()) == [x * 2 for x in range(20)]
+
+    def test_aimap_yields_as_completed(self):
+        async def slow_first(x):
+            await asyncio.sleep(0.05 if x == 0 else 0)
+            return x
+
+        async def run():
+            async with logmap("m") as lm:
+                return [r async for r in lm.aimap(slow_first, range(5), progress=False)]
+
+        out = asyncio.run(run())
+        assert sorted(out) == list(range(5))
+        assert out[-1] == 0
+
+    def test_concurrency_is_bounded(self):
+        running = peak = 0
+
+        async def track(x):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.001)
+            running -= 1
+            return x
+
+        async def run():
+            async with logmap("m") as lm:
+                return await lm.amap(track, range(50), concurrency=7, progress=False)
+
+        assert asyncio.run(run()) == list(range(50))
+        assert peak == 7
+
+    def test_with_index_and_lim(self):
+        async def run():
+            async with logmap("m") as lm:
+                return [p async for p in lm.aimap(_adouble, iter(range(100)), lim=3,
+                                                  with_index=True, progress=False)]
+
+        assert sorted(asyncio.run(run())) == [(0, 0), (1, 2), (2, 4)]
+
+    def test_error_cancels_the_rest(self):
+        cancelled = []
+
+        async def work(x):
+            if x == 0:
+                raise RuntimeError("boom")
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(x)
+                raise
+
+        async def run():
+            async with logmap("m") as lm:
+                await lm.amap(work, range(4), progress=False)
+
+        with pytest.raises(RuntimeError, match="boom"):
+            asyncio.run(run())
+        assert sorted(cancelled) == [1, 2, 3]
+
+    def test_nested_spans_log_at_task_depth(self, captured_sink):
+        async def work(x):
+            async with logmap(f"item {x}") as lm:
+                await asyncio.sleep(0.001 * (3 - x))
+                lm.log(f"done {x}")
+
+        async def run():
+            async with logmap("outer") as lm:
+                await lm.amap(work, range(3), progress=False)
+
+        asyncio.run(run())
+        lines = captured_sink.getvalue().splitlines()
+        for x in range(3):
+            assert any(line.startswith(f"    done {x}") for line in lines)
+
+    def test_progress_counts_items(self, capsys, bar_progress):
+        async def run():
+            async with logmap("m") as lm:
+                await lm.amap(_adouble, range(6))
+
+        asyncio.run(run())
+        assert "6/6" in capsys.readouterr().err
+
+
+@logmap.fn
+def _profiled_step(x):
+    time.sleep(0.002)
+    return x
+
+
+class TestProfile:
+    def test_paths_counts_and_times(self):
+        with logmap.profile() as prof:
+            with logmap("pipeline"):
+                for i in range(3):
+                    _profiled_step(i)
+                with logmap("load"):
+                    time.sleep(0.01)
+        rows = {path: (calls, total, self_time, mean)
+                for path, calls, total, self_time, mean in prof.stats()}
+        assert set(rows) == {
+            ("pipeline",),
+            ("pipeline", "_profiled_step()"),
+            ("pipeline", "load"),
+        }
+        calls, total, self_time, mean = rows[("pipeline", "_profiled_step()")]
+        assert calls == 3
+        assert total >= 0.006
+        assert mean == pytest.approx(total / 3)
+        p_calls, p_total, p_self, _ = rows[("pipeline",)]
+        assert p_calls == 1
+        assert p_self == pytest.approx(p_total - total - rows[("pipeline", "load")][1])
+
+    def test_sorted_by_cumulative_time(self):
+        with logmap.profile() as prof:
+            with logmap("fast"):
+                pass
+            with logmap("slow"):
+                time.sleep(0.01)
+        assert [row[0] for row in prof.stats()] == [("slow",), ("fast",)]
+
+    def test_nothing_recorded_outside_the_block(self):
+        with logmap.profile() as prof:
+            pass
+        with logmap("after"):
+            pass
+        assert prof.stats() == []
+
+    def test_failed_span_is_recorded(self):
+        with logmap.profile() as prof:
+            with pytest.raises(ValueError):
+                with logmap("fails"):
+                    raise ValueError
+        assert prof.stats()[0][:2] == (("fails",), 1)
+
+    def test_recording_does_not_depend_on_output(self):
+        with logmap.quiet(), logmap.profile() as prof:
+            _profiled_step(1)
+        assert prof.stats()[0][:2] == (("_profiled_step()",), 1)
+
+    def test_gathered_tasks_nest_under_their_span(self):
+        async def task():
+            async with logmap("task"):
+                await asyncio.sleep(0.01)
+
+        async def run():
+            async with logmap("outer"):
+                await asyncio.gather(*(task() for _ in range(4)))
+
+        with logmap.profile() as prof:
+            asyncio.run(run())
+        rows = {row[0]: row for row in prof.stats()}
+        assert rows[("outer", "task")][1] == 4
+        # Overlapping children would make the parent's self time negative.
+        assert rows[("outer",)][3] == 0.0
+
+    def test_report(self):
+        with logmap.profile() as prof:
+            with logmap("a"):
+                with logmap("b"):
+                    pass
+        lines = prof.report().splitlines()
+        assert lines[0].split() == ["calls", "total", "s", "self", "s", "mean", "s", "path"]
+        assert lines[1].endswith("  a")
+        assert lines[2].endswith("  a > b")
+        assert str(prof) == prof.report()
+
+
+def _load_trace(path):
+    text = path.read_text()
+    # Viewers accept an unterminated array; close it for json.loads.
+    return json.loads(text if text.rstrip().endswith("]") else text + "]")
+
+
+@pytest.fixture
+def trace_path(tmp_path):
+    path = tmp_path / "run.trace.json"
+    configure(trace=str(path))
+    try:
+        yield path
+    finally:
+        configure(trace=None)
+
+
+class TestTrace:
+    def test_spans_become_begin_end_pairs(self, trace_path, captured_sink):
+        with logmap("outer"):
+            with logmap("inner"):
+                pass
+        configure(trace=None)
+        events = _load_trace(trace_path)
+        spans = [(e["ph"], e.get("name")) for e in events if e["ph"] in "BE"]
+        assert spans == [("B", "outer"), ("B", "inner"), ("E", None), ("E", None)]
+        assert all(e["pid"] == os.getpid() for e in events)
+        assert len({e["tid"] for e in events if e["ph"] in "BE"}) == 1
+
+    def test_file_is_loadable_while_open(self, trace_path, captured_sink):
+        with logmap("span"):
+            pass
+        flush()
+        events = _load_trace(trace_path)
+        assert [e["ph"] for e in events if e["ph"] in "BE"] == ["B", "E"]
+
+    def test_failed_span_records_error(self, trace_path, captured_sink):
+        with pytest.raises(ValueError):
+            with logmap("fails"):
+                raise ValueError("bad")
+        configure(trace=None)
+        end = [e for e in _load_trace(trace_path) if e["ph"] == "E"][0]
+        assert end["args"]["error"] == "ValueError: bad"
+
+    def test_gathered_tasks_get_their_own_lanes(self, trace_path, captured_sink):
+        async def task(i):
+            async with logmap(f"t{i}"):
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(*(task(i) for i in range(3)))
+
+        asyncio.run(run())
+        configure(trace=None)
+        events = _load_trace(trace_path)
+        lanes = {e["tid"] for e in events if e["ph"] == "B"}
+        assert len(lanes) == 3
+        named = {e["tid"] for e in events if e.get("name") == "thread_name"}
+        assert lanes <= named
+
+    def test_map_items_are_timed_per_item(self, trace_path):
+        pmap(_square, range(5), num_proc=1, progress=False)
+        configure(trace=None)
+        items = [e for e in _load_trace(trace_path) if e["ph"] == "X"]
+        assert sorted(e["args"]["index"] for e in items) == list(range(5))
+        assert all(e["name"] == "_square" and e["dur"] >= 0 for e in items)
+
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_process_workers_get_lanes(self, trace_path):
+        pmap(_square, range(40), num_proc=2, chunksize=5, progress=False)
+        configure(trace=None)
+        events = _load_trace(trace_path)
+        items = [e for e in events if e["ph"] == "X"]
+        assert sorted(e["args"]["index"] for e in items) == list(range(40))
+        worker_pids = {e["pid"] for e in items}
+        assert os.getpid() not in worker_pids
+        names = {e["pid"] for e in events if e.get("name") == "process_name"}
+        assert worker_pids <= names
+
+    def test_batches_list_their_items(self, trace_path):
+        pmap(_square_batch, range(7), batch_size=3, num_proc=2, backend="thread",
+             progress=False)
+        configure(trace=None)
+        items = [e["args"]["items"] for e in _load_trace(trace_path) if e["ph"] == "X"]
+        assert sorted(items) == [[0, 1, 2], [3, 4, 5], [6]]
+
+    def test_cached_items_are_not_traced(self, trace_path, tmp_path):
+        pmap(_square, range(3), cache=tmp_path, num_proc=1, progress=False)
+        configure(trace=str(trace_path))
+        pmap(_square, range(5), cache=tmp_path, num_proc=1, progress=False)
+        configure(trace=None)
+        items = [e["args"]["index"] for e in _load_trace(trace_path) if e["ph"] == "X"]
+        assert items == [3, 4]
+
+
+@pytest.mark.usefixtures("multi_cpu")
+class TestWorkerLogs:
+    def test_records_nest_under_the_map_span(self, captured_sink):
+        with logmap("outer"):
+            with logmap("mapping") as lm:
+                lm.map(_logging_work, range(4), num_proc=2, progress=False)
+        lines = captured_sink.getvalue().splitlines()
+        worker_lines = [line for line in lines if "[worker " in line]
+        assert len(worker_lines) == 4 * 4
+        for x in range(4):
+            assert any(line.startswith("    [worker ") and f"⎾ item {x}" in line
+                       for line in worker_lines)
+            assert any(line.startswith("    [worker ") and f"  working on {x}" in line
+                       for line in worker_lines)
+
+    def test_records_precede_the_closing_line(self, captured_sink):
+        with logmap("mapping") as lm:
+            lm.map(_logging_work, range(6), num_proc=2, progress=False)
+        lines = captured_sink.getvalue().splitlines()
+        last_worker = max(i for i, line in enumerate(lines) if "[worker " in line)
+        closing = max(i for i, line in enumerate(lines) if line.startswith("⎿"))
+        assert last_worker < closing
+
+    def test_parent_level_filter_applies(self, captured_sink):
+        configure(level="INFO")
+        try:
+            pmap(_logging_work, range(3), num_proc=2, progress=False)
+        finally:
+            configure(level="DEBUG")
+        worker_lines = [line for line in captured_sink.getvalue().splitlines()
+                        if "[worker " in line]
+        assert sorted(line.split("] ")[1].split(" @")[0] for line in worker_lines) == [
+            "  info 0", "  info 1", "  info 2",
+        ]
+
+    def test_structured_records_carry_worker_and_depth(self, captured_sink):
+        configure(structured=True)
+        try:
+            with logmap("mapping") as lm:
+                lm.map(_logging_work, range(2), num_proc=2, progress=False)
+        finally:
+            configure(structured=False)
+        records = [json.loads(line) for line in captured_sink.getvalue().splitlines()]
+        forwarded = [r for r in records if "worker" in r]
+        assert {r["msg"] for r in forwarded} >= {"working on 0", "working on 1"}
+        assert {r["depth"] for r in forwarded} == {2}
+        assert all(r["worker"] != os.getpid() for r in forwarded)
+
+    def test_quiet_parent_silences_workers(self, captured_sink):
+        with logmap.quiet():
+            pmap(_logging_work, range(3), num_proc=2, progress=False)
+        assert "[worker " not in captured_sink.getvalue()
+
+
+class TestThreadWorkerNesting:
+    def test_thread_worker_spans_nest_under_the_caller(self, captured_sink):
+        with logmap("outer") as lm:
+            lm.map(_logging_work, range(3), num_proc=2, backend="thread", progress=False)
+        lines = captured_sink.getvalue().splitlines()
+        for x in range(3):
+            assert any(line.startswith(f"  ⎾ item {x}") for line in lines)
+            assert any(line.startswith(f"    working on {x}") for line in lines)
+
+
+class TestMapStats:
+    @pytest.mark.usefixtures("multi_cpu")
+    def test_process_workers(self):
+        with logmap("m") as lm:
+            lm.map(_echo, [bytes([i]) * 1000 for i in range(40)], num_proc=2, chunksize=4,
+                   progress=False)
+        stats = lm.last_map_stats
+        assert stats.backend == "process"
+        assert stats.num_proc == 2
+        assert stats.items == 40
+        assert os.getpid() not in stats.workers
+        assert sum(w.chunks for w in stats.workers.values()) == 10
+        for w in stats.workers.values():
+            assert w.bytes_in >= 1000 * w.items
+            assert w.bytes_out >= 1000 * w.items
+            assert w.busy >= 0 and w.idle >= 0
+            assert w.busy + w.idle == pytest.approx(stats.wall)
+        assert stats.unpickle > 0
+
+    def test_thread_workers_are_keyed_by_thread(self):
+        with logmap("m") as lm:
+            lm.map(_square, range(30), num_proc=3, backend="thread", progress=False)
+        stats = lm.last_map_stats
+        assert stats.backend == "thread"
+        assert stats.items == 30
+        assert threading.get_native_id() not in stats.workers
+        assert all(w.bytes_in == w.bytes_out == 0 for w in stats.workers.values())
+
+    def test_serial(self):
+        with logmap("m") as lm:
+            lm.map(_square, range(5), num_proc=1, progress=False)
+        stats = lm.last_map_stats
+        assert (stats.backend, stats.items, len(stats.workers)) == ("serial", 5, 1)
+        assert 0 <= stats.utilization <= 1
+
+    def test_pmap_iter_fills_given_stats(self):
+        stats = MapStats()
+        assert pmap(_square, range(6), num_proc=2, backend="thread", stats=stats,
+                    progress=False) == [x * x for x in range(6)]
+        assert stats.items == 6
+        assert stats.wall > 0
+
+    def test_cached_items_not_attributed(self, tmp_path):
+        pmap(_square, range(4), cache=tmp_path, num_proc=1, progress=False)
+        stats = MapStats()
+        pmap(_square, range(6), cache=tmp_path, num_proc=1, stats=stats, progress=False)
+        assert stats.items == 2
+
+    def test_summary_logged_on_close(self, captured_sink):
+        with logmap("m") as lm:
+            lm.map(_square, range(10), num_proc=2, backend="thread", progress=False)
+        out = captured_sink.getvalue()
+        assert "10 items on" in out
+        assert "thread workers in" in out
+        assert "% busy" in out
+        assert lm.last_map_stats.summary() in out
+
+    def test_bare_pmap_summary_only_at_trace(self, captured_sink):
+        pmap(_square, range(10), num_proc=2, backend="thread", progress=False)
+        assert "items on" not in captured_sink.getvalue()
+        configure(sink=captured_sink, level="TRACE")
+        try:
+            pmap(_square, range(10), num_proc=2, backend="thread", progress=False)
+        finally:
+            configure(level="DEBUG")
+        assert "10 items on" in captured_sink.getvalue()